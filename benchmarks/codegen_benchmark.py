@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+
+""" Benchmarks of the Doping source-to-source transformation with large
+synthetic C/C++ inputs (thousands of loops, deep loop nests, large headers
+and many functions). For each input it measures the DopingTranslationUnit
+parse time, the variable_analysis time of all the loops, the Rewriter edit
+throughput, the whole InjectDoping transformation and the peak memory, and
+compares them with a baseline file (generated locally with --update-baseline,
+as the timings depend on the machine) to flag regressions. """
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from codegen.ast.translation_unit import DopingTranslationUnit
+from codegen.rewriter import PieceTableRewriter
+from codegen.transformations import InjectDoping
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "codegen_baseline.json")
+
+# Metrics where a larger value is better, for the others smaller is better
+HIGHER_IS_BETTER = ("rewriter_lines_per_second",)
+
+# Lines inserted by the Rewriter benchmark at each loop, similar to the
+# code generated by InjectDoping for a loop
+EDIT_LINES = 40
+# Times the edits of each input are repeated, so the timing is not too short
+EDIT_REPETITIONS = 10
+
+
+def loop_nest(depth, indent="    "):
+    ''' Return a loop nest of the given depth with runtime invariants, the
+    loops use the i0..i<depth> variables and the n, m and s parameters. '''
+    lines = []
+    for level in range(depth):
+        lines.append("{0}for(int i{1} = 0; i{1} < n; i{1}++){{".format(
+            indent * (level + 1), level))
+    index = " + ".join("i{0}".format(level) for level in range(depth))
+    lines.append("{0}A[({1}) % m] += B[i0 % m] * s + {1};".format(
+        indent * (depth + 1), index))
+    for level in reversed(range(depth)):
+        lines.append(indent * (level + 1) + "}")
+    return lines
+
+
+def many_loops(size):
+    ''' A few long functions with many consecutive loops each. '''
+    lines = ["#include <stdio.h>", "#include <stdlib.h>",
+             "double A[1000], B[1000];"]
+    for function in range(10):
+        lines.append("void f{0}(int n, int m, double s){{".format(function))
+        for _ in range(size * 5):
+            lines.extend(loop_nest(2))
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def many_functions(size):
+    ''' Many small functions with a single loop each. '''
+    lines = ["#include <stdio.h>", "double A[1000], B[1000];"]
+    for function in range(size * 50):
+        lines.append("void f{0}(int n, int m, double s){{".format(function))
+        lines.extend(loop_nest(1))
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def deep_nesting(size):
+    ''' Functions with deep loop nests. '''
+    lines = ["double A[1000], B[1000];"]
+    for function in range(size * 5):
+        lines.append("void f{0}(int n, int m, double s){{".format(function))
+        lines.extend(loop_nest(12))
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def large_header(size):
+    ''' A few loops in a file that includes a large header (declarations,
+    structs and static inline functions with loops that must be skipped). '''
+    header = ["#ifndef LARGE_HEADER_H", "#define LARGE_HEADER_H"]
+    for declaration in range(size * 500):
+        header.append("typedef struct {{ int a; double b[4]; }} type{0};".format(declaration))
+        header.append("double function{0}(type{0} * x, int n);".format(declaration))
+        header.append("static inline double inline{0}(const double * x, int n){{".format(
+            declaration))
+        header.append("    double r = 0; for(int i = 0; i < n; i++) r += x[i]; return r;")
+        header.append("}")
+    header.append("#endif")
+    lines = ["#include <stdio.h>", "#include <math.h>", "#include \"large_header.h\"",
+             "double A[1000], B[1000];"]
+    for function in range(size * 5):
+        lines.append("void f{0}(int n, int m, double s){{".format(function))
+        lines.extend(loop_nest(2))
+        lines.append("    s = inline{0}(A, n);".format(function))
+        lines.append("}")
+    return "\n".join(lines) + "\n", "\n".join(header) + "\n"
+
+
+def cpp_templates(size):
+    ''' C++ source with a heavy standard library preamble, classes and
+    templates. '''
+    lines = ["#include <vector>", "#include <map>", "#include <string>",
+             "std::vector<double> A(1000), B(1000);"]
+    for function in range(size * 10):
+        lines.append("template <typename T> struct Kernel{0} {{".format(function))
+        lines.append("    T A[1000], B[1000];")
+        lines.append("    void run(int n, int m, T s){")
+        lines.extend(loop_nest(1))
+        lines.append("    }")
+        lines.append("};")
+        lines.append("void f{0}(int n, int m, double s){{".format(function))
+        lines.extend(loop_nest(2))
+        lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+# Name, file name and generator of each synthetic input
+INPUTS = [
+    ("many_loops", "many_loops.c", many_loops),
+    ("many_functions", "many_functions.c", many_functions),
+    ("deep_nesting", "deep_nesting.c", deep_nesting),
+    ("large_header", "large_header.c", large_header),
+    ("cpp_templates", "cpp_templates.cc", cpp_templates),
+]
+
+
+def write_input(directory, filename, generator, size):
+    ''' Generate the input (and its header, if any) in the directory and
+    return the path of the source file. '''
+    content = generator(size)
+    if isinstance(content, tuple):
+        content, header = content
+        with open(os.path.join(directory, "large_header.h"), "w") as fobj:
+            fobj.write(header)
+    path = os.path.join(directory, filename)
+    with open(path, "w") as fobj:
+        fobj.write(content)
+    return path
+
+
+def best_time(function, repetitions):
+    ''' Return the minimum seconds of the given repetitions of function. '''
+    best = None
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_input(name, filename, generator, size, repetitions):
+    '''
+    Run the benchmarks of one input and return its metrics. It is executed
+    in its own process, so the maximum resident memory is only the one of
+    this input.
+    '''
+    # pylint: disable=too-many-locals
+    with tempfile.TemporaryDirectory(prefix="doping_benchmark") as directory:
+        path = write_input(directory, filename, generator, size)
+        with open(path, "r") as fobj:
+            metrics = {"lines": sum(1 for _ in fobj)}
+
+        # Cold parses use an empty preamble cache each time, cached parses
+        # reuse the precompiled preamble.
+        def parse_cold():
+            os.environ["DOPING_CACHE_DIR"] = tempfile.mkdtemp(dir=directory)
+            DopingTranslationUnit(path).get_root()
+        metrics["parse_seconds"] = best_time(parse_cold, repetitions)
+        metrics["parse_cached_seconds"] = best_time(
+            lambda: DopingTranslationUnit(path).get_root(), repetitions)
+
+        def analyse():
+            root = DopingTranslationUnit(path).get_root()
+            start = time.perf_counter()
+            loops = list(root.find_loops(outermostonly=True, exclude_headers=True))
+            find_loops = time.perf_counter() - start
+            start = time.perf_counter()
+            for loop in loops:
+                loop.variable_analysis()
+            return loops, find_loops, time.perf_counter() - start
+        timings = [analyse() for _ in range(repetitions)]
+        loops = timings[0][0]
+        metrics["loops"] = len(loops)
+        metrics["find_loops_seconds"] = min(x[1] for x in timings)
+        metrics["variable_analysis_seconds"] = min(x[2] for x in timings)
+
+        # The memory is traced in a separate analysis, as tracing slows it
+        tracemalloc.start()
+        analyse()
+        metrics["peak_python_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+        # Edits at the original line of each loop, as the transformation does
+        lines = [loop.location.line for loop in loops]
+
+        def edit():
+            for _ in range(EDIT_REPETITIONS):
+                rewriter = PieceTableRewriter(os.path.join(directory, "edited.c"), path)
+                for line in lines:
+                    rewriter.goto_original_line(line)
+                    for _ in range(EDIT_LINES):
+                        rewriter.insert("// inserted line")
+                rewriter.get_content()
+        seconds = best_time(edit, repetitions)
+        metrics["rewriter_lines_per_second"] = \
+            len(lines) * EDIT_LINES * EDIT_REPETITIONS / seconds
+
+        def transform():
+            with redirect_stdout(io.StringIO()):
+                InjectDoping(path, os.path.join(directory, "output" + filename),
+                             "gcc -O2", filename.endswith(".cc")).apply()
+        metrics["inject_doping_seconds"] = best_time(transform, repetitions)
+
+        metrics["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return name, metrics
+
+
+def run(size, repetitions, selected=None):
+    ''' Run the benchmarks of the selected inputs (all by default) and
+    return a dictionary with the metrics of each of them. '''
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, filename, generator in INPUTS:
+        if selected and name not in selected:
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            _, metrics = pool.submit(benchmark_input, name, filename, generator,
+                                     size, repetitions).result()
+        results[name] = metrics
+        print("{0:16} {1:6} lines {2:5} loops  parse {3:.3f}s ({4:.3f}s cached)  "
+              "analysis {5:.3f}s  rewriter {6:.0f} lines/s  transformation {7:.3f}s  "
+              "max rss {8:.0f} MB".format(
+                  name, metrics["lines"], metrics["loops"], metrics["parse_seconds"],
+                  metrics["parse_cached_seconds"], metrics["variable_analysis_seconds"],
+                  metrics["rewriter_lines_per_second"], metrics["inject_doping_seconds"],
+                  metrics["max_rss_mb"]))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    ''' Return a list of messages describing the metrics that are worse than
+    the baseline by more than the given tolerance (as a fraction). '''
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get(name, {})
+        for metric, value in metrics.items():
+            if metric not in reference or metric in ("lines", "loops"):
+                continue
+            expected = reference[metric]
+            if metric in HIGHER_IS_BETTER:
+                worse = value < expected / (1 + tolerance)
+            else:
+                worse = value > expected * (1 + tolerance)
+            if worse:
+                regressions.append("{0} {1}: {2:.4g} (baseline {3:.4g})".format(
+                    name, metric, value, expected))
+    return regressions
+
+
+def main(argv=None):
+    ''' Command line entry point, with --check it returns 1 if there are
+    regressions. '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=10,
+                        help="Scale of the synthetic inputs (default 10)")
+    parser.add_argument("--repetitions", type=int, default=3,
+                        help="Repetitions of each timing, the minimum is used")
+    parser.add_argument("--input", action="append", choices=[x[0] for x in INPUTS],
+                        help="Only run the given input (it can be repeated)")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="Baseline file (default codegen_baseline.json)")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Allowed fraction over the baseline (default 0.5)")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="Exit with an error if there are regressions")
+    parser.add_argument("--output", help="Write the results in this JSON file")
+    args = parser.parse_args(argv)
+
+    results = run(args.size, args.repetitions, args.input)
+    report = {"size": args.size, "inputs": results}
+    if args.output:
+        with open(args.output, "w") as fobj:
+            json.dump(report, fobj, indent=2)
+
+    if args.update_baseline:
+        rounded = {name: {metric: float("{0:.4g}".format(value))
+                          for metric, value in metrics.items()}
+                   for name, metrics in results.items()}
+        with open(args.baseline, "w") as fobj:
+            json.dump({"size": args.size, "inputs": rounded}, fobj, indent=2)
+        print("Baseline updated: " + args.baseline)
+        return 0
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline found in " + args.baseline + ", generate it with"
+              " --update-baseline.")
+        return 0
+    with open(args.baseline, "r") as fobj:
+        baseline = json.load(fobj)
+    if baseline.get("size") != args.size:
+        print("The baseline was generated with size {0}, not comparing.".format(
+            baseline.get("size")))
+        return 0
+    regressions = compare(results, baseline["inputs"], args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    if not regressions:
+        print("No regressions over the baseline.")
+    return 1 if regressions and args.check else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
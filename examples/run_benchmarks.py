@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+""" End-to-end speedup benchmarks of the quick examples. For each example
+and size it builds the native and the dope-wrapped binaries, runs both
+alternately a number of times and reports the speedup of the Doping version
+with and without the time spent compiling the specializations at runtime,
+which is taken from the runtime trace (DOPING_TRACE). """
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "quick_examples")
+
+# Source file, compiler flags (as in the example Makefile) and default size
+# sweep (the program arguments of each run) of each example.
+EXAMPLES = {
+    "helloworld": ("helloworld/helloworld.c", "-O3 -march=native", [""]),
+    "multiplematrixmult": ("multiplematrixmult/mm.cc", "-O2",
+                           ["50 10000", "100 1000", "200 100"]),
+    "imgfilt": ("imgfilt/imgfilt-cpp.cc", "-O2", ["10", "50"]),
+    "skewedgaussseidel": ("skewedgaussseidel/skewedgaussseidel.cc",
+                          "-O3 -march=native", ["10 512 0.0000001 0", "100"]),
+}
+
+# Two-sided 95% critical values of the Student's t distribution by degrees
+# of freedom, larger samples use the normal approximation.
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+        2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+        2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def confidence_interval(values):
+    """ Return the mean of the values and the half width of its 95%
+    confidence interval (0 if there is a single value). """
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    variance = sum((x - mean) ** 2 for x in values) / (len(values) - 1)
+    degrees = len(values) - 1
+    critical = T_95[degrees - 1] if degrees <= len(T_95) else 1.96
+    return mean, critical * math.sqrt(variance / len(values))
+
+
+def build(example, compiler, directory):
+    """ Build the native and Doping versions of the example in the given
+    directory and return the path of both binaries. """
+    source, flags, _ = EXAMPLES[example]
+    shutil.copy(os.path.join(EXAMPLES_DIR, source), directory)
+    source = os.path.basename(source)
+    command = [compiler] + flags.split() + [source, "-o"]
+    dope = os.path.join(os.environ["DOPING_ROOT"], "bin", "dope")
+    native = os.path.join(directory, "native.exe")
+    doping = os.path.join(directory, "doping.exe")
+    for binary, prefix in ((native, []), (doping, [dope, "--no-cache", "--"])):
+        result = subprocess.run(prefix + command + [binary], cwd=directory,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        if result.returncode != 0:
+            raise RuntimeError("Failed to build {0}:\n{1}".format(binary, result.stdout))
+    return native, doping
+
+
+def run(binary, arguments, trace=None):
+    """ Run the binary and return its wall time in seconds. If a trace file
+    is given, the runtime trace is written in it. """
+    env = dict(os.environ)
+    # Each run must compile its specializations
+    env.pop("DOPING_CACHE_DIR", None)
+    env["LD_LIBRARY_PATH"] = os.pathsep.join(
+        [os.path.join(env["DOPING_ROOT"], "bin"), env.get("LD_LIBRARY_PATH", "")])
+    if trace:
+        env["DOPING_TRACE"] = trace
+    start = time.perf_counter()
+    result = subprocess.run([binary] + arguments.split(), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError("{0} {1} failed:\n{2}".format(binary, arguments, result.stderr))
+    return elapsed
+
+
+def runtime_times(trace):
+    """ Return the seconds spent preparing the specializations (rendering,
+    compiling and loading them) and running them, from a runtime trace. """
+    if not os.path.isfile(trace):
+        return 0.0, 0.0
+    with open(trace, "r") as fobj:
+        loops = json.load(fobj)["loops"]
+    compile_time = sum(loop["render_time"] + loop["compile_time"] + loop["dlopen_time"]
+                       for loop in loops)
+    return compile_time, sum(loop["specialized_time"] for loop in loops)
+
+
+def benchmark(example, arguments, native, doping, repetitions, directory):
+    """ Run the native and Doping binaries alternately and return the
+    statistics of the example with the given arguments. """
+    native_times, doping_times, compile_times, specialized_times = [], [], [], []
+    trace = os.path.join(directory, "trace.json")
+    for _ in range(repetitions):
+        native_times.append(run(native, arguments))
+        if os.path.isfile(trace):
+            os.remove(trace)
+        doping_times.append(run(doping, arguments, trace))
+        compile_time, specialized_time = runtime_times(trace)
+        compile_times.append(compile_time)
+        specialized_times.append(specialized_time)
+
+    # Speedups of each pair of runs, with and without the runtime compilation
+    speedups = [n / d for n, d in zip(native_times, doping_times)]
+    loop_speedups = [n / max(d - c, 1e-9)
+                     for n, d, c in zip(native_times, doping_times, compile_times)]
+    result = {"example": example, "arguments": arguments, "repetitions": repetitions}
+    for name, values in (("native_seconds", native_times),
+                         ("doping_seconds", doping_times),
+                         ("compile_seconds", compile_times),
+                         ("specialized_seconds", specialized_times),
+                         ("speedup", speedups),
+                         ("speedup_without_compilation", loop_speedups)):
+        mean, interval = confidence_interval(values)
+        result[name] = {"mean": mean, "ci95": interval}
+    return result
+
+
+def print_table(results):
+    """ Print the results as a table. """
+    row = "{0:20} {1:22} {2:>16} {3:>16} {4:>16} {5:>16} {6:>16}"
+    print(row.format("example", "arguments", "native (s)", "doping (s)",
+                     "compile (s)", "speedup", "w/o compile"))
+
+    def cell(metric):
+        return "{0:.3f} ±{1:.3f}".format(metric["mean"], metric["ci95"])
+    for result in results:
+        print(row.format(result["example"], result["arguments"] or "-",
+                         cell(result["native_seconds"]), cell(result["doping_seconds"]),
+                         cell(result["compile_seconds"]), cell(result["speedup"]),
+                         cell(result["speedup_without_compilation"])))
+
+
+def main():
+    """ Benchmark runner entry point. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("examples", nargs="*",
+                        help="Examples to run (default all): " + ", ".join(sorted(EXAMPLES)))
+    parser.add_argument("-n", "--repetitions", type=int, default=5,
+                        help="Runs of each binary and size (default 5)")
+    parser.add_argument("--sizes", action="append", default=[], metavar="EXAMPLE=ARGS",
+                        help="Program arguments of a run of the example, it can"
+                        " be repeated to sweep several sizes (replaces the"
+                        " default sizes of the example)")
+    parser.add_argument("--compiler", default=os.environ.get("CXX", "g++"),
+                        help="Compiler used for both versions (default $CXX or g++)")
+    parser.add_argument("--output", help="Write the results in this JSON file")
+    args = parser.parse_args()
+
+    if "DOPING_ROOT" not in os.environ:
+        print("Error: Environment variable DOPING_ROOT not defined!")
+        return 1
+
+    for example in args.examples:
+        if example not in EXAMPLES:
+            parser.error("unknown example " + example)
+    sizes = {}
+    for value in args.sizes:
+        example, _, arguments = value.partition("=")
+        if example not in EXAMPLES:
+            parser.error("unknown example in --sizes " + value)
+        sizes.setdefault(example, []).append(arguments)
+
+    results = []
+    for example in args.examples or sorted(EXAMPLES):
+        with tempfile.TemporaryDirectory(prefix="doping_benchmark_" + example) as directory:
+            native, doping = build(example, args.compiler, directory)
+            for arguments in sizes.get(example, EXAMPLES[example][2]):
+                print("Running {0} {1}".format(example, arguments), file=sys.stderr)
+                results.append(benchmark(example, arguments, native, doping,
+                                         args.repetitions, directory))
+    print_table(results)
+
+    if args.output:
+        with open(args.output, "w") as fobj:
+            json.dump({"compiler": args.compiler, "results": results}, fobj, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
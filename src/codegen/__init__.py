@@ -0,0 +1,3 @@
+""" Doping source-to-source transformation package """
+
+__version__ = "0.1"
@@ -2,7 +2,11 @@
 of certain node kinds"""
 
 import sys
-from clang.cindex import Cursor, CursorKind, TypeKind
+from bisect import bisect_left
+from itertools import chain
+from clang.cindex import Cursor, CursorKind, TypeKind, conf
+from codegen import profiling
+from codegen.ast.tokens import StreamToken
 
 BINARY_ARITHMETIC_OPERATORS = ("+", "-", "*", "/", "%")
 UNARY_ARITHMETIC_OPERATORS = ("++", "--")
@@ -12,69 +16,199 @@ BINARY_RELATIONAL_OPERATORS_LT = ("<", "<=")
 BINARY_LOGICAL_OPERATORS = ("&&", "||")
 
 
-class DopingCursor(Cursor):
+class DopingCursor():
     '''
-    Doping Cursor which inherits from Clang Cursors and extends it.
+    Doping view of a Clang Cursor that extends it. All the attributes of the
+    wrapped cursor can be accessed through the view.
+
+    The views are lightweight objects (they use __slots__) that are created
+    lazily when a node is reached, and the root keeps a single view for each
+    AST node, so they can be compared by identity and they memoize
+    information about the node (e.g. its parent and children).
     '''
 
-    # DopingCursors have a reference to its parent on the AST tree
-    _parent = None
-    _root = None
+    __slots__ = ("_cursor", "_root", "_parent", "_children", "_token_range",
+                 "_local_indexes")
 
     # IMPORTANT: All Cursor movements/traversals/references should
     # call the instantiate_node to remain inside Doping functionality
     # at the moment the traversal methods implemented are:
     #  -  get_children()
+    #  -  find_definition()
+
+    def __init__(self, cursor, root=None):
+        # Wrapped Clang Cursor
+        self._cursor = cursor
+        # DopingCursors have a reference to its parent on the AST tree
+        self._root = root
+        self._parent = None
+        # Children list, materialized the first time it is requested
+        self._children = None
+        # Positions of the node tokens in the TokenStream of the root (False
+        # if the node is not in the tokenized file)
+        self._token_range = None
+        # AstIndex of the subtree, for nodes not in the index of the root
+        self._local_indexes = None
 
     @staticmethod
-    def _instantiate_node(node):
-        if node.kind == CursorKind.FOR_STMT:
-            node.__class__ = ForCursor
-        elif node.kind == CursorKind.DECL_STMT:
-            node.__class__ = DeclarationCursor
-        elif node.kind == CursorKind.BINARY_OPERATOR:
-            node.__class__ = BinaryOperatorCursor
-        elif node.kind == CursorKind.CALL_EXPR:
-            node.__class__ = CallCursor
-        else:
-            node.__class__ = DopingCursor
-        return node
+    def _instantiate_node(node, root=None):
+        ''' Return a new view of the given Clang Cursor with the appropriate
+        DopingCursor sub-class. '''
+        kind = node.kind
+        if kind == CursorKind.FOR_STMT:
+            return ForCursor(node, root)
+        if kind == CursorKind.DECL_STMT:
+            return DeclarationCursor(node, root)
+        if kind == CursorKind.BINARY_OPERATOR:
+            return BinaryOperatorCursor(node, root)
+        if kind == CursorKind.CALL_EXPR:
+            return CallCursor(node, root)
+        return DopingCursor(node, root)
+
+    def __getattr__(self, name):
+        # Any other attribute is taken from the wrapped Clang Cursor (but
+        # not the special ones, e.g. its __dict__)
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def __eq__(self, other):
+        if isinstance(other, DopingCursor):
+            other = other._cursor
+        if not isinstance(other, Cursor):
+            return NotImplemented
+        return self._cursor == other
+
+    def __hash__(self):
+        return self._cursor.hash
+
+    # The most used Cursor attributes are forwarded explicitly, as it is
+    # faster than going through __getattr__.
+    @property
+    def cursor(self):
+        ''' Return the wrapped Clang Cursor '''
+        return self._cursor
+
+    @property
+    def kind(self):
+        ''' Return the CursorKind of the node '''
+        return self._cursor.kind
+
+    @property
+    def spelling(self):
+        ''' Return the spelling of the node '''
+        return self._cursor.spelling
+
+    @property
+    def displayname(self):
+        ''' Return the display name of the node '''
+        return self._cursor.displayname
+
+    @property
+    def location(self):
+        ''' Return the SourceLocation of the node '''
+        return self._cursor.location
+
+    @property
+    def extent(self):
+        ''' Return the SourceRange of the node '''
+        return self._cursor.extent
+
+    @property
+    def type(self):
+        ''' Return the Type of the node '''
+        return self._cursor.type
 
     def get_children(self):
         ''' Return the children nodes of this AST node.
 
-        Note: In addition to the libclang functionallity, this method dynamically
-        changes the node sub-class to the appropriate Doping sub-class. It also
+        Note: In addition to the libclang functionallity, this method returns
+        the children as views of the appropriate Doping sub-class. It also
         retrofits the parent information to the children nodes.
+
+        The children are only retrieved from libclang the first time, then
+        the same list (with the same node instances) is returned. The list
+        must not be modified.
         '''
-        # Retrofit the parent information into the children
-        children_list = []
-        for child in super().get_children():
-            DopingCursor._instantiate_node(child)
-            # pylint: disable=protected-access
-            child._parent = self
-            child._root = self.root
-            # pylint: enable=protected-access
-            children_list.append(child)
-        return children_list
+        if self._children is None:
+            root = self._root
+            children_list = []
+            for child in self._cursor.get_children():
+                if root is not None:
+                    child = root.cache_node(child)
+                else:
+                    child = DopingCursor._instantiate_node(child)
+                # pylint: disable=protected-access
+                if child._parent is None:
+                    child._parent = self
+                # pylint: enable=protected-access
+                children_list.append(child)
+            self._children = children_list
+        return self._children
 
     @property
     def root(self):
         ''' Return the root node of the AST '''
         return self._root
 
+    def is_from_header(self):
+        ''' Return whether the node is located in a header file. The
+        location is not cached in the Clang Cursor (as the location attribute
+        does), so checking it in all the nodes of an AST does not keep a
+        SourceLocation of each one. '''
+        location_file = conf.lib.clang_getCursorLocation(self._cursor).file
+        return location_file is not None and \
+            location_file.name.endswith(('.h', '.hpp', '.tcc'))
+
     def find_definition(self, exclude_headers=True):
-        node = super().get_definition()
+        node = self._cursor.get_definition()
         if node is not None:
             if exclude_headers and node.location.file.name != self.location.file.name:
                 return None
-            DopingCursor._instantiate_node(node)
-            # pylint: disable=protected-access
-            node._root = self.root
-            # pylint: enable=protected-access
-            return node
+            if self.root is not None:
+                return self.root.cache_node(node)
+            return DopingCursor._instantiate_node(node)
         return None
 
+    def _get_token_range(self):
+        if self._token_range is None:
+            self._token_range = False
+            stream = self.root.get_token_stream() if self.root is not None else None
+            if stream is not None:
+                extent = self.extent
+                if extent.start.file is not None and \
+                        extent.start.file.name == stream.filename:
+                    first, last = stream.find_range(extent.start.offset,
+                                                    extent.end.offset)
+                    self._token_range = (stream, first, last)
+        return self._token_range
+
+    def get_token_spellings(self):
+        ''' Return the list of spellings of the tokens of this node. The
+        tokens are taken from the TokenStream of the source file when it is
+        available, otherwise libclang tokenizes the node extent. '''
+        token_range = self._get_token_range()
+        if not token_range:
+            spellings = [token.spelling for token in self.get_tokens()]
+            profiling.count("tokens_fetched", len(spellings))
+            return spellings
+        stream, first, last = token_range
+        profiling.count("tokens_fetched", last - first)
+        return stream.spellings(first, last)
+
+    def get_stream_tokens(self):
+        ''' Return the list of tokens of this node as StreamTokens. '''
+        token_range = self._get_token_range()
+        if not token_range:
+            tokens = [StreamToken(token.kind, token.spelling, token.location.line,
+                                  token.location.column, token.location.offset)
+                      for token in self.get_tokens()]
+            profiling.count("tokens_fetched", len(tokens))
+            return tokens
+        stream, first, last = token_range
+        profiling.count("tokens_fetched", last - first)
+        return stream.tokens(first, last)
+
     def find_file_includes(self):
         # return filter(self.is_from_file, self.root.find_includes())
         # Clang implementation above does not work! FIX! Meanwhile ugly
@@ -126,21 +260,19 @@ class DopingCursor(Cursor):
         string = ""
         line = self.location.line
 
-        # Sometimes get_tokens() does not return the expected tokens. This
-        # may be a BUG in libclang.
-        tokens = self.get_tokens()
+        tokens = self.get_stream_tokens()
         if len(tokens) <= 0:
             print("Probably a get_tokens error! Stopping")
             sys.exit(-1)
 
         # We need to join the tokens using ' ' and '\n' appropriately.
         for token in tokens:
-            while token.location.line > line:
+            while token.line > line:
                 if string[-1] == " ":
                     string = string[:-1]
-                for _ in range(line, token.location.line):
+                for _ in range(line, token.line):
                     string = string + "\n"
-                line = token.location.line
+                line = token.line
             if referencing_variables and token.spelling in referencing_variables:
                 # If a list of referencing variables is given and this token
                 # matches one of them, add the * prefix.
@@ -198,35 +330,35 @@ class DopingCursor(Cursor):
     # find_* Generators
     #######################################
 
+    def _index(self, exclude_headers=True):
+        ''' Return the AstIndex that contains this node and the position of
+        the node in it. The index of the whole AST is shared by all the
+        nodes, nodes that are not part of it (e.g. inside a header) get an
+        index of their own subtree. '''
+        root = self.root
+        if root is not None:
+            index = root.get_index(exclude_headers)
+            position = index.position(self)
+            if position is not None:
+                return index, position
+        if self._local_indexes is None:
+            self._local_indexes = {}
+        index = self._local_indexes.get(exclude_headers)
+        if index is None:
+            with profiling.span("AstIndex", "detail", local=True):
+                index = AstIndex(self, exclude_headers)
+            self._local_indexes[exclude_headers] = index
+        # It is None if this node is excluded (it is inside a header)
+        return index, index.position(self)
+
     def _find(self, searchtype, outermostonly=False, exclude_headers=True,  displayname=False):
 
         # Search type must be a tuple to allow multiple search types
         if not isinstance(searchtype, tuple):
             searchtype = (searchtype,)
 
-        if exclude_headers:
-            if self.location.file is not None:
-                if self.location.file.name.endswith(('.h', '.hpp', '.tcc')):
-                    return  # Does not yield anything
-
-        # Found a node if searchtype, or searchtype is empty(we want all)
-        found = False
-        if self.kind in searchtype or not searchtype:
-            if not displayname or displayname == self.displayname:
-                found = True
-                yield self
-
-        # If it needs to continue searching recurse down into the children
-        if not found or not outermostonly:
-            if self.kind == CursorKind.CALL_EXPR:
-                # [1:] to Remove name node of function calls
-                for child in self.get_children()[1:]:
-                    for match in child._find(searchtype, outermostonly, exclude_headers,  displayname):
-                        yield match
-            else:
-                for child in self.get_children():
-                    for match in child._find(searchtype, outermostonly, exclude_headers,  displayname):
-                        yield match
+        index, position = self._index(exclude_headers)
+        return index.find(position, searchtype, outermostonly, displayname)
 
     def find_loops(self, outermostonly=False, exclude_headers=True):
         ''' Find For Statements nodes '''
@@ -285,36 +417,212 @@ class DopingCursor(Cursor):
         ''' Get the string representing this node by using the extents
         to cut the original source code. '''
 
-        start = self.extent.start.line - 1  # 1 to 0-indexing
-        end = self.extent.end.line - 1  # 1 to 0-indexing
-        block = self.root.source_code.split('\n')[start:end + 1]
+        extent = self.extent
+        start = extent.start.line - 1  # 1 to 0-indexing
+        end = extent.end.line - 1  # 1 to 0-indexing
+        col_start = extent.start.column - 1  # 1 to 0-indexing
+        col_end = extent.end.column - 1  # 1 to 0-indexing
+        source = self.root.source_code
+        start_offset = self.root.line_offset(start)
+
+        # The slices are limited to the length of each line, as if the
+        # lines were cut separately. Note that in single line nodes the
+        # end column is counted from the start column.
+        first = min(start_offset + col_start, self.root.line_end_offset(start))
+        if start == end:
+            last = first + col_end + 1
+        else:
+            last = self.root.line_offset(end) + col_end + 1
+        last = min(last, self.root.line_end_offset(end))
+        return source[first:last]
+
 
-        col_start = self.extent.start.column - 1  # 1 to 0-indexing
-        block[0] = block[0][col_start:]
-        col_end = self.extent.end.column - 1  # 1 to 0-indexing
-        block[-1] = block[-1][:col_end + 1]
+class AstIndex():
+    '''
+    Index of the nodes of an AST subtree built in a single traversal, so
+    the find_* queries become lookups instead of traversals.
+
+    The nodes are stored in preorder, so the subtree of a node is the
+    interval between its position and the position where its subtree ends.
+    The nodes are also bucketed by kind (and by displayname the first time
+    it is needed) keeping their preorder. The traversal follows the same
+    rules as the find_* methods: nodes from header files (and their
+    subtrees) are excluded if exclude_headers is True, and the name node of
+    function calls is skipped.
+    '''
 
-        return '\n'.join(block)
+    def __init__(self, node, exclude_headers=True):
+        self._nodes = []
+        self._ends = []
+        self._positions = {}
+        self._kinds = {}
+        self._names = None
+
+        # Iterative preorder traversal, the end of a subtree is recorded
+        # when the traversal gets back to its node.
+        visits = 0
+        stack = [(node, False)]
+        while stack:
+            current, visited = stack.pop()
+            if visited:
+                self._ends[self._positions[id(current)]] = len(self._nodes)
+                continue
+            visits += 1
+            if exclude_headers and current.is_from_header():
+                continue
+            self._positions[id(current)] = len(self._nodes)
+            self._nodes.append(current)
+            self._ends.append(None)
+            self._kinds.setdefault(current.kind, []).append(len(self._nodes) - 1)
+            stack.append((current, True))
+            children = current.get_children()
+            if current.kind == CursorKind.CALL_EXPR:
+                # [1:] to Remove name node of function calls
+                children = children[1:]
+            stack.extend((child, False) for child in reversed(children))
+        profiling.count("nodes_visited", visits)
+
+    def position(self, node):
+        ''' Return the preorder position of the node or None if it is not
+        part of the index. '''
+        return self._positions.get(id(node))
+
+    def _bucket(self, displayname):
+        if self._names is None:
+            self._names = {}
+            for position, node in enumerate(self._nodes):
+                self._names.setdefault(node.displayname, []).append(position)
+        return self._names.get(displayname, [])
+
+    def find(self, position, searchtype, outermostonly=False, displayname=False):
+        ''' Return a generator with the nodes in the subtree of the node at
+        the given position that have one of the searchtype kinds (or any
+        kind if searchtype is empty) and the given displayname (if any), in
+        preorder. If outermostonly is True, the subtrees of the found nodes
+        are not searched. If the position is None (the node is not part of
+        the index) nothing is found. '''
+        if position is None:
+            return iter(())
+        start, end = position, self._ends[position]
+        if searchtype:
+            buckets = [self._kinds.get(kind, []) for kind in set(searchtype)]
+        elif displayname:
+            buckets = [self._bucket(displayname)]
+        else:
+            buckets = [range(start, end)]
+        # Select the positions of each bucket that are inside the subtree
+        buckets = [bucket[bisect_left(bucket, start):bisect_left(bucket, end)]
+                   for bucket in buckets]
+        positions = buckets[0] if len(buckets) == 1 else sorted(chain(*buckets))
+        return self._generate(positions, outermostonly, displayname)
+
+    def _generate(self, positions, outermostonly, displayname):
+        skip_until = 0
+        for position in positions:
+            if position < skip_until:
+                continue
+            node = self._nodes[position]
+            if not displayname or displayname == node.displayname:
+                if outermostonly:
+                    skip_until = self._ends[position]
+                yield node
 
 
 class DopingRootCursor (DopingCursor):
     ''' Special Cursor for the AST Root node '''
 
-    _source_code = None
-
-    @property
-    def _root(self):
-        return self
+    __slots__ = ("_source_code", "_nodes", "_indexes", "_offsets",
+                 "_translation_unit")
+
+    def __init__(self, cursor, source_code=None, translation_unit=None):
+        super().__init__(cursor)
+        self._root = self
+        self._source_code = source_code
+        # Unique DopingCursor instance of each node of the AST
+        self._nodes = None
+        # AstIndex of the whole AST (with and without header files)
+        self._indexes = None
+        # Offset of the start of each line in the source code
+        self._offsets = None
+        # DopingTranslationUnit that created this root
+        self._translation_unit = translation_unit
+
+    def get_token_stream(self):
+        ''' Return the TokenStream of the source file or None if it is not
+        available. '''
+        if self._translation_unit is None:
+            return None
+        return self._translation_unit.get_token_stream()
+
+    def get_index(self, exclude_headers=True):
+        ''' Return the AstIndex of the whole AST, it is only built the
+        first time it is needed. '''
+        if self._indexes is None:
+            self._indexes = {}
+        if exclude_headers not in self._indexes:
+            with profiling.span("AstIndex", "detail", local=False):
+                self._indexes[exclude_headers] = AstIndex(self, exclude_headers)
+        return self._indexes[exclude_headers]
+
+    def cache_node(self, node):
+        ''' Return the DopingCursor instance that represents the same AST
+        node as the given clang cursor (or DopingCursor). The first time a
+        node is seen a view of the appropriate DopingCursor sub-class is
+        created and becomes the instance returned for that node. The views
+        are interned by the libclang cursor hash (and equality). '''
+        # pylint: disable=protected-access
+        if isinstance(node, DopingCursor):
+            if node._root is self:
+                return node
+            node = node._cursor
+        # pylint: enable=protected-access
+        if self._nodes is None:
+            self._nodes = {}
+        cached = self._nodes.get(node)
+        if cached is None:
+            cached = DopingCursor._instantiate_node(node, self)
+            self._nodes[node] = cached
+        return cached
 
     @property
     def source_code(self):
         ''' Return the original source code represented by this AST '''
         return self._source_code
 
+    def _line_offsets(self):
+        # Offset of the start of each line in the source code, computed
+        # the first time it is needed.
+        if self._offsets is None:
+            offsets = [0]
+            position = self._source_code.find('\n')
+            while position != -1:
+                offsets.append(position + 1)
+                position = self._source_code.find('\n', position + 1)
+            self._offsets = offsets
+        return self._offsets
+
+    def line_offset(self, line):
+        ''' Return the offset in the source code where the given line
+        (0-indexed) starts. '''
+        offsets = self._line_offsets()
+        if line >= len(offsets):
+            return len(self._source_code)
+        return offsets[line]
+
+    def line_end_offset(self, line):
+        ''' Return the offset in the source code where the given line
+        (0-indexed) ends, without its new line character. '''
+        offsets = self._line_offsets()
+        if line + 1 >= len(offsets):
+            return len(self._source_code)
+        return offsets[line + 1] - 1
+
 
 class CallCursor (DopingCursor):
     ''' Subclass for Function call nodes '''
 
+    __slots__ = ()
+
     def get_declaration(self):
         ''' Get the function declaration '''
         definition = self.get_definition()
@@ -328,10 +636,13 @@ class BinaryOperatorCursor (DopingCursor):
     '''
     Subclass for AST nodes that containt a BinaryOperator.
     '''
+
+    __slots__ = ()
+
     def operator(self):
         ''' Return the operator token. '''
-        lhs_len = len(list(self.get_children()[0].get_tokens()))
-        tokens = [x.spelling for x in self.get_tokens()]
+        lhs_len = len(self.get_children()[0].get_token_spellings())
+        tokens = self.get_token_spellings()
         # No Operator or RHS found
         if lhs_len >= len(tokens):
             return None
@@ -346,9 +657,12 @@ class DeclarationCursor (DopingCursor):
     [modifiers] type id;
     [modifiers] type id = value;
     '''
+
+    __slots__ = ()
+
     def get_type_id_string(self):
         ''' Returns a tuple with the type and the id of this declaration. '''
-        tokens = [x.spelling for x in self.get_tokens()]
+        tokens = self.get_token_spellings()
 
         if tokens.count("=") == 1:
             # Initialization declaration
@@ -374,6 +688,8 @@ class ForCursor (DopingCursor):
     FIXME: This is to restrictive, there are more For loop syntaxes now.
     '''
 
+    __slots__ = ()
+
     # Should this be Attributes?
     def get_initialization(self):
         ''' Get For Initialization child node. '''
@@ -394,20 +710,20 @@ class ForCursor (DopingCursor):
     def initialization_string(self):
         ''' Get For Initialization string. '''
         init = self.get_initialization()
-        # BUG: libclang get_tokens returns one more token than needed
-        tokens = [x.spelling for x in init.get_tokens() if x.spelling != ";"]
+        # The declaration statements include the ';'
+        tokens = [x for x in init.get_token_spellings() if x != ";"]
         return " ".join(tokens)
 
     def end_condition_string(self):
         ''' Get For Condition string. '''
         cond = self.get_end_condition()
-        tokens = [x.spelling for x in cond.get_tokens() if x.spelling != ";"]
+        tokens = [x for x in cond.get_token_spellings() if x != ";"]
         return " ".join(tokens)
 
     def increment_string(self):
         ''' Get For Increment string. '''
         incr = self.get_increment()
-        tokens = [x.spelling for x in incr.get_tokens()]
+        tokens = incr.get_token_spellings()
         return " ".join(tokens)
 
     def body_string(self, referencing_variables=None):
@@ -430,7 +746,7 @@ class ForCursor (DopingCursor):
 
     def cond_variable(self):
         ''' Return the variable used in this For Loop as iterator. '''
-        tokens = [x.spelling for x in self.get_initialization().get_tokens()]
+        tokens = self.get_initialization().get_token_spellings()
         if tokens.count(",") > 1:
             raise NotImplementedError(
                 "Multiple initialization for loops not implemented yet."
@@ -443,7 +759,7 @@ class ForCursor (DopingCursor):
 
     def cond_starting_value(self):
         ''' Return the For iteration starting expression '''
-        tokens = [x.spelling for x in self.get_initialization().get_tokens()]
+        tokens = self.get_initialization().get_token_spellings()
 
         if tokens.count("=") == 1:
             eqindex = tokens.index("=")
@@ -459,7 +775,7 @@ class ForCursor (DopingCursor):
         # and without any typedef or other alias
         # There is more "unsigned" that we don't capture and long types, ...
         # but for now returning int is relatively safe
-        tokens = [x.spelling for x in self.get_initialization().get_tokens()]
+        tokens = self.get_initialization().get_token_spellings()
         if tokens[0] == "unsigned":
             return "unsigned"
         return "int"
@@ -468,7 +784,7 @@ class ForCursor (DopingCursor):
         ''' Return the For iteration end expression. '''
 
         # FIXME: Probably it just work with positive numbers
-        tokens = [x.spelling for x in self.get_end_condition().get_tokens()]
+        tokens = self.get_end_condition().get_token_spellings()
 
         try:
             endindex = tokens.index(";")
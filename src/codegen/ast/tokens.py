@@ -0,0 +1,80 @@
+""" Cache of the tokens of a source file, so the cursors don't need to ask
+libclang to tokenize their extents every time they need their tokens. """
+
+import os
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from clang.cindex import SourceLocation, SourceRange, TokenKind
+
+# Token of a TokenStream: its TokenKind, spelling and the line, column and
+# offset where it starts.
+StreamToken = namedtuple("StreamToken", ["kind", "spelling", "line", "column", "offset"])
+
+
+class TokenStream():
+    '''
+    All the tokens of a source file, obtained from libclang in a single
+    tokenization and stored in arrays (one per token attribute) with the
+    spellings interned in a table.
+
+    The tokens of an AST node are the ones that start inside its extent, as
+    the tokens are sorted, they are found with a binary search of the start
+    and end offsets of the extent.
+    '''
+
+    def __init__(self, clang_tu, filename):
+        self._filename = filename
+        self._kinds = array('b')
+        self._spelling_ids = array('l')
+        self._lines = array('l')
+        self._columns = array('l')
+        self._offsets = array('l')
+        self._spellings = []
+        spelling_ids = {}
+
+        source_file = clang_tu.get_file(filename)
+        extent = SourceRange.from_locations(
+            SourceLocation.from_offset(clang_tu, source_file, 0),
+            SourceLocation.from_offset(clang_tu, source_file, os.path.getsize(filename)))
+        for token in clang_tu.get_tokens(extent=extent):
+            spelling = token.spelling
+            spelling_id = spelling_ids.get(spelling)
+            if spelling_id is None:
+                spelling_id = len(self._spellings)
+                spelling_ids[spelling] = spelling_id
+                self._spellings.append(spelling)
+            location = token.location
+            self._kinds.append(token.kind.value)
+            self._spelling_ids.append(spelling_id)
+            self._lines.append(location.line)
+            self._columns.append(location.column)
+            self._offsets.append(location.offset)
+
+    @property
+    def filename(self):
+        ''' Return the name of the tokenized file. '''
+        return self._filename
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def find_range(self, start_offset, end_offset):
+        ''' Return the positions of the first token starting at or after
+        start_offset and the first token starting at or after end_offset. '''
+        return (bisect_left(self._offsets, start_offset),
+                bisect_left(self._offsets, end_offset))
+
+    def spellings(self, first, last):
+        ''' Return the spellings of the tokens between the given positions
+        (last not included). '''
+        table = self._spellings
+        return [table[spelling_id] for spelling_id in self._spelling_ids[first:last]]
+
+    def tokens(self, first, last):
+        ''' Return the StreamTokens between the given positions (last not
+        included). '''
+        return [StreamToken(TokenKind.from_value(self._kinds[i]),
+                            self._spellings[self._spelling_ids[i]],
+                            self._lines[i], self._columns[i], self._offsets[i])
+                for i in range(first, last)]
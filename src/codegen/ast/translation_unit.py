@@ -2,17 +2,69 @@
 
 
 import os
-from clang.cindex import Index
+import re
+import tempfile
+from clang.cindex import Index, TranslationUnit, TranslationUnitLoadError, \
+    TranslationUnitSaveError, conf
+from codegen import profiling
 from codegen.ast.cursors import DopingRootCursor
+from codegen.ast.tokens import TokenStream
+from codegen.cache import PreambleCache
+
+# libclang Index shared by all the translation units of the process
+_INDEX = None
+
+# Lines that can be part of a preamble: system includes, blank lines and
+# single line comments.
+_PREAMBLE_INCLUDE = re.compile(r"^\s*#\s*include\s*<[^>]*>\s*$")
+_PREAMBLE_SKIP = re.compile(r"^\s*(//.*|/\*.*\*/\s*)?$")
+
+
+def get_index():
+    ''' Return the libclang Index shared by all the translation units, it
+    is created the first time it is needed. '''
+    global _INDEX  # pylint: disable=global-statement
+    if _INDEX is None:
+        _INDEX = Index.create()
+    return _INDEX
+
+
+def get_preamble(source_code):
+    ''' Return the system includes at the beginning of the given source
+    code (before any other statement), which can be precompiled without
+    changing the meaning of the source. '''
+    includes = []
+    for line in source_code.splitlines():
+        if _PREAMBLE_INCLUDE.match(line):
+            includes.append(line.strip() + "\n")
+        elif not _PREAMBLE_SKIP.match(line):
+            break
+    return "".join(includes)
+
+
+def _parser_identifier():
+    ''' Return a string that identifies the libclang library in use. '''
+    library = conf.get_filename()
+    try:
+        stat = os.stat(library)
+        return "{0} {1} {2}".format(library, stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return library
 
 
 class DopingTranslationUnit():
     '''
     This class encapsulates Clang Translation unit functionality.
     When the class is instantiated, it already parsed the provided file.
+
+    :param str filename: Path of the C/C++ source file.
+    :param str compiler_command: Compiler command whose flags are used.
+    :param preamble_cache: PreambleCache used to load the preamble system
+        headers, True (the default) uses one in its default directory and
+        None parses the whole file without precompiled headers.
     '''
 
-    def __init__(self, filename, compiler_command=None):
+    def __init__(self, filename, compiler_command=None, preamble_cache=True):
         if not os.path.isfile(filename):
             raise FileNotFoundError("{0} does not exist".format(filename))
         extension = os.path.splitext(filename)[1]
@@ -31,19 +83,79 @@ class DopingTranslationUnit():
                 [x for x in compiler_command.split() if x.startswith("-")]
 
         self._filename = filename
-        index = Index.create()
         # We need to filter the flags because some may be intended for a different
         # compiler and are not standard
         parse_flags = [flag for flag in self._flags if flag.startswith("-D")]
-        self._clang_tu = index.parse(filename, args=parse_flags)
+        self._preamble_includes = []
+        if preamble_cache is True:
+            preamble_cache = PreambleCache()
+        self._clang_tu = self._parse(parse_flags, extension, preamble_cache)
+        self._root = None
+        self._token_stream = None
 
-    def get_root(self):
-        ''' Returns the DopingCursor that represents the AST root node. '''
-        root = self._clang_tu.cursor
-        root.__class__ = DopingRootCursor
+    def _parse(self, parse_flags, extension, cache):
+        ''' Parse the file with the shared Index. The system headers of its
+        preamble are loaded from a precompiled header of the given
+        PreambleCache (which is built the first time they are used), if
+        there is no cache or this is not possible the whole file is
+        parsed. '''
+        index = get_index()
+        if cache is None:
+            return index.parse(self._filename, args=parse_flags)
         with open(self._filename, "r") as source:
-            root._source_code = source.read()
-        return root
+            preamble = get_preamble(source.read())
+        if not preamble:
+            return index.parse(self._filename, args=parse_flags)
+
+        language = "c-header" if extension == ".c" else "c++-header"
+        header_flags = ["-x", language] + parse_flags
+        with tempfile.TemporaryDirectory(prefix="doping") as tmpdir:
+            try:
+                key = cache.key(preamble, header_flags, _parser_identifier())
+                entry = cache.lookup(key)
+                if entry is None:
+                    with profiling.span("precompile preamble", "detail"):
+                        header_tu = index.parse(
+                            cache.header(key, preamble), args=header_flags,
+                            options=TranslationUnit.PARSE_INCOMPLETE)
+                        precompiled = os.path.join(tmpdir, "preamble.pch")
+                        header_tu.save(precompiled)
+                        includes = sorted({inclusion.include.name
+                                           for inclusion in header_tu.get_includes()})
+                        cache.store(key, precompiled, includes)
+                    entry = (precompiled, includes)
+                precompiled, self._preamble_includes = entry
+                return index.parse(self._filename,
+                                   args=parse_flags + ["-include-pch", precompiled])
+            except (OSError, TranslationUnitLoadError, TranslationUnitSaveError):
+                self._preamble_includes = []
+                return index.parse(self._filename, args=parse_flags)
+
+    def get_root(self):
+        ''' Returns the DopingCursor that represents the AST root node. The
+        same root (and therefore the same cache of AST nodes) is returned in
+        all the calls. '''
+        if self._root is None:
+            with open(self._filename, "r") as source:
+                self._root = DopingRootCursor(self._clang_tu.cursor, source.read(), self)
+        return self._root
+
+    def get_token_stream(self):
+        ''' Returns the TokenStream with all the tokens of the source file,
+        it is only tokenized the first time. '''
+        if self._token_stream is None:
+            self._token_stream = TokenStream(self._clang_tu, self._filename)
+        return self._token_stream
+
+    def get_includes(self):
+        ''' Return the paths of all the files transitively included by the
+        source file. '''
+        includes = {inclusion.include.name
+                    for inclusion in self._clang_tu.get_includes()}
+        # The headers loaded from the precompiled preamble are not reported
+        # by the translation unit.
+        includes.update(self._preamble_includes)
+        return sorted(includes)
 
     def get_flags(self):
         ''' Return arguments used by Clang to parse the source file. '''
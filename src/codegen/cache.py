@@ -0,0 +1,372 @@
+""" This module provides a persistent cache of the files generated by the
+Doping source-to-source transformations """
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import functools
+from codegen import __version__
+
+# Default maximum size of the cache (in bytes)
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+def hash_file(filename):
+    ''' Return the hexadecimal SHA-256 digest of the given file contents. '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def runtime_header():
+    ''' Return the path of the Doping runtime header included by the
+    generated code: $DOPING_ROOT/bin/doping.h, or the runtime source header
+    if it has not been built. '''
+    if 'DOPING_ROOT' in os.environ:
+        header = os.path.join(os.environ['DOPING_ROOT'], 'bin', 'doping.h')
+        if os.path.isfile(header):
+            return header
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         os.pardir, 'runtime', 'include',
+                                         'dopingRuntime.h'))
+
+
+@functools.lru_cache(maxsize=None)
+def generator_digest():
+    ''' Return a digest of the code generator (the codegen package sources)
+    and of the runtime header, so the cached files are not restored when
+    the generated code or the layout of the runtime structures change
+    without a new version. '''
+    digest = hashlib.sha256()
+    package = os.path.dirname(os.path.abspath(__file__))
+    sources = []
+    for directory, subdirectories, files in os.walk(package):
+        subdirectories[:] = sorted(x for x in subdirectories
+                                   if x not in ('test', '__pycache__'))
+        sources.extend(os.path.join(directory, x) for x in files if x.endswith('.py'))
+    for filename in sorted(sources) + [runtime_header()]:
+        digest.update((os.path.relpath(filename, package) + "\n").encode())
+        if os.path.isfile(filename):
+            digest.update(hash_file(filename).encode())
+    return digest.hexdigest()
+
+
+class TransformationCache:
+    '''
+    This class implements a content-addressed on-disk cache of transformed
+    source files. Each entry is identified by a key computed from the
+    original source text, the compiler command used to parse (and later
+    re-compile) it, the transformation options and the Doping version.
+
+    Entries also record the files transitively included by the source, as
+    reported by the libclang translation unit, with their contents hash. An
+    entry is only restored if none of these dependencies has changed, this
+    avoids having to parse the file to know its includes before looking up
+    the cache.
+
+    The cache has a maximum size, when it is exceeded the least recently
+    used entries are evicted. Entries are published atomically, so
+    multiple dope invocations (e.g. from a parallel build) can share the
+    same cache directory.
+    '''
+
+    _NAME = "transformation"
+    _MANIFEST = "manifest.json"
+    _OUTPUT = "output"
+    _STATS = "stats.json"
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = self.default_directory()
+        self._directory = directory
+        self._max_size = max_size
+
+    @staticmethod
+    def default_directory():
+        ''' Return the default cache location. This is the 'transformations'
+        sub-directory of DOPING_CACHE_DIR if the environment variable is
+        defined, otherwise it is located in the user cache directory. '''
+        root = os.environ.get('DOPING_CACHE_DIR')
+        if not root:
+            root = os.path.join(os.path.expanduser('~'), '.cache', 'doping')
+        return os.path.join(root, 'transformations')
+
+    @property
+    def directory(self):
+        ''' Return the cache directory. '''
+        return self._directory
+
+    @staticmethod
+    def key(sourcefile, compiler_command="", options=None):
+        '''
+        Return the key that identifies the transformation of the given file.
+
+        :param str sourcefile: Path to the original source file.
+        :param str compiler_command: Compiler command used to parse the file
+            and embedded in the generated code.
+        :param dict options: Other options that modify the transformation
+            output (e.g. dose and optimization).
+
+        The key also depends on the Doping version and on the code generator
+        and runtime header (see generator_digest).
+        '''
+        digest = hashlib.sha256()
+        digest.update(("Doping " + __version__ + "\n").encode())
+        digest.update(generator_digest().encode())
+        # The generated code references the original file by its absolute path
+        digest.update((os.path.abspath(sourcefile) + "\n").encode())
+        digest.update(hash_file(sourcefile).encode())
+        # The preprocessor definitions are the flags used by the parser, but
+        # the whole command is also embedded in the generated code.
+        defines = [x for x in compiler_command.split() if x.startswith("-D")]
+        digest.update(json.dumps(defines).encode())
+        digest.update(compiler_command.encode())
+        digest.update(json.dumps(options or {}, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._directory, key[:2], key)
+
+    def restore(self, key, outputfile):
+        '''
+        Copy the cached output of the given key into outputfile.
+
+        :param str key: Entry key as returned by key().
+        :param str outputfile: Where to restore the cached file.
+        :returns: True if the entry was found and is valid, False otherwise.
+        '''
+        entry = self._entry_path(key)
+        try:
+            with open(os.path.join(entry, self._MANIFEST), 'r') as fobj:
+                manifest = json.load(fobj)
+            if not self._dependencies_unchanged(manifest['dependencies']):
+                self._update_stats(misses=1)
+                return False
+            shutil.copyfile(os.path.join(entry, self._OUTPUT), outputfile)
+            # Mark the entry as recently used
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            self._update_stats(misses=1)
+            return False
+        self._update_stats(hits=1)
+        return True
+
+    def store(self, key, outputfile, dependencies=()):
+        '''
+        Add outputfile into the cache with the given key.
+
+        :param str key: Entry key as returned by key().
+        :param str outputfile: Path to the generated file to cache.
+        :param dependencies: Files included by the original source file.
+        '''
+        manifest = {'dependencies': {}}
+        for dependency in dependencies:
+            try:
+                stat = os.stat(dependency)
+                manifest['dependencies'][dependency] = [
+                    stat.st_size, stat.st_mtime_ns, hash_file(dependency)]
+            except OSError:
+                # A dependency that we can not read can not be validated later
+                return
+
+        os.makedirs(os.path.dirname(self._entry_path(key)), exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix=".tmp", dir=self._directory)
+        try:
+            shutil.copyfile(outputfile, os.path.join(tmpdir, self._OUTPUT))
+            with open(os.path.join(tmpdir, self._MANIFEST), 'w') as fobj:
+                json.dump(manifest, fobj)
+            entry = self._entry_path(key)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmpdir, entry)
+        except OSError:
+            # Another process may have published the same entry meanwhile
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self._evict()
+
+    @staticmethod
+    def _dependencies_unchanged(dependencies):
+        for dependency, (size, mtime, digest) in dependencies.items():
+            stat = os.stat(dependency)
+            if stat.st_size != size:
+                return False
+            # Only re-hash the file if the timestamp is not the same
+            if stat.st_mtime_ns != mtime and hash_file(dependency) != digest:
+                return False
+        return True
+
+    def _entries(self):
+        ''' Return a list of (last_use, size, path) for each cache entry. '''
+        entries = []
+        if not os.path.isdir(self._directory):
+            return entries
+        for prefix in os.listdir(self._directory):
+            prefix_path = os.path.join(self._directory, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                entry = os.path.join(prefix_path, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, x))
+                               for x in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+        return entries
+
+    def _evict(self):
+        ''' Remove the least recently used entries until the cache size is
+        under the maximum size. '''
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, entry in entries:
+            if total <= self._max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            evicted += 1
+        if evicted:
+            self._update_stats(evictions=evicted)
+
+    def _update_stats(self, **counters):
+        os.makedirs(self._directory, exist_ok=True)
+        statsfile = os.path.join(self._directory, self._STATS)
+        # The stats file is shared by concurrent dope invocations
+        with open(statsfile, 'a+') as fobj:
+            fcntl.flock(fobj, fcntl.LOCK_EX)
+            fobj.seek(0)
+            try:
+                stats = json.load(fobj)
+            except ValueError:
+                stats = {}
+            for counter, value in counters.items():
+                stats[counter] = stats.get(counter, 0) + value
+            stats['last_update'] = time.time()
+            fobj.seek(0)
+            fobj.truncate()
+            json.dump(stats, fobj)
+
+    def stats(self):
+        ''' Return a dictionary with the cache statistics. '''
+        stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            with open(os.path.join(self._directory, self._STATS), 'r') as fobj:
+                stats.update(json.load(fobj))
+        except (OSError, ValueError):
+            pass
+        entries = self._entries()
+        stats['entries'] = len(entries)
+        stats['size'] = sum(size for _, size, _ in entries)
+        stats['max_size'] = self._max_size
+        stats['directory'] = self._directory
+        return stats
+
+    def print_stats(self):
+        ''' Print a report of the cache statistics. '''
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        ratio = 100.0 * stats['hits'] / lookups if lookups else 0.0
+        print("Doping " + self._NAME + " cache: " + stats['directory'])
+        print("    Entries:   " + str(stats['entries']))
+        print("    Size:      {0:.1f} / {1:.1f} MB".format(
+            stats['size'] / 2**20, stats['max_size'] / 2**20))
+        print("    Hits:      {0} ({1:.1f} %)".format(stats['hits'], ratio))
+        print("    Misses:    " + str(stats['misses']))
+        print("    Evictions: " + str(stats['evictions']))
+
+
+class PreambleCache(TransformationCache):
+    '''
+    On-disk cache of precompiled headers (PCH) with the system headers
+    included at the beginning of the source files (their preamble). The
+    preambles are shared by all the files and dope invocations that include
+    the same headers with the same parser flags, so the headers do not need
+    to be parsed again for each translation unit.
+
+    The entries are managed as in the TransformationCache, their
+    dependencies are the headers included by the preamble, and they can be
+    used in place by the parser (without copying them). The parser also
+    checks that the header from which the PCH was built has not changed,
+    so the preamble headers are kept in the '.headers' sub-directory.
+    '''
+
+    _NAME = "preamble"
+    _HEADERS = ".headers"
+
+    @staticmethod
+    def default_directory():
+        ''' Return the default cache location. This is the 'preambles'
+        sub-directory of DOPING_CACHE_DIR if the environment variable is
+        defined, otherwise it is located in the user cache directory. '''
+        return os.path.join(
+            os.path.dirname(TransformationCache.default_directory()), 'preambles')
+
+    @staticmethod
+    def key(preamble, parser_args=(), parser=""):
+        '''
+        Return the key that identifies the precompiled preamble.
+
+        :param str preamble: Source code of the preamble.
+        :param parser_args: Arguments used to parse the preamble.
+        :param str parser: Identifier of the parser (libclang) version, the
+            PCH files can not be read by other versions.
+        '''
+        digest = hashlib.sha256()
+        digest.update(("Doping " + __version__ + "\n").encode())
+        digest.update((parser + "\n").encode())
+        digest.update(json.dumps(list(parser_args)).encode())
+        digest.update(preamble.encode())
+        return digest.hexdigest()
+
+    def header(self, key, preamble):
+        '''
+        Return the path of a header file with the given preamble. It is only
+        written if it does not exist, so it keeps the same timestamp while
+        the PCH files built from it are used.
+
+        :param str key: Entry key as returned by key().
+        :param str preamble: Source code of the preamble.
+        '''
+        directory = os.path.join(self._directory, self._HEADERS)
+        header = os.path.join(directory, key + ".h")
+        try:
+            with open(header, 'r') as fobj:
+                if fobj.read() == preamble:
+                    return header
+        except OSError:
+            pass
+        os.makedirs(directory, exist_ok=True)
+        fdesc, tmpfile = tempfile.mkstemp(prefix=".tmp", dir=directory)
+        with os.fdopen(fdesc, 'w') as fobj:
+            fobj.write(preamble)
+        os.replace(tmpfile, header)
+        return header
+
+    def lookup(self, key):
+        '''
+        Return the path of the cached file with the given key and the list
+        of its dependencies, or None if the entry is not found or any of its
+        dependencies has changed.
+
+        :param str key: Entry key as returned by key().
+        '''
+        entry = self._entry_path(key)
+        try:
+            with open(os.path.join(entry, self._MANIFEST), 'r') as fobj:
+                manifest = json.load(fobj)
+            if not self._dependencies_unchanged(manifest['dependencies']):
+                self._update_stats(misses=1)
+                return None
+            os.utime(entry)
+        except (OSError, ValueError, KeyError):
+            self._update_stats(misses=1)
+            return None
+        self._update_stats(hits=1)
+        return os.path.join(entry, self._OUTPUT), sorted(manifest['dependencies'])
@@ -0,0 +1,118 @@
+""" This module reads the runtime traces of a recorded execution, so the
+transformations only inject Doping in the loops that benefit from it (see
+the dope --profile-use option) """
+
+import json
+
+# Counters and times of each loop in the runtime trace that are accumulated
+# when several traces are given (e.g. one per MPI rank)
+FIELDS = ["entries", "executions", "iterations", "specialized_runs",
+          "specialized_iterations", "specialized_time", "sampled_iterations",
+          "sampled_time", "render_time", "compile_time", "dlopen_time"]
+
+# Minimum fraction of the execution time spent in a loop to consider it hot
+DEFAULT_HOT_FRACTION = 0.01
+
+
+class LoopProfile:
+    '''
+    This class holds what the runtime recorded about each loop in previous
+    executions, as written in the runtime trace (DOPING_TRACE) when the
+    application runs with DOPING_POLICY=record. With this policy the
+    runtime times some baseline iterations of each loop before specializing
+    it, so the time of the loop without Doping can be estimated and compared
+    with the time of the specialization and its compilation.
+
+    Loops are identified by their name, which is their location in the
+    source files as given to the compiler command, so the application must
+    be built from the same directory and with the same file paths.
+
+    :param filenames: List of runtime trace files (JSON).
+    :param float hot_fraction: Minimum fraction of the execution time spent
+        in a loop to consider it hot.
+    :raises ValueError: If a file is not a runtime trace.
+    '''
+
+    def __init__(self, filenames, hot_fraction=DEFAULT_HOT_FRACTION):
+        self._hot_fraction = hot_fraction
+        self._elapsed = 0.0
+        self._loops = {}
+        for filename in filenames:
+            with open(filename, "r") as fobj:
+                try:
+                    trace = json.load(fobj)
+                    self._elapsed += trace["elapsed"]
+                    for loop in trace["loops"]:
+                        counters = self._loops.setdefault(
+                            loop["name"], dict.fromkeys(FIELDS, 0))
+                        for field in FIELDS:
+                            counters[field] += loop.get(field, 0)
+                except (ValueError, KeyError, TypeError) as err:
+                    raise ValueError("{0} is not a Doping runtime trace ({1})".format(
+                        filename, err))
+
+    def __contains__(self, name):
+        return name in self._loops
+
+    def baseline_iteration_time(self, name):
+        ''' Return the measured seconds per iteration of the loop without
+        Doping, or None if it was not sampled. '''
+        loop = self._loops.get(name)
+        if loop is None or loop["sampled_iterations"] <= 0:
+            return None
+        return loop["sampled_time"] / loop["sampled_iterations"]
+
+    def loop_time(self, name):
+        ''' Return the estimated seconds spent in the loop without Doping, if
+        the baseline was not sampled it is the time spent in its
+        specializations. '''
+        loop = self._loops.get(name)
+        if loop is None:
+            return 0.0
+        iteration_time = self.baseline_iteration_time(name)
+        if iteration_time is None:
+            return loop["specialized_time"]
+        return loop["iterations"] * iteration_time
+
+    def is_hot(self, name):
+        ''' Return whether the loop took at least the hot fraction of the
+        execution time. Loops that were never entered are not hot. '''
+        if name not in self._loops:
+            return False
+        return self.loop_time(name) >= self._hot_fraction * self._elapsed
+
+    def gain(self, name):
+        ''' Return the seconds saved by the specializations of the loop,
+        including the time spent rendering, compiling and loading them, or
+        None if it can not be known. '''
+        loop = self._loops.get(name)
+        iteration_time = self.baseline_iteration_time(name)
+        if loop is None or iteration_time is None or loop["specialized_runs"] == 0:
+            return None
+        preparation = loop["render_time"] + loop["compile_time"] + loop["dlopen_time"]
+        return (loop["specialized_iterations"] * iteration_time -
+                loop["specialized_time"] - preparation)
+
+    def select(self, name, dose=1):
+        ''' Return whether the loop should be transformed and the reason.
+        With dose 1 the loop must be hot and its specialization must have
+        paid off (if it is not known, only being hot is required), with
+        dose 2 it only needs to be hot and with dose 3 all loops are
+        selected.
+
+        :param str name: Name of the loop.
+        :param int dose: Doping dose (see the dope --dose option).
+        '''
+        if dose >= 3:
+            return True, "all loops are selected with dose 3"
+        if name not in self._loops:
+            return False, "it was not executed in the profile"
+        if not self.is_hot(name):
+            return False, "it took {0:.2g}s of {1:.2g}s in the profile".format(
+                self.loop_time(name), self._elapsed)
+        gain = self.gain(name)
+        if dose <= 1 and gain is not None and gain <= 0:
+            return False, "its specialization did not pay off ({0:.2g}s)".format(gain)
+        if gain is None:
+            return True, "it is hot"
+        return True, "it is hot and its specialization saved {0:.2g}s".format(gain)
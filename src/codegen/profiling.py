@@ -0,0 +1,165 @@
+""" This module provides the instrumentation used to profile the Doping
+source-to-source transformations (the dope --profile mode) """
+
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+# Profiler of the process, None when profiling is disabled
+_PROFILER = None
+
+
+class Profiler():
+    '''
+    Records the time spans of the dope pipeline (files, transformation
+    phases and loops) and counters of the work done (e.g. AST nodes
+    visited, tokens fetched or lines inserted).
+
+    Each span is stored as a complete event of the Chrome trace format
+    (which can be loaded in chrome://tracing or Perfetto) and the counters
+    incremented during the span are added to the event arguments. The
+    events can be summarized per file and per loop as JSON.
+    '''
+
+    def __init__(self):
+        self._events = []
+        self._counters = {}
+
+    @property
+    def events(self):
+        ''' Return the list of recorded events. '''
+        return self._events
+
+    def extend(self, events):
+        ''' Add events recorded by another profiler (e.g. in a worker
+        process). '''
+        self._events.extend(events)
+
+    def count(self, counter, value=1):
+        ''' Increase the given counter. '''
+        self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def counters(self):
+        ''' Return a dictionary with the value of each counter. '''
+        return dict(self._counters)
+
+    @contextmanager
+    def span(self, name, category="dope", **args):
+        '''
+        Context manager that records the time spent inside it.
+
+        :param str name: Name of the event.
+        :param str category: Category of the event, the summary uses the
+            'file', 'phase' and 'loop' categories.
+        :param args: Other information added to the event, the arguments
+            can also be updated inside the context through the yielded
+            dictionary.
+        '''
+        counters = dict(self._counters)
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            duration = time.perf_counter() - start
+            increments = {counter: value - counters.get(counter, 0)
+                          for counter, value in self._counters.items()
+                          if value != counters.get(counter, 0)}
+            if increments:
+                args["counters"] = increments
+            self._events.append({
+                "name": name, "cat": category, "ph": "X",
+                "ts": int(start_time * 1e6), "dur": int(duration * 1e6),
+                "pid": os.getpid(), "tid": os.getpid(), "args": args})
+
+    def trace(self):
+        ''' Return the events in the Chrome trace format. '''
+        return {"traceEvents": sorted(self._events, key=lambda x: x["ts"]),
+                "displayTimeUnit": "ms"}
+
+    def summary(self):
+        '''
+        Return a dictionary with the seconds and counters of each file, of
+        its transformation phases and of its loops, the seconds of the other
+        events (e.g. the compilation) and the total of each counter in all
+        the files.
+        '''
+        def seconds(event):
+            return event["dur"] / 1e6
+
+        files = {}
+        others = []
+        for event in sorted(self._events, key=lambda x: x["ts"]):
+            args = event["args"]
+            if event["cat"] in ("file", "phase", "loop"):
+                report = files.setdefault(args["file"], {
+                    "file": args["file"], "seconds": 0.0, "counters": {},
+                    "phases": {}, "loops": []})
+                if event["cat"] == "file":
+                    report["seconds"] = seconds(event)
+                    report["counters"] = args.get("counters", {})
+                elif event["cat"] == "phase":
+                    report["phases"][event["name"]] = seconds(event)
+                else:
+                    loop = dict(args)
+                    del loop["file"]
+                    loop["phase"] = event["name"]
+                    loop["seconds"] = seconds(event)
+                    report["loops"].append(loop)
+            elif event["cat"] != "detail":
+                others.append({"name": event["name"], "seconds": seconds(event),
+                               "counters": args.get("counters", {})})
+        totals = {}
+        for report in files.values():
+            for counter, value in report["counters"].items():
+                totals[counter] = totals.get(counter, 0) + value
+        return {"files": list(files.values()), "events": others,
+                "counters": totals}
+
+    def write(self, prefix):
+        '''
+        Write the summary into <prefix>.json and the Chrome trace into
+        <prefix>.trace.json. Return the name of both files.
+
+        :param str prefix: Path and name (without extension) of the files.
+        '''
+        summary_file = prefix + ".json"
+        trace_file = prefix + ".trace.json"
+        with open(summary_file, "w") as fobj:
+            json.dump(self.summary(), fobj, indent=2)
+        with open(trace_file, "w") as fobj:
+            json.dump(self.trace(), fobj)
+        return summary_file, trace_file
+
+
+def enable():
+    ''' Start profiling with a new Profiler and return it. '''
+    global _PROFILER  # pylint: disable=global-statement
+    _PROFILER = Profiler()
+    return _PROFILER
+
+
+def disable():
+    ''' Stop profiling. '''
+    global _PROFILER  # pylint: disable=global-statement
+    _PROFILER = None
+
+
+def get_profiler():
+    ''' Return the Profiler in use or None if profiling is disabled. '''
+    return _PROFILER
+
+
+def span(name, category="dope", **args):
+    ''' Return a context manager that records a span in the Profiler in use
+    (see Profiler.span), or does nothing if profiling is disabled. '''
+    if _PROFILER is None:
+        return nullcontext(args)
+    return _PROFILER.span(name, category, **args)
+
+
+def count(counter, value=1):
+    ''' Increase a counter of the Profiler in use, if any. '''
+    if _PROFILER is not None:
+        _PROFILER.count(counter, value)
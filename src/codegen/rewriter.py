@@ -1,6 +1,8 @@
 """ This module provides a Rewritter buffer """
 
 import os
+from codegen import profiling
+
 
 class Rewriter:
     '''
@@ -31,14 +33,21 @@ class Rewriter:
     _ind_level = 0
     _ind_string = "  "
 
-    def __init__(self, filename):
+    def __init__(self, filename, source=None):
+        '''
+        :param filename: Path to the file where the buffer is saved.
+        :param source: Path to the file loaded into the buffer, by default
+            filename. If it is given, filename is not read or created.
+        '''
         self._filename = filename
 
-        # If file does not exist create an empty file
-        if not os.path.isfile(filename):
-            open(filename, 'a').close()
+        if source is None:
+            # If file does not exist create an empty file
+            if not os.path.isfile(filename):
+                open(filename, 'a').close()
+            source = filename
 
-        self.load(filename)
+        self.load(source)
 
     def load(self, filetocopy):
         '''
@@ -93,6 +102,7 @@ class Rewriter:
 
         :param str string: String to insert.
         '''
+        profiling.count("lines_inserted")
         # Update content
         self._content.insert(self._cursor - 1,
                              (self._ind_string * self._ind_level) + string)
@@ -202,5 +212,229 @@ class Rewriter:
 
     def save(self):
         ''' Save buffer contents to file. '''
-        with open(self._filename, 'w') as fobj:
-            fobj.write("\n".join(self._content))
+        self._write(self._content)
+
+    def _write(self, lines):
+        # Write into a temporary file and rename it, so the file is replaced
+        # atomically and never has partial contents.
+        tmpname = self._filename + "." + str(os.getpid()) + ".tmp"
+        try:
+            with open(tmpname, 'w') as fobj:
+                fobj.write("\n".join(lines))
+            os.replace(tmpname, self._filename)
+        except OSError:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+
+class FenwickTree:
+    '''
+    Fenwick (binary indexed) tree of integers. It updates a value and
+    computes prefix sums in O(log n).
+    '''
+
+    def __init__(self, values):
+        self._tree = [0] + list(values)
+        for i in range(1, len(self._tree)):
+            parent = i + (i & -i)
+            if parent < len(self._tree):
+                self._tree[parent] += self._tree[i]
+
+    def add(self, index, value):
+        ''' Add value to the element at index (0-indexed). '''
+        index += 1
+        while index < len(self._tree):
+            self._tree[index] += value
+            index += index & -index
+
+    def prefix_sum(self, index):
+        ''' Return the sum of the elements before index (0-indexed). '''
+        total = 0
+        while index > 0:
+            total += self._tree[index]
+            index -= index & -index
+        return total
+
+    def lower_bound(self, value):
+        '''
+        Return the first index (0-indexed) whose prefix sum (including
+        itself) reaches value. The elements must not be negative.
+        '''
+        index = 0
+        step = 1 << (len(self._tree).bit_length() - 1)
+        while step > 0:
+            if index + step < len(self._tree) and self._tree[index + step] < value:
+                index += step
+                value -= self._tree[index]
+            step >>= 1
+        return index
+
+
+class PieceTableRewriter(Rewriter):
+    '''
+    Rewriter with the same interface and behaviour, but with operations in
+    O(log n) instead of O(n), for files with many modifications.
+
+    Instead of a list of lines, the content is stored in one piece per
+    original line: the lines inserted before it and the original line
+    itself (None once deleted). An extra piece keeps the lines added at
+    the end. A Fenwick tree with the number of lines of each piece maps
+    current line numbers to pieces and original line numbers to current
+    ones. The original lines that have been deleted are mapped to the line
+    that follows them.
+    '''
+
+    def load(self, filetocopy):
+        '''
+        Populates rewrite buffer with filetocopy contents. It destroys any
+        previous content in the buffer.
+
+        :param filetocopy: Path to file that will be copied into the buffer.
+        '''
+
+        with open(filetocopy, 'r') as fobj:
+            self._original = fobj.read().splitlines()
+        self._cursor = 1
+        self._original_num_lines = len(self._original)
+        self._num_lines = self._original_num_lines
+        # Lines inserted before each original line (only for pieces that
+        # have any)
+        self._inserted = {}
+        self._sizes = FenwickTree([1] * self._original_num_lines + [0])
+
+    def _locate(self, number):
+        # Return the piece and the position inside it of the line number
+        if number > self._num_lines:
+            # Lines appended at the end
+            return self._original_num_lines, number - self._num_lines - 1 + \
+                len(self._inserted.get(self._original_num_lines, ()))
+        piece = self._sizes.lower_bound(number)
+        return piece, number - self._sizes.prefix_sum(piece) - 1
+
+    def _get(self, number):
+        piece, position = self._locate(number)
+        inserted = self._inserted.get(piece, ())
+        if position < len(inserted):
+            return inserted[position]
+        return self._original[piece]
+
+    def _set(self, number, string):
+        piece, position = self._locate(number)
+        inserted = self._inserted.get(piece, ())
+        if position < len(inserted):
+            inserted[position] = string
+        else:
+            self._original[piece] = string
+
+    def _lines(self):
+        # Generator of all the lines in order
+        for piece in range(self._original_num_lines + 1):
+            for line in self._inserted.get(piece, ()):
+                yield line
+            if piece < self._original_num_lines and self._original[piece] is not None:
+                yield self._original[piece]
+
+    def get_content(self):
+        ''' Returns cursor line content.'''
+        return self._get(self._cursor)
+
+    def goto_line(self, number):
+        '''
+        Move the cursor to provided line number.
+
+        :param number: Line number
+        '''
+        if (number > self._num_lines or number < 1):
+            raise IndexError("File only has " +
+                             str(self._num_lines) + " lines.")
+        self._cursor = number
+
+    def goto_original_line(self, number):
+        '''
+        Move the cursor to the new possitional of the original line
+        number provided.
+
+        :param number: Line number in original file.
+        '''
+        if (number > self._original_num_lines or number < 1):
+            raise IndexError("Original file only had " +
+                             str(self._original_num_lines)+" lines.")
+        self._cursor = self._sizes.prefix_sum(number - 1) + \
+            len(self._inserted.get(number - 1, ())) + 1
+
+    def insert(self, string):
+        '''
+        Insert string into the cursor position.
+
+        :param str string: String to insert.
+        '''
+        profiling.count("lines_inserted")
+        piece, position = self._locate(self._cursor)
+        self._inserted.setdefault(piece, []).insert(
+            position, (self._ind_string * self._ind_level) + string)
+        self._sizes.add(piece, 1)
+        self._num_lines = self._num_lines + 1
+        self._cursor = self._cursor + 1
+
+    def insertpl(self, string):
+        '''
+        Insert string at the end of the previous line and don't update the
+        cursor.
+
+        :param str string: String to insert.
+        '''
+        self._set(self._cursor - 1, self._get(self._cursor - 1) + " " + string)
+
+    def delete(self):
+        '''
+        Delete current cursor line contents.
+        '''
+        piece, position = self._locate(self._cursor)
+        inserted = self._inserted.get(piece, ())
+        if position < len(inserted):
+            inserted.pop(position)
+        else:
+            self._original[piece] = None
+        self._sizes.add(piece, -1)
+        self._num_lines = self._num_lines - 1
+
+        # when cursor was last line, decrease it
+        self._cursor = min(self._cursor, self._num_lines)
+
+    def replace(self, string):
+        '''
+        Replace contents from the cursor line with the new provided string.
+
+        :param str string: String to insert.
+        '''
+        self._set(self._cursor, (self._ind_string * self._ind_level) + string)
+        self._cursor = self._cursor + 1
+
+    def comment(self):
+        ''' Prefix cursor line with C-style comment symbol. '''
+        self.replace("//" + self._get(self._cursor))
+
+    def print_range(self, start, end):
+        '''
+        Print content from provided start to end line.
+
+        :param start: Start line.
+        :param end: End line.
+        '''
+        print("--- Buffer from line " + str(start) + " to " + str(end) +
+              " ---")
+        for line in range(start, end + 1):
+            if line == self._cursor:
+                print("->" + str(line) + ": " + self._get(line))
+            else:
+                print("  " + str(line) + ": " + self._get(line))
+        print("--- End range ---")
+
+    def printall(self):
+        ''' Print full buffer.'''
+        self.print_range(1, self._num_lines)
+
+    def save(self):
+        ''' Save buffer contents to file. '''
+        self._write(self._lines())
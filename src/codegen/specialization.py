@@ -0,0 +1,100 @@
+""" This module precompiles the specializations of the transformed loops when
+the application is built, so the runtime finds them at the first entry of the
+loop instead of compiling them (see the dope --specialize option) """
+
+import json
+import ctypes
+
+
+def parse_values(string):
+    ''' Return a dictionary with the runtime invariant values given as a
+    "name=value,..." string.
+
+    :param str string: Comma-separated list of name=value pairs.
+    :raises ValueError: If an item is not a name=value pair.
+    '''
+    values = {}
+    for item in string.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, separator, value = item.partition("=")
+        if not separator or not name.strip() or not value.strip():
+            raise ValueError("Invalid specialization value '{0}', it must be"
+                             " name=value".format(item))
+        values[name.strip()] = value.strip()
+    return values
+
+
+def read_profile(filename):
+    ''' Return a dictionary with the parameters ("name:value,..." strings)
+    of the specializations compiled by each loop, read from the runtime
+    trace events file (DOPING_TRACE_EVENTS) of a previous execution.
+
+    :param str filename: JSON lines file with the runtime events.
+    '''
+    profile = {}
+    with open(filename, "r") as fobj:
+        for line in fobj:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event.get("event") == "compile":
+                parameters = profile.setdefault(event["loop"], [])
+                if event["parameters"] not in parameters:
+                    parameters.append(event["parameters"])
+    return profile
+
+
+def specializations(loop, values_list, profile=None):
+    ''' Return the parameters of the specializations to precompile for the
+    given loop (as described by InjectDoping.get_loops()).
+
+    Each dictionary of values gives a specialization of the loops that have
+    all their runtime invariants in it. If the pointers aliasing is not
+    given (doping_restrict_all), it takes the value that the runtime checks
+    find when the pointers do not alias. The profile (see read_profile) adds
+    the specializations that the loop compiled in a previous execution.
+
+    :param dict loop: Description of the transformed loop.
+    :param values_list: List of dictionaries of runtime invariant values.
+    :param dict profile: Parameters of the specializations of each loop.
+    '''
+    names = [item.split(":")[0] for item in loop["signature_format"].split(",")]
+    defaults = {"doping_restrict_all": "1" if loop["restrict"] else "0"}
+    result = []
+    for values in values_list:
+        values = dict(defaults, **values)
+        if all(name in values for name in names):
+            result.append(",".join(name + ":" + values[name] for name in names))
+    if profile:
+        result.extend(profile.get(loop["name"], []))
+    # Remove duplicates, keeping the order
+    return list(dict.fromkeys(result))
+
+
+class Precompiler:
+    '''
+    This class compiles the specializations with the Doping runtime library,
+    which renders the loop sources exactly as it does at runtime.
+
+    :param str library: Path of the Doping runtime library (libdoping.so).
+    '''
+
+    def __init__(self, library):
+        self._library = ctypes.CDLL(library)
+        self._library.dopingPrecompile.restype = ctypes.c_int
+        self._library.dopingPrecompile.argtypes = [ctypes.c_char_p] * 5
+
+    def precompile(self, loop, parameters, directory):
+        ''' Compile the specialization of the loop with the given parameters
+        into the directory. It returns whether it succeeded.
+
+        :param dict loop: Description of the transformed loop.
+        :param str parameters: "name:value,..." values of its invariants.
+        :param str directory: Directory where the library is stored.
+        '''
+        arguments = [loop["source"], loop["signature_format"], parameters,
+                     loop["compiler_command"], directory]
+        return self._library.dopingPrecompile(
+            *[argument.encode("utf-8") for argument in arguments]) != 0
@@ -4,8 +4,10 @@ ast/cursor.py '''
 
 import os
 import pytest
+import clang
 from codegen.ast.translation_unit import DopingTranslationUnit
 from codegen.ast.cursors import DopingCursor
+from clang.cindex import CursorKind
 
 
 class TestDopingCursorBase:
@@ -33,3 +35,187 @@ class TestDopingCursorBase:
     def test_cursor_base(self, sample_cursor):
         ''' Test '''
         assert isinstance(sample_cursor, DopingCursor)
+
+    def test_children_are_memoized(self, sample_cursor, monkeypatch):
+        ''' The children of a node are retrieved from libclang only once and
+        the same instances are returned in following calls. '''
+        main = list(sample_cursor.find_functions())[0]
+        assert main.get_children() is main.get_children()
+
+        # Count the libclang traversals of the same subtree
+        calls = []
+        original = clang.cindex.Cursor.get_children
+
+        def counting_get_children(cursor):
+            calls.append(cursor)
+            return original(cursor)
+
+        monkeypatch.setattr(clang.cindex.Cursor, "get_children",
+                            counting_get_children)
+        str(main)
+        first_traversal = len(calls)
+        assert first_traversal > 0
+        str(main)
+        list(main.find_calls())
+        assert len(calls) == first_traversal
+
+    def test_node_identity_and_parents(self, sample_cursor):
+        ''' Nodes reached through different paths are the same instance and
+        have the parent and root set. '''
+        main = list(sample_cursor.find_functions())[0]
+        assert main._parent is sample_cursor
+        assert main.root is sample_cursor
+        for child in main.get_children():
+            assert child._parent is main
+            assert child.root is sample_cursor
+        call = list(main.find_calls())[0]
+        assert call is list(sample_cursor.find_calls())[0]
+        assert call.root.cache_node(call) is call
+
+    def test_cursor_views(self, sample_cursor):
+        ''' DopingCursors are lightweight views of the libclang cursors that
+        give access to the cursor attributes and are interned by the root. '''
+        main = list(sample_cursor.find_functions())[0]
+        call = list(main.find_calls())[0]
+        for node in (sample_cursor, main, call):
+            assert not hasattr(node, "__dict__")
+            assert isinstance(node.cursor, clang.cindex.Cursor)
+
+        # Cursor attributes are forwarded
+        assert main.spelling == main.cursor.spelling == "main"
+        assert main.kind == CursorKind.FUNCTION_DECL
+        assert main.result_type.spelling == "int"
+        assert main.get_usr() == main.cursor.get_usr()
+
+        # The same node is always represented by the same view and views
+        # compare equal to the cursors they wrap.
+        assert sample_cursor.cache_node(main.cursor) is main
+        assert sample_cursor.cache_node(main) is main
+        assert main == main.cursor
+        assert hash(main) == hash(main.cursor)
+        assert main != call
+        assert main in [call, main]
+
+    def test_is_from_header(self, sample_cursor):
+        ''' The nodes declared in header files are identified '''
+        printf = [x for x in sample_cursor.get_children() if x.spelling == "printf"]
+        assert printf and printf[0].is_from_header()
+        main = list(sample_cursor.find_functions())[0]
+        assert not main.is_from_header()
+
+
+class TestAstIndex:
+    ''' Test the AstIndex used by the find_* methods '''
+
+    @pytest.fixture
+    def loops_root(self, tmpdir):
+        ''' Creates a temporary file called test.c with nested loops '''
+        filename = os.path.join(str(tmpdir), "test.c")
+        with open(filename, "w") as source:
+            source.write(
+                '''
+                #include<stdio.h>
+                int add(int a, int b){ return a + b; }
+                int main(){
+                    int s = 0, n = 10;
+                    for(int i = 0; i < n; i++){
+                        for(int j = 0; j < n; j++){
+                            s += add(i, j);
+                        }
+                        s = s * 2;
+                    }
+                    for(int k = 0; k < n; k++){
+                        printf("%d", add(s, k));
+                    }
+                    return s;
+                }
+                '''
+            )
+        return DopingTranslationUnit(filename).get_root()
+
+    @staticmethod
+    def reference_find(node, kinds, outermostonly=False, displayname=False):
+        ''' Recursive traversal with the semantics of the find_* methods '''
+        if node.location.file is not None and \
+                node.location.file.name.endswith(('.h', '.hpp', '.tcc')):
+            return
+        found = False
+        if node.kind in kinds or not kinds:
+            if not displayname or displayname == node.displayname:
+                found = True
+                yield node
+        if not found or not outermostonly:
+            children = node.get_children()
+            if node.kind == CursorKind.CALL_EXPR:
+                children = children[1:]
+            for child in children:
+                yield from TestAstIndex.reference_find(
+                    child, kinds, outermostonly, displayname)
+
+    def test_queries_match_traversal(self, loops_root):
+        ''' The index returns the same nodes (in the same order) as a full
+        traversal, for the root and for subtrees. '''
+        loops = list(loops_root.find_loops())
+        assert len(loops) == 3
+        assert list(loops_root.find_loops(outermostonly=True)) == \
+            [loops[0], loops[2]]
+        for node in [loops_root] + loops:
+            for kinds in [(CursorKind.FOR_STMT,), (CursorKind.CALL_EXPR,),
+                          (CursorKind.UNEXPOSED_EXPR, CursorKind.DECL_REF_EXPR),
+                          ()]:
+                for outermost in (False, True):
+                    expected = list(self.reference_find(node, kinds, outermost))
+                    assert list(node._find(kinds, outermost)) == expected
+            assert list(node.find_name("s")) == \
+                list(self.reference_find(node, (), True, "s"))
+
+    def test_index_is_built_once(self, loops_root):
+        ''' All the nodes share the index of the root. '''
+        loop = list(loops_root.find_loops())[1]
+        index, position = loop._index()
+        assert index is loops_root.get_index()
+        assert index.position(loop) == position
+        assert loops_root._index() == (index, 0)
+
+    def test_find_in_header_nodes(self, tmpdir):
+        ''' Nodes from header files are excluded from their own queries
+        instead of failing. '''
+        with open(os.path.join(str(tmpdir), "helper.h"), "w") as header:
+            header.write(
+                '''
+                int twice(int a){ return 2 * a; }
+                int helper(int n){
+                    int s = 0;
+                    for(int i = 0; i < n; i++){ s += twice(i); }
+                    return s;
+                }
+                '''
+            )
+        filename = os.path.join(str(tmpdir), "test.c")
+        with open(filename, "w") as source:
+            source.write('#include "helper.h"\nint main(){ return helper(3); }\n')
+        root = DopingTranslationUnit(filename).get_root()
+        helper = [x for x in root.get_children() if x.spelling == "helper"][0]
+        assert helper.is_from_header()
+        assert list(helper.find_loops()) == []
+        assert list(helper.find_calls()) == []
+        assert len(list(helper.find_loops(exclude_headers=False))) == 1
+
+    def test_get_string_from_source(self, loops_root):
+        ''' The source of each node is the same as cutting its lines from
+        the source code. '''
+        def reference(node):
+            block = node.root.source_code.split('\n')[
+                node.extent.start.line - 1:node.extent.end.line]
+            block[0] = block[0][node.extent.start.column - 1:]
+            block[-1] = block[-1][:node.extent.end.column]
+            return '\n'.join(block)
+
+        main = list(loops_root.find_functions())[1]
+        nodes = list(main._find(()))
+        assert len(nodes) > 20
+        for node in nodes:
+            assert node.get_string_from_source() == reference(node)
+        loop = list(loops_root.find_loops())[1]
+        assert loop.get_string_from_source().startswith("for(int j = 0;")
+        assert loop.get_string_from_source().endswith("}")
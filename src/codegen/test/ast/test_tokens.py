@@ -0,0 +1,68 @@
+# pylint: disable=no-self-use, protected-access
+''' Py.test tests for the TokenStream class as implemented in
+ast/tokens.py '''
+
+import os
+import pytest
+from codegen.ast.translation_unit import DopingTranslationUnit
+from codegen.ast.tokens import TokenStream
+
+
+class TestTokenStream:
+    ''' Test the TokenStream '''
+
+    @pytest.fixture
+    def sample_tu(self, tmpdir):
+        ''' Creates a temporary file called test.c with a loop that uses a
+        macro '''
+        filename = os.path.join(str(tmpdir), "test.c")
+        with open(filename, "w") as source:
+            source.write(
+                "#define TYPE double\n"
+                "int sum(TYPE * a, int n){\n"
+                "    int s = 0;\n"
+                "    for(int i = 0; i < n; i++){\n"
+                "        s += a[i];\n"
+                "    }\n"
+                "    return s;\n"
+                "}\n"
+            )
+        return DopingTranslationUnit(filename)
+
+    def test_stream(self, sample_tu):
+        ''' The stream has all the tokens of the file with the repeated
+        spellings interned. '''
+        stream = sample_tu.get_token_stream()
+        assert isinstance(stream, TokenStream)
+        assert stream is sample_tu.get_token_stream()
+        assert len(stream) == 47
+        assert len(stream._spellings) < len(stream)
+        assert stream.spellings(0, 4) == ["#", "define", "TYPE", "double"]
+        first, last = stream.find_range(0, 20)
+        assert (first, last) == (0, 4)
+        token = stream.tokens(4, 5)[0]
+        assert token.spelling == "int"
+        assert token.kind.name == "KEYWORD"
+        assert (token.line, token.column, token.offset) == (2, 1, 20)
+
+    def test_cursor_tokens(self, sample_tu):
+        ''' The cursors get their tokens from the stream. '''
+        root = sample_tu.get_root()
+        loop = list(root.find_loops())[0]
+        assert loop.get_initialization().get_token_spellings() == \
+            ["int", "i", "=", "0", ";"]
+        assert loop.get_end_condition().get_token_spellings() == ["i", "<", "n"]
+        assert loop.end_condition_string() == "i < n"
+        assert loop.cond_variable() == "i"
+        tokens = loop.get_body().get_stream_tokens()
+        assert [token.line for token in tokens] == [4, 5, 5, 5, 5, 5, 5, 5, 6]
+        assert loop.get_body().get_string(referencing_variables=["s"]) == \
+            "{\n (*s)+=a [i ];\n}"
+
+    def test_macro_extents(self, sample_tu):
+        ''' Nodes that start with a macro only get the tokens in their
+        extent. '''
+        root = sample_tu.get_root()
+        function = list(root.find_functions())[0]
+        parameter = function.get_children()[0]
+        assert parameter.get_token_spellings() == ["TYPE", "*", "a"]
@@ -5,7 +5,9 @@ ast/translation_unit.py '''
 import os
 import pytest
 import clang
-from codegen.ast.translation_unit import DopingTranslationUnit
+from codegen.ast.translation_unit import DopingTranslationUnit, get_index, \
+    get_preamble
+from codegen.cache import PreambleCache
 from codegen.ast.cursors import DopingCursor
 
 
@@ -95,6 +97,15 @@ class TestDopingTranslationUnit:
         ''' The get_root() method returns a doping cursor. '''
         sample_tu = DopingTranslationUnit(cfile)
         assert isinstance(sample_tu.get_root(), DopingCursor)
+        # It is always the same root
+        assert sample_tu.get_root() is sample_tu.get_root()
+
+    def test_get_includes(self, cfile):
+        ''' The get_includes() method returns the included files '''
+        sample_tu = DopingTranslationUnit(cfile)
+        includes = sample_tu.get_includes()
+        assert any(x.endswith("stdio.h") for x in includes)
+        assert includes == sorted(set(includes))
 
     def test_get_flags(self, cfile):
         ''' The get_flags() method returns the arguments string '''
@@ -107,3 +118,73 @@ class TestDopingTranslationUnit:
         sample_tu = DopingTranslationUnit(cfile, "gcc -O2 invalidflag")
         assert len(sample_tu.get_flags()) == 1
         assert "-O2" in sample_tu.get_flags()
+
+    def test_shared_index(self, cfile):
+        ''' All the translation units are parsed with the same Index '''
+        assert get_index() is get_index()
+        first = DopingTranslationUnit(cfile)
+        second = DopingTranslationUnit(cfile)
+        assert first._clang_tu.index is second._clang_tu.index is get_index()
+
+    def test_get_preamble(self):
+        ''' The preamble are the system includes before any other code '''
+        source = ("// Comment\n"
+                  "#include <stdio.h>\n"
+                  "\n"
+                  "/* Comment */\n"
+                  "  #  include<stdlib.h>\n"
+                  "#include \"local.h\"\n"
+                  "#include <math.h>\n")
+        assert get_preamble(source) == "#include <stdio.h>\n#  include<stdlib.h>\n"
+        assert get_preamble("#define N 3\n#include <stdio.h>\n") == ""
+        assert get_preamble("int main(){}\n") == ""
+
+    def test_precompiled_preamble(self, cfile):
+        ''' The preamble headers are loaded from a precompiled header that is
+        built once and shared by the translation units, they produce the same
+        AST and includes than a plain parse '''
+        def main_file_nodes(cursor, nodes):
+            for child in cursor.get_children():
+                if child.location.file and child.location.file.name == cfile:
+                    nodes.append((child.kind, child.spelling, child.extent.start.offset))
+                    main_file_nodes(child, nodes)
+            return nodes
+
+        cache = PreambleCache()
+        first = DopingTranslationUnit(cfile)
+        stats = cache.stats()
+        assert stats['entries'] >= 1
+        second = DopingTranslationUnit(cfile)
+        assert cache.stats()['hits'] == stats['hits'] + 1
+        assert cache.stats()['entries'] == stats['entries']
+
+        plain = clang.cindex.Index.create().parse(cfile)
+        plain_includes = {inclusion.include.name
+                          for inclusion in plain.get_includes()}
+        plain_nodes = main_file_nodes(plain.cursor, [])
+        assert plain_nodes
+        for tunit in (first, second):
+            assert set(tunit.get_includes()) == plain_includes
+            assert main_file_nodes(tunit._clang_tu.cursor, []) == plain_nodes
+
+    def test_precompiled_preamble_fallback(self, cfile, monkeypatch):
+        ''' If the cache can not be used the file is parsed normally '''
+        def failing_lookup(_, key):
+            raise OSError("Read-only cache")
+        monkeypatch.setattr(PreambleCache, "lookup", failing_lookup)
+        tunit = DopingTranslationUnit(cfile)
+        assert tunit._preamble_includes == []
+        assert any(x.endswith("stdio.h") for x in tunit.get_includes())
+
+    def test_precompiled_preamble_disabled(self, cfile, tmpdir):
+        ''' Without preamble cache the whole file is parsed, and a given
+        cache is used instead of the default one '''
+        cache = PreambleCache(os.path.join(str(tmpdir), "preambles"))
+        tunit = DopingTranslationUnit(cfile, preamble_cache=None)
+        assert tunit._preamble_includes == []
+        assert any(x.endswith("stdio.h") for x in tunit.get_includes())
+        assert cache.stats()['entries'] == 0
+
+        tunit = DopingTranslationUnit(cfile, preamble_cache=cache)
+        assert tunit._preamble_includes
+        assert cache.stats()['entries'] == 1
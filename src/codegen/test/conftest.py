@@ -12,6 +12,19 @@ def pytest_addoption(parser):
                      help="Compile output code when tests produce code")
 
 
+@pytest.fixture(autouse=True, scope="session")
+def cache_directory(tmp_path_factory):
+    ''' Keep the caches shared by the tests (e.g. the precompiled preambles)
+    in a temporary directory instead of the user cache directory '''
+    previous = os.environ.get("DOPING_CACHE_DIR")
+    os.environ["DOPING_CACHE_DIR"] = str(tmp_path_factory.mktemp("doping_cache"))
+    yield os.environ["DOPING_CACHE_DIR"]
+    if previous is None:
+        del os.environ["DOPING_CACHE_DIR"]
+    else:
+        os.environ["DOPING_CACHE_DIR"] = previous
+
+
 @pytest.fixture
 def compiler(request):
     ''' Return a Compiler object '''
@@ -0,0 +1,159 @@
+# pylint: disable=protected-access,redefined-outer-name
+''' Py.test tests for the TransformationCache class as implemented in cache.py '''
+
+import os
+import pytest
+import codegen.cache
+from codegen.cache import TransformationCache, PreambleCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    ''' Creates a TransformationCache in a temporary directory '''
+    return TransformationCache(os.path.join(str(tmpdir), "cache"))
+
+
+@pytest.fixture
+def sources(tmpdir):
+    ''' Creates a source file, a header it depends on and a generated file '''
+    source = os.path.join(str(tmpdir), "input.c")
+    with open(source, "w") as fobj:
+        fobj.write('#include "header.h"\nint main(){ return 0; }\n')
+    header = os.path.join(str(tmpdir), "header.h")
+    with open(header, "w") as fobj:
+        fobj.write("int value;\n")
+    output = os.path.join(str(tmpdir), "input.doping.c")
+    with open(output, "w") as fobj:
+        fobj.write("Generated code\n")
+    return source, header, output
+
+
+def test_default_directory(monkeypatch):
+    ''' The cache is stored inside DOPING_CACHE_DIR when it is defined '''
+    monkeypatch.setenv("DOPING_CACHE_DIR", "/cachedir")
+    assert TransformationCache().directory == "/cachedir/transformations"
+    monkeypatch.delenv("DOPING_CACHE_DIR")
+    assert TransformationCache().directory.endswith(
+        os.path.join(".cache", "doping", "transformations"))
+
+
+def test_key(sources):
+    ''' The key depends on the source, the compiler command and the options '''
+    source, _, _ = sources
+    key = TransformationCache.key(source, "gcc -O2", {'dose': 1})
+    assert key == TransformationCache.key(source, "gcc -O2", {'dose': 1})
+    assert key != TransformationCache.key(source, "gcc -O2 -DN=3", {'dose': 1})
+    assert key != TransformationCache.key(source, "gcc -O2", {'dose': 2})
+
+    with open(source, "a") as fobj:
+        fobj.write("\n")
+    assert key != TransformationCache.key(source, "gcc -O2", {'dose': 1})
+
+
+def test_key_depends_on_the_generator(sources, tmpdir, monkeypatch):
+    ''' The key changes with the code generator and the runtime header '''
+    source, _, _ = sources
+    key = TransformationCache.key(source, "gcc -O2", {'dose': 1})
+    monkeypatch.setattr(codegen.cache, "generator_digest", lambda: "other")
+    assert key != TransformationCache.key(source, "gcc -O2", {'dose': 1})
+    monkeypatch.undo()
+
+    header = tmpdir.mkdir("root").mkdir("bin").join("doping.h")
+    header.write("typedef struct dopinginfo{ int a; } dopinginfo;\n")
+    monkeypatch.setenv("DOPING_ROOT", str(tmpdir.join("root")))
+    codegen.cache.generator_digest.cache_clear()
+    try:
+        assert codegen.cache.runtime_header() == str(header)
+        digest = codegen.cache.generator_digest()
+        header.write("typedef struct dopinginfo{ int a; int b; } dopinginfo;\n")
+        codegen.cache.generator_digest.cache_clear()
+        assert codegen.cache.generator_digest() != digest
+    finally:
+        codegen.cache.generator_digest.cache_clear()
+
+
+def test_store_and_restore(cache, sources, tmpdir):
+    ''' A stored file can be restored while its dependencies do not change '''
+    source, header, output = sources
+    restored = os.path.join(str(tmpdir), "restored.c")
+    key = cache.key(source)
+
+    assert not cache.restore(key, restored)
+    cache.store(key, output, [header])
+    assert cache.restore(key, restored)
+    with open(restored, "r") as fobj:
+        assert fobj.read() == "Generated code\n"
+
+    # Modifying an included file invalidates the entry
+    with open(header, "w") as fobj:
+        fobj.write("int other_value;\n")
+    assert not cache.restore(key, restored)
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['entries'] == 1
+
+
+def test_lru_eviction(sources, tmpdir):
+    ''' When the cache is full the least recently used entries are evicted '''
+    source, _, output = sources
+    cache = TransformationCache(os.path.join(str(tmpdir), "cache"))
+    restored = os.path.join(str(tmpdir), "restored.c")
+
+    keys = [cache.key(source, "gcc -DN=" + str(num)) for num in range(3)]
+    cache.store(keys[0], output)
+    cache.store(keys[1], output)
+    # Limit the cache to the size of the two stored entries
+    cache._max_size = cache.stats()['size']
+    # Make the first entry the oldest one and then use it
+    os.utime(cache._entry_path(keys[0]), (0, 0))
+    os.utime(cache._entry_path(keys[1]), (1, 1))
+    assert cache.restore(keys[0], restored)
+
+    cache.store(keys[2], output)
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['evictions'] == 1
+    assert cache.restore(keys[0], restored)
+    assert not cache.restore(keys[1], restored)
+    assert cache.restore(keys[2], restored)
+
+
+def test_print_stats(cache, capsys):
+    ''' The statistics report contains the counters '''
+    cache.print_stats()
+    captured = capsys.readouterr()
+    assert "Doping transformation cache: " + cache.directory in captured.out
+    assert "Entries:   0" in captured.out
+    assert "Hits:      0 (0.0 %)" in captured.out
+
+
+def test_preamble_cache(sources, tmpdir, monkeypatch):
+    ''' The PreambleCache entries are used in place and its headers keep their
+    timestamp while their contents do not change '''
+    monkeypatch.setenv("DOPING_CACHE_DIR", "/cachedir")
+    assert PreambleCache().directory == "/cachedir/preambles"
+
+    _, header, output = sources
+    cache = PreambleCache(os.path.join(str(tmpdir), "cache"))
+    key = cache.key("#include <stdio.h>\n", ["-x", "c-header"], "libclang")
+    assert key != cache.key("#include <stdio.h>\n", ["-x", "c-header"], "other")
+    assert key != cache.key("#include <math.h>\n", ["-x", "c-header"], "libclang")
+
+    preamble = cache.header(key, "#include <stdio.h>\n")
+    os.utime(preamble, (0, 0))
+    assert cache.header(key, "#include <stdio.h>\n") == preamble
+    assert os.path.getmtime(preamble) == 0
+    # The headers are not cache entries
+    assert cache.stats()['entries'] == 0
+
+    assert cache.lookup(key) is None
+    cache.store(key, output, [header])
+    path, dependencies = cache.lookup(key)
+    assert dependencies == [header]
+    with open(path, "r") as fobj:
+        assert fobj.read() == "Generated code\n"
+
+    with open(header, "w") as fobj:
+        fobj.write("int other_value;\n")
+    assert cache.lookup(key) is None
@@ -0,0 +1,87 @@
+''' Py.test tests for the LoopProfile class as implemented in loop_profile.py '''
+
+import os
+import json
+import pytest
+from codegen.loop_profile import LoopProfile
+
+
+def write_trace(directory, name, elapsed, loops):
+    ''' Write a runtime trace with the given loops (a dictionary of the
+    counters of each loop name) and return its path '''
+    filename = os.path.join(str(directory), name)
+    with open(filename, "w") as fobj:
+        json.dump({"pid": 1, "elapsed": elapsed,
+                   "loops": [dict(counters, name=loop_name)
+                             for loop_name, counters in loops.items()]}, fobj)
+    return filename
+
+
+@pytest.fixture
+def trace(tmpdir):
+    ''' A trace with a hot loop whose specialization paid off, a hot loop
+    whose specialization did not pay off, a cold loop and a loop without
+    baseline samples. '''
+    return write_trace(tmpdir, "trace.json", 10.0, {
+        "fast": {"iterations": 1000, "specialized_runs": 1,
+                 "specialized_iterations": 900, "specialized_time": 1.0,
+                 "sampled_iterations": 100, "sampled_time": 0.5,
+                 "compile_time": 0.5},
+        "slow": {"iterations": 1000, "specialized_runs": 1,
+                 "specialized_iterations": 900, "specialized_time": 4.0,
+                 "sampled_iterations": 100, "sampled_time": 0.5,
+                 "compile_time": 0.5},
+        "cold": {"iterations": 10, "specialized_runs": 1,
+                 "specialized_iterations": 9, "specialized_time": 0.001,
+                 "sampled_iterations": 1, "sampled_time": 0.001},
+        "unsampled": {"iterations": 1000, "specialized_runs": 1,
+                      "specialized_iterations": 1000, "specialized_time": 2.0}})
+
+
+def test_loop_times(trace):
+    ''' The loop time is estimated from the baseline samples '''
+    profile = LoopProfile([trace])
+    assert "fast" in profile
+    assert "other" not in profile
+    assert profile.baseline_iteration_time("fast") == pytest.approx(0.005)
+    assert profile.loop_time("fast") == pytest.approx(5.0)
+    assert profile.baseline_iteration_time("unsampled") is None
+    assert profile.loop_time("unsampled") == pytest.approx(2.0)
+    assert profile.gain("fast") == pytest.approx(4.5 - 1.0 - 0.5)
+    assert profile.gain("slow") == pytest.approx(4.5 - 4.0 - 0.5)
+    assert profile.gain("unsampled") is None
+
+
+def test_select(trace):
+    ''' Loops are selected depending on the dose '''
+    profile = LoopProfile([trace])
+    assert profile.select("fast")[0]
+    assert not profile.select("slow")[0]
+    assert not profile.select("cold")[0]
+    assert not profile.select("other")[0]
+    assert profile.select("unsampled")[0]
+    assert profile.select("slow", dose=2)[0]
+    assert not profile.select("cold", dose=2)[0]
+    assert profile.select("cold", dose=3)[0]
+    assert profile.select("other", dose=3)[0]
+    # The hot fraction can be changed
+    assert LoopProfile([trace], hot_fraction=0.0).select("cold", dose=2)[0]
+    assert not LoopProfile([trace], hot_fraction=0.6).select("fast")[0]
+
+
+def test_multiple_traces(tmpdir, trace):
+    ''' The counters of several traces are added '''
+    other = write_trace(tmpdir, "other.json", 10.0, {
+        "fast": {"iterations": 1000, "sampled_iterations": 100, "sampled_time": 0.5}})
+    profile = LoopProfile([trace, other])
+    assert profile.loop_time("fast") == pytest.approx(2000 * 1.0 / 200)
+    assert profile.is_hot("fast")
+
+
+def test_invalid_trace(tmpdir):
+    ''' Files that are not runtime traces raise a ValueError '''
+    filename = os.path.join(str(tmpdir), "invalid.json")
+    with open(filename, "w") as fobj:
+        fobj.write("[1, 2]")
+    with pytest.raises(ValueError):
+        LoopProfile([filename])
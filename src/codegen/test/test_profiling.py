@@ -0,0 +1,105 @@
+# pylint: disable=protected-access,redefined-outer-name
+''' Py.test tests for the Profiler as implemented in profiling.py '''
+
+import os
+import json
+import pytest
+from codegen import profiling
+from codegen.transformations import InjectDoping
+
+
+@pytest.fixture
+def profiler():
+    ''' Enable profiling during the test '''
+    yield profiling.enable()
+    profiling.disable()
+
+
+def test_disabled():
+    ''' Without a Profiler the spans and counters do nothing '''
+    assert profiling.get_profiler() is None
+    with profiling.span("name", value=1) as args:
+        args["other"] = 2
+        profiling.count("counter")
+    assert profiling.get_profiler() is None
+
+
+def test_span_and_counters(profiler):
+    ''' The spans are recorded as Chrome trace events with the counters
+    incremented inside them '''
+    assert profiling.get_profiler() is profiler
+    profiling.count("nodes_visited", 3)
+    with profiling.span("outer", "file", file="a.c"):
+        profiling.count("nodes_visited", 2)
+        with profiling.span("inner", "phase", file="a.c") as args:
+            args["extra"] = True
+            profiling.count("lines_inserted")
+
+    inner, outer = profiler.events
+    assert inner["name"] == "inner" and inner["cat"] == "phase"
+    assert inner["ph"] == "X" and inner["pid"] == os.getpid()
+    assert inner["args"] == {"file": "a.c", "extra": True,
+                             "counters": {"lines_inserted": 1}}
+    assert outer["args"]["counters"] == {"nodes_visited": 2, "lines_inserted": 1}
+    assert outer["ts"] <= inner["ts"]
+    assert outer["dur"] >= inner["dur"]
+    assert profiler.counters() == {"nodes_visited": 5, "lines_inserted": 1}
+    assert profiler.trace()["traceEvents"] == [outer, inner]
+
+
+def test_summary_and_write(profiler, tmpdir):
+    ''' The summary groups the events by file, phase and loop '''
+    with profiling.span("a.c", "file", file="a.c"):
+        with profiling.span("analysis", "phase", file="a.c"):
+            with profiling.span("analysis", "loop", file="a.c", line=3):
+                profiling.count("tokens_fetched", 4)
+            with profiling.span("AstIndex", "detail"):
+                pass
+    with profiling.span("compile"):
+        pass
+    other = profiling.Profiler()
+    with other.span("b.c", "file", file="b.c"):
+        other.count("tokens_fetched", 6)
+    profiler.extend(other.events)
+
+    summary = profiler.summary()
+    first, second = summary["files"]
+    assert first["file"] == "a.c"
+    assert list(first["phases"]) == ["analysis"]
+    assert first["loops"][0]["line"] == 3
+    assert first["loops"][0]["phase"] == "analysis"
+    assert first["loops"][0]["counters"] == {"tokens_fetched": 4}
+    assert second["counters"] == {"tokens_fetched": 6}
+    assert [event["name"] for event in summary["events"]] == ["compile"]
+    assert summary["counters"] == {"tokens_fetched": 10}
+
+    summary_file, trace_file = profiler.write(os.path.join(str(tmpdir), "prof"))
+    with open(summary_file, "r") as fobj:
+        assert json.load(fobj) == summary
+    with open(trace_file, "r") as fobj:
+        assert len(json.load(fobj)["traceEvents"]) == 6
+
+
+def test_transformation_profile(profiler, tmpdir):
+    ''' The transformation records the file, its phases and each loop '''
+    input_file = os.path.join(str(tmpdir), "input.c")
+    output_file = os.path.join(str(tmpdir), "output.c")
+    with open(input_file, "w") as source:
+        source.write(
+            "int main(int argc, char** argv){\n"
+            "    int a = argc, s = 0;\n"
+            "    for(int i = 0; i < a; i++){\n"
+            "        s = s + i;\n"
+            "    }\n"
+            "    return s;\n"
+            "}\n")
+    InjectDoping(input_file, output_file).apply()
+
+    report, = profiler.summary()["files"]
+    assert report["file"] == input_file
+    assert list(report["phases"]) == ["parse", "analysis", "edit", "save"]
+    assert [(loop["phase"], loop["line"]) for loop in report["loops"]] == \
+        [("analysis", 3), ("edit", 3)]
+    assert report["loops"][1]["transformed"]
+    for counter in ("nodes_visited", "tokens_fetched", "lines_inserted"):
+        assert report["counters"][counter] > 0
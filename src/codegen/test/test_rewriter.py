@@ -2,8 +2,9 @@
 ''' Py.test tests for the Rewriter class as implemented in Rewriter.py '''
 
 import os
+import random
 import pytest
-from codegen.rewriter import Rewriter
+from codegen.rewriter import Rewriter, PieceTableRewriter, FenwickTree
 
 
 @pytest.fixture
@@ -159,3 +160,101 @@ def test_goto_original_line_integration(sample_rewriter_modified):
     assert sample_rewriter_modified._cursor == 3, str(sample_rewriter_modified._content)
     sample_rewriter_modified.goto_original_line(3)
     assert sample_rewriter_modified._cursor == 4, str(sample_rewriter_modified._content)
+
+
+def test_fenwick_tree():
+    ''' Prefix sums and searches of the FenwickTree '''
+    values = [1, 0, 3, 2, 0, 1]
+    tree = FenwickTree(values)
+    for index in range(len(values) + 1):
+        assert tree.prefix_sum(index) == sum(values[:index])
+    assert [tree.lower_bound(value) for value in range(1, 8)] == [0, 2, 2, 2, 3, 3, 5]
+    tree.add(1, 2)
+    assert tree.prefix_sum(2) == 3
+    assert tree.lower_bound(2) == 1
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_piece_table_rewriter(tmpdir, seed):
+    ''' The PieceTableRewriter gives the same results than the Rewriter
+    for a random sequence of operations '''
+    filename = os.path.join(str(tmpdir), "test.txt")
+    with open(filename, "w") as fobj:
+        fobj.write("\n".join("Original" + str(i) for i in range(1, 31)))
+    reference = Rewriter(os.path.join(str(tmpdir), "reference.txt"))
+    reference.load(filename)
+    rewriter = PieceTableRewriter(os.path.join(str(tmpdir), "rewriter.txt"))
+    rewriter.load(filename)
+
+    rng = random.Random(seed)
+    for step in range(300):
+        operation = rng.choice(["insert", "insert", "insertpl", "delete",
+                                "replace", "comment", "indent"])
+        # The Rewriter can not delete the last line or insert after it
+        line = rng.randint(1, len(reference._content) - 1)
+        # The original lines that have been deleted are not compared, as
+        # the Rewriter deltas of deleted lines are not always updated
+        existing = [number for number in range(1, reference._original_num_lines + 1)
+                    if rewriter._original[number - 1] is not None]
+        if rng.random() < 0.5 and existing:
+            original = rng.choice(existing)
+            reference.goto_original_line(original)
+            rewriter.goto_original_line(original)
+            if reference._cursor >= len(reference._content):
+                continue
+        else:
+            reference.goto_line(line)
+            rewriter.goto_line(line)
+        assert rewriter.get_line() == reference.get_line()
+        assert rewriter.get_content() == reference.get_content()
+        if operation == "indent":
+            for obj in (reference, rewriter):
+                obj.increase_indexation() if step % 3 else obj.decrease_indexation()
+        elif operation == "insertpl" and reference.get_line() > 1:
+            reference.insertpl("pl" + str(step))
+            rewriter.insertpl("pl" + str(step))
+        elif operation in ("insert", "replace"):
+            getattr(reference, operation)("New" + str(step))
+            getattr(rewriter, operation)("New" + str(step))
+        elif operation in ("delete", "comment"):
+            getattr(reference, operation)()
+            getattr(rewriter, operation)()
+        assert rewriter.get_line() == reference.get_line()
+
+    for original in existing:
+        reference.goto_original_line(original)
+        rewriter.goto_original_line(original)
+        assert rewriter.get_line() == reference.get_line()
+    reference.save()
+    rewriter.save()
+    with open(reference._filename) as expected, open(rewriter._filename) as result:
+        assert result.read() == expected.read()
+
+
+def test_piece_table_rewriter_empty_file(tmpdir):
+    ''' The PieceTableRewriter can write new files '''
+    rewriter = PieceTableRewriter(os.path.join(str(tmpdir), "empty.txt"))
+    rewriter.insert("Insert1")
+    rewriter.insert("Insert2")
+    rewriter.goto_line(1)
+    assert rewriter.get_content() == "Insert1"
+    rewriter.save()
+    with open(os.path.join(str(tmpdir), "empty.txt")) as result:
+        assert result.read() == "Insert1\nInsert2"
+
+
+def test_init_with_source(samplefile, tmpdir):
+    ''' A Rewriter with a source file only creates the output file when
+    it is saved, and replaces it atomically '''
+    fname = os.path.join(str(tmpdir), "output.txt")
+    for rewriter_class in (Rewriter, PieceTableRewriter):
+        obj = rewriter_class(fname, samplefile)
+        assert obj._original_num_lines == 3
+        assert not os.path.exists(fname)
+        obj.goto_line(2)
+        obj.insert("Insert1")
+        obj.save()
+        with open(fname) as result:
+            assert result.read() == "Original1\nInsert1\nOriginal2\nOriginal3"
+        assert sorted(os.listdir(str(tmpdir))) == ["output.txt", "test.txt"]
+        os.remove(fname)
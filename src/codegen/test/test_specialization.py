@@ -0,0 +1,66 @@
+''' Py.test tests for the build time precompilation of specializations as
+implemented in specialization.py '''
+
+import os
+import json
+import pytest
+from codegen.specialization import (Precompiler, parse_values, read_profile,
+                                    specializations)
+
+LOOP = {"name": "<SourceLocation file 'input.c', line 3, column 5>",
+        "source": "\nint function(){\n    return /*<DOPING n >*/ * /*<DOPING scale >*/;\n}\n",
+        "signature_format": "n:d,scale:f,doping_restrict_all:d",
+        "compiler_command": "gcc",
+        "restrict": False}
+
+
+def test_parse_values():
+    ''' Values are given as name=value pairs '''
+    assert parse_values("n=100, scale=1.5,") == {"n": "100", "scale": "1.5"}
+    assert parse_values("") == {}
+    with pytest.raises(ValueError):
+        parse_values("n:100")
+    with pytest.raises(ValueError):
+        parse_values("n=")
+
+
+def test_read_profile(tmpdir):
+    ''' The compiled specializations are read from the runtime events '''
+    events = os.path.join(str(tmpdir), "events.jsonl")
+    with open(events, "w") as fobj:
+        for event, parameters in (("compile", "n:1"), ("failure", "n:2"),
+                                  ("compile", "n:3"), ("compile", "n:1")):
+            fobj.write(json.dumps({"time": 0.1, "loop": "loop", "event": event,
+                                   "parameters": parameters}) + "\n")
+        fobj.write(json.dumps({"time": 0.2, "loop": "loop", "event": "run",
+                               "seconds": 0.1}) + "\n")
+    assert read_profile(events) == {"loop": ["n:1", "n:3"]}
+
+
+def test_specializations():
+    ''' The values of all the invariants of the loop are needed, the pointers
+    aliasing defaults to the value of non-aliasing pointers '''
+    values = [{"n": "10", "scale": "2"}, {"n": "5"},
+              {"n": "10", "scale": "2", "other": "1"}]
+    assert specializations(LOOP, values) == ["n:10,scale:2,doping_restrict_all:0"]
+    assert specializations(dict(LOOP, restrict=True), values) == \
+        ["n:10,scale:2,doping_restrict_all:1"]
+    profile = {LOOP["name"]: ["n:1,scale:1,doping_restrict_all:0"], "other": ["n:2"]}
+    assert specializations(LOOP, [{"n": "1", "scale": "1"}], profile) == \
+        ["n:1,scale:1,doping_restrict_all:0"]
+
+
+def test_precompile(tmpdir, request):
+    ''' Specializations are compiled into the given directory by the Doping
+    runtime library '''
+    if not request.config.getoption("--compile"):
+        pytest.skip("Needs --compile and the Doping runtime library")
+    library = os.path.join(os.environ['DOPING_ROOT'], 'bin', 'libdoping.so')
+    precompiler = Precompiler(library)
+    directory = os.path.join(str(tmpdir), "specializations")
+    assert precompiler.precompile(LOOP, "n:10,scale:2,doping_restrict_all:0", directory)
+    assert len(os.listdir(directory)) == 1
+    # The same values written differently give the same specialization
+    assert precompiler.precompile(LOOP, "n:10,scale:2.0,doping_restrict_all:0", directory)
+    assert len(os.listdir(directory)) == 1
+    assert not precompiler.precompile(LOOP, "n:10", directory)
@@ -5,8 +5,10 @@ implemented in transformations/inject_doping.py '''
 
 import os
 import re
+import json
 import pytest
 from codegen.transformations import InjectDoping
+from codegen.rewriter import PieceTableRewriter
 
 
 class TestInjectDoping:
@@ -161,13 +163,15 @@ class TestInjectDoping:
         )
         assert re.search(regexpr, output_source)
 
-        # It creates a new scope and initializes dopingRuntimeVal with the invariant
+        # It creates a new scope with the call site slot and initializes the
+        # dopingRuntimeVal signature with the invariant
         regexpr = (
             re.escape(
                 "//  ---- New version: ----\n"
                 "{  // start a doping scope\n"
-                "char dopingRuntimeVal_1[100];\n"
-                "sprintf(dopingRuntimeVal_1,  \"constvar:%d\",  constvar);"
+                "static void * dopingCallSite_1 = NULL;\n"
+                "struct { long long constvar; long long doping_restrict_all; } "
+                "dopingRuntimeVal_1 = {(long long)constvar, 0};\n"
             )
         )
         assert re.search(regexpr, output_source)
@@ -184,7 +188,12 @@ class TestInjectDoping:
         regexpr = (
             re.escape(
                 "    .compiler_command = \"" + compiler.flags + "\",\n"
-                "    .parameters = dopingRuntimeVal_1,\n"
+            ) + "    .name = .*\n" + re.escape(
+                "    .signature = &dopingRuntimeVal_1,\n"
+                "    .signature_size = sizeof(dopingRuntimeVal_1),\n"
+                "    .signature_format = \"constvar:d,doping_restrict_all:d\",\n"
+                "    .call_site = &dopingCallSite_1,\n"
+                "};\n"
             )
         )
         assert re.search(regexpr, output_source)
@@ -198,7 +207,8 @@ class TestInjectDoping:
                 "while(dopingRuntime(i, i < 10, &info1, NULL )){\n"
                 "  \n"
                 "  // Unmodified loop\n"
-                "  for(; (i < 10  ); i ++) {\n"
+                "  for(long dopingChunk_1 = info1.chunk_size; (i < 10  ) && dopingChunk_1-- > 0;"
+                " i ++) {\n"
             )
         )
         assert re.search(regexpr, output_source)
@@ -285,6 +295,32 @@ class TestInjectDoping:
         )
         assert re.search(regexpr, output_source)
 
+    def test_pragmas_are_not_shared(self, tmpdir, input_file, output_file):
+        ''' Test that the loop pragmas found in one file are not re-used by
+        transformations of other files '''
+
+        with open(input_file, "w") as source:
+            source.write(
+                '''
+                int main(){
+                    int constvar = 3;
+                    #pragma omp simd
+                    for(int i=0; i<10; i++){
+                        constvar = constvar + 1;
+                    }
+                    return 0;
+                }
+                '''
+            )
+        other_file = os.path.join(str(tmpdir), "other.c")
+        with open(other_file, "w") as source:
+            source.write("int main(){ return 0; }\n")
+
+        doping_trans = InjectDoping(input_file, output_file)
+        other_trans = InjectDoping(other_file, output_file)
+        assert 5 in doping_trans._for_loop_pragmas
+        assert not other_trans._for_loop_pragmas
+
     def test_dynamic_code_simple_loop(self, input_file, output_file, capsys, compiler):
         ''' Test a loop containing a runtime invariant '''
 
@@ -390,6 +426,42 @@ class TestInjectDoping:
         assert "#define LOOPDONE" in dynopt_code[dynopt_start:]
         assert "#define LASTDEFINE" in dynopt_code[dynopt_start:]
 
+    def test_dynamic_code_without_pragmas(self, input_file, output_file, compiler):
+        ''' Test that indented pragmas outside the loop, e.g. an OpenMP
+        parallel region that calls the function, are not replicated in the
+        dynamically compiled region.'''
+
+        with open(input_file, "w") as source:
+            source.write(
+                '''
+                #include<stdio.h>\n
+                int work(int n){\n
+                    int sum = 0;\n
+                    for(int i=0; i<n; i++){\n
+                        sum = sum + i;\n
+                    }\n
+                    return sum;\n
+                }\n
+                int main(){\n
+                    int total = 0;\n
+                    #pragma omp parallel reduction(+:total)\n
+                    total = work(10);\n
+                    return total;\n
+                }\n
+                '''
+            )
+
+        doping_trans = InjectDoping(input_file, output_file, compiler.flags)
+        doping_trans.apply()
+
+        with open(output_file, "r") as source:
+            output_source = source.read()
+
+        dynopt_code = self._filter_dyn_code(output_source)
+        print(dynopt_code)
+        assert "void function(" in dynopt_code
+        assert "pragma" not in dynopt_code
+
     def test_dynamic_code_function_calls(self, input_file, output_file, capsys, compiler):
         ''' Test a loop containing a runtime invariant and a function call inside the
         dynamically compiled region.'''
@@ -588,3 +660,186 @@ class TestInjectDoping:
         assert compiler.compile(output_file)
         assert compiler.run(match="Rendering template, compilation and linking took:",
                             verbosity=2)
+
+    def test_multiple_loops_saved_once(self, input_file, output_file, monkeypatch):
+        ''' All the loops are analysed and transformed before the output file
+        is written, and it is only written once. '''
+
+        with open(input_file, "w") as source:
+            source.write(
+                '''
+                int main(int argc, char ** argv){
+                    int a = argc, b = argc * 2, s = 0;
+                    for(int i=0; i<10; i++){
+                        s += a;
+                    }
+                    for(int i=0; i<10; i++){
+                        s += 1;
+                    }
+                    for(int i=0; i<10; i++){
+                        s += b;
+                    }
+                    return s;
+                }
+                '''
+            )
+
+        saves = []
+        original_save = PieceTableRewriter.save
+
+        def counting_save(rewriter):
+            saves.append(rewriter)
+            original_save(rewriter)
+
+        monkeypatch.setattr(PieceTableRewriter, "save", counting_save)
+        doping_trans = InjectDoping(input_file, output_file)
+        result = doping_trans.apply()
+        assert [transformed for _, transformed in result] == [True, False, True]
+        assert len(saves) == 1
+        assert sorted(doping_trans.get_timings()) == ["analysis", "edit", "parse", "save"]
+        with open(output_file) as output:
+            assert output.read().count("dopingRuntime(") == 2
+        # The temporary file has been renamed
+        assert sorted(os.listdir(os.path.dirname(output_file))) == ["input.c", "output.c"]
+
+    def test_get_loops(self, input_file, output_file):
+        ''' The transformed loops are described with the same source template
+        and signature format given to the runtime. '''
+
+        with open(input_file, "w") as source:
+            source.write(
+                '''
+                #include<stdio.h>
+                int main(int argc, char ** argv){
+                    int constvar = argc;
+                    for(int i=0; i<10; i++){
+                        printf("The const is %d.\\n", constvar);
+                    }
+                    for(int i=0; i<10; i++){
+                        printf("Not transformed");
+                    }
+                    return 0;
+                }
+                '''
+            )
+
+        doping_trans = InjectDoping(input_file, output_file, "gcc -O2")
+        doping_trans.apply()
+        loops = doping_trans.get_loops()
+        assert len(loops) == 1
+        assert "line 5" in loops[0]["name"]
+        assert loops[0]["signature_format"] == "constvar:d,doping_restrict_all:d"
+        assert loops[0]["compiler_command"] == "gcc -O2"
+        assert not loops[0]["restrict"]
+        # The C literals are unescaped
+        assert loops[0]["source"].startswith("\n#include <stdarg.h>\n")
+        assert 'printf("The const is %d.\\n", constvar);\n' in loops[0]["source"]
+        assert "const int constvar = /*<DOPING constvar >*/;\n" in loops[0]["source"]
+        # The loop header literal has no line break
+        assert "i < 10; i ++){\n" in loops[0]["source"]
+
+    def test_get_loops_escaped_source(self, input_file, output_file):
+        ''' The source of the transformed loops is the template as written
+        in the file, including quotes and escape sequences '''
+
+        body = r'printf("\"%d\" \\n\n", constvar);'
+        with open(input_file, "w") as source:
+            source.write(
+                '''
+                #include<stdio.h>
+                int main(int argc, char ** argv){
+                    int constvar = argc;
+                    for(int i=0; i<10; i++){
+                        ''' + body + '''
+                    }
+                    return 0;
+                }
+                '''
+            )
+
+        doping_trans = InjectDoping(input_file, output_file, "gcc -O2")
+        doping_trans.apply()
+        loops = doping_trans.get_loops()
+        assert len(loops) == 1
+        assert body + "\n" in loops[0]["source"]
+
+    def test_loop_selection(self, input_file, output_file, capsys):
+        ''' The dose and the profile choose which loops are transformed '''
+
+        with open(input_file, "w") as source:
+            source.write(
+                '''int main(int argc, char ** argv){
+                    int a = argc, s = 0;
+                    for(int i=0; i<10; i++){
+                        s += a;
+                    }
+                    #pragma doping
+                    for(int i=0; i<10; i++){
+                        s += a;
+                    }
+                    return s;
+                }
+                '''
+            )
+
+        class Profile:
+            ''' Profile that selects the loops of the given lines '''
+            def __init__(self, lines):
+                self.lines = lines
+                self.doses = []
+
+            def select(self, name, dose):
+                ''' Select the loops by line '''
+                self.doses.append(dose)
+                selected = any("line {0},".format(x) in name for x in self.lines)
+                return selected, "test"
+
+        def transformed(**kwargs):
+            doping_trans = InjectDoping(input_file, output_file, **kwargs)
+            result = doping_trans.apply()
+            return [applied for _, applied in result]
+
+        assert transformed() == [True, True]
+        assert transformed(dose=0) == [False, True]
+        capsys.readouterr()
+        profile = Profile([3])
+        assert transformed(dose=2, profile=profile) == [True, False]
+        assert profile.doses == [2, 2]
+        assert "Not selected by the profile, test." in capsys.readouterr().out
+        # The pragma is required with dose 0 even if the loop is hot
+        assert transformed(dose=0, profile=profile) == [False, True]
+
+    def test_recorded_iterations(self, input_file, output_file, compiler, request,
+                                 monkeypatch, tmpdir):
+        ''' The runtime trace of a recorded execution counts all the
+        iterations of the transformed loop '''
+        if not request.config.getoption("--compile"):
+            pytest.skip("Needs --compile and the Doping runtime library")
+
+        with open(input_file, "w") as source:
+            source.write(
+                '''int sum(int a){
+                    int s = 0;
+                    for(int i=0; i<50; i++){
+                        s += a;
+                    }
+                    return s;
+                }
+                int main(int argc, char ** argv){
+                    return sum(argc) + sum(argc) == 200 ? 0 : 1;
+                }
+                '''
+            )
+
+        doping_trans = InjectDoping(input_file, output_file, compiler.flags)
+        assert doping_trans.apply()[0][1]
+        trace = os.path.join(str(tmpdir), "trace.json")
+        monkeypatch.setenv("DOPING_POLICY", "record")
+        monkeypatch.setenv("DOPING_TRACE", trace)
+        assert compiler.compile(output_file)
+        assert compiler.run()
+        with open(trace, "r") as fobj:
+            loops = json.load(fobj)["loops"]
+        assert len(loops) == 1
+        assert loops[0]["executions"] == 2
+        assert loops[0]["iterations"] == 100
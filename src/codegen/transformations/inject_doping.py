@@ -1,19 +1,32 @@
 """ Implementation of InjectDoping transformation """
 
 import os
+from collections import namedtuple
+from codegen import profiling
 from codegen.transformations.transformation import CodeTransformation
 
+# Result of the static analysis of a loop, used to transform it. The template
+# collects the lines of the dynamic function source while they are inserted.
+LoopAnalysis = namedtuple("LoopAnalysis", ["local_vars", "pointers", "written_scalars",
+                                           "runtime_invariants", "fcalls", "template"])
+
 
 class InjectDoping(CodeTransformation):
-    """ InjectDoping Transformation """
+    """ InjectDoping Transformation. The dose chooses which loops are
+    transformed: with 0 only the loops marked with '#pragma doping', with 1
+    or 2 the loops selected by the profile (see LoopProfile.select) if one
+    is given, and with 3 all the loops that support it. """
     # pylint: disable=too-few-public-methods, too-many-instance-attributes,
     # pylint: disable=too-many-statements, too-many-branches
 
-    def __init__(self, inputfile, outputfile, compiler_command="", is_cpp=False):
-        super().__init__(inputfile, outputfile, compiler_command)
+    def __init__(self, inputfile, outputfile, compiler_command="", is_cpp=False,
+                 dose=1, profile=None, preamble_cache=True):
+        super().__init__(inputfile, outputfile, compiler_command, preamble_cache)
         self.compiler_command = compiler_command
         self._loop_id = 0
         self._is_cpp = is_cpp
+        self._dose = dose
+        self._profile = profile
 
         # Globals shared between methods
         self._local_vars = None
@@ -21,6 +34,17 @@ class InjectDoping(CodeTransformation):
         self._written_scalars = None
         self._runtime_invariants = None
         self._fcalls = None
+        self._template = None
+
+        # Description of each transformed loop, see get_loops()
+        self._loops = []
+
+    def get_loops(self):
+        """ Return a list with a dictionary describing each loop transformed
+        by apply(): its name, the source template and signature format given
+        to the runtime, the compiler command and whether the pointers aliasing
+        is checked at runtime (doping_restrict_all). """
+        return list(self._loops)
 
     def _candidates(self):
         return self._ast.find_loops(outermostonly=True, exclude_headers=True)
@@ -35,9 +59,22 @@ class InjectDoping(CodeTransformation):
                 print("DISCARDED by DOPING_BENCHMARK (from 910 to 5584)")
                 return False
 
+        # Select the loops before analysing them
+        if self._dose == 0:
+            if "doping" not in self._for_loop_pragmas.get(node.location.line, "").split():
+                print("    > Not marked with '#pragma doping'.\n")
+                return False
+        elif self._profile is not None:
+            selected, reason = self._profile.select(str(node.location), self._dose)
+            if not selected:
+                print("    > Not selected by the profile, " + reason + ".\n")
+                return False
+            print("    > Selected by the profile, " + reason + ".")
+
         # Analyse the loop variables
-        local_vars, pointers, written_scalars, runtime_constants = \
-            node.variable_analysis()
+        with profiling.span("variable_analysis", "detail"):
+            local_vars, pointers, written_scalars, runtime_constants = \
+                node.variable_analysis()
 
         # Analyse the function calls
         fcalls = [x for x in node.find_calls()]
@@ -51,15 +88,16 @@ class InjectDoping(CodeTransformation):
 
         print("    > Creating dynamically optimized version of the loop.\n")
 
-        self._local_vars = local_vars
-        self._pointers = pointers
-        self._written_scalars = written_scalars
-        self._runtime_invariants = runtime_constants
-        self._fcalls = fcalls
+        return LoopAnalysis(local_vars, pointers, written_scalars,
+                            runtime_constants, fcalls, [])
 
-        return True
-
-    def _apply(self, node):
+    def _apply(self, node, analysis):
+        self._local_vars = analysis.local_vars
+        self._pointers = analysis.pointers
+        self._written_scalars = analysis.written_scalars
+        self._runtime_invariants = analysis.runtime_invariants
+        self._fcalls = analysis.fcalls
+        self._template = analysis.template
 
         # Get a unique id to this loop for this transformation
         self._loop_id = self._loop_id + 1
@@ -74,37 +112,40 @@ class InjectDoping(CodeTransformation):
             struct_type = "dopinginfoU"
             rtfunc_name = "dopingRuntimeU"
 
-        # We will need to generate a string of values of the runtime invariants with
-        # an sprintf call, e.g: `sprintf(dopingRuntimeVal_X, "A:%d,B:%f", A, B);`. So
-        # we check that we can populate the format and parameters list here, otherwise
-        # we refuse to optimize the loop.
+        # The values of the runtime invariants are packed into a struct of 8-byte
+        # members (so it has no padding), e.g:
+        # `struct { long long A; double B; } dopingRuntimeVal_X = {A, B};`.
+        # The runtime compares and hashes it as binary data and only formats
+        # it as text when it needs to render a new specialization. So we check
+        # that we can pack all the invariants here, otherwise we refuse to
+        # optimize the loop.
+        members_list = []
         format_list = []
-        parameters_list = []
+        values_list = []
         for var in self._runtime_invariants:
-            format_specifier = None
             if var.type.spelling in ('int', 'short', 'long'):
-                format_specifier = "%d"
+                member_type, kind = "long long", "d"
             elif var.type.spelling in ('unsigned int', 'unsigned long'):
-                format_specifier = "%u"
-            elif var.type.spelling in ('float',):
-                format_specifier = "%f"
-            elif var.type.spelling in ('double',):
-                format_specifier = "%lf"
+                member_type, kind = "long long", "u"
+            elif var.type.spelling in ('float', 'double'):
+                member_type, kind = "double", "f"
             else:
                 print("    > Tried dynamic optimization but found unsupported"
                       " type: {0}.\n".format(var.type.spelling))
                 return False
-            format_list.append(var.displayname + ":" + format_specifier)
-            parameters_list.append(var.displayname)
+            members_list.append(member_type + " " + var.displayname + ";")
+            format_list.append(var.displayname + ":" + kind)
+            values_list.append("(" + member_type + ")" + var.displayname)
 
-        format_list.append("doping_restrict_all:%d")
+        members_list.append("long long doping_restrict_all;")
+        format_list.append("doping_restrict_all:d")
         if len(self._pointers) > 1 and node.guarantee_non_aliasing_of(self._pointers):
             # TODO: We also need to test that is not in the range from start to iteration end!
             base = self._pointers[0].displayname
             cmp_address_string = " && ".join([base + "!=" + var.displayname for var in self._pointers[1:]])
-            parameters_list.append(cmp_address_string)
+            values_list.append("(long long)(" + cmp_address_string + ")")
         else:
-            parameters_list.append("0")
+            values_list.append("0")
         # TODO: Could also add an alignment check!
 
         # Include doping runtime at the top if it doesn't exist already
@@ -112,7 +153,6 @@ class InjectDoping(CodeTransformation):
         include_string = "#include \"doping.h\""
         if self._buffer.get_content() != include_string:
             self._buffer.insert(include_string)
-            self._buffer.insert("#include <stdio.h>")
 
         # Comment old code
         self._buffer.goto_original_line(node.get_start())
@@ -126,19 +166,18 @@ class InjectDoping(CodeTransformation):
         self._buffer.insert("//  ---- New version: ----")
         self._buffer.insert("{  // start a doping scope")
 
-        # Convert runtime constant values into strings with sprintf
+        # The call site slot is where the runtime keeps the last specialization
+        # used by this loop, so repeated entries with the same values don't
+        # need to search it again.
+        call_site_string = "dopingCallSite_" + str(self._loop_id)
+        self._buffer.insert("static void * " + call_site_string + " = NULL;")
+
+        # Pack the runtime constant values into the signature struct
         # e.g:
-        #     char dopingRuntimeVal_X[100];
-        #     sprintf(dopingRuntimeVal_X, "A:%d,B:%f", A, B);
-
-        # Create Unique string identifier
-        parameters_string = "dopingRuntimeVal_" + str(self._loop_id)
-        # Declare the string (array of char)
-        self._buffer.insert("char " + parameters_string + "[300];")
-        # Ensemble the sprinf call
-        self._buffer.insert("sprintf(" + parameters_string + ", ")
-        self._buffer.insertpl("\""+",".join(format_list) + "\", ")
-        self._buffer.insertpl(", ".join(parameters_list) + ");")
+        #     struct { long long A; double B; } dopingRuntimeVal_X = {(long long)A, (double)B};
+        signature_string = "dopingRuntimeVal_" + str(self._loop_id)
+        self._buffer.insert("struct { " + " ".join(members_list) + " } " +
+                            signature_string + " = {" + ", ".join(values_list) + "};")
 
         # Generate the dopinginfo object
         self._buffer.insert(struct_type + " info" + str(self._loop_id) + " = {")
@@ -147,12 +186,21 @@ class InjectDoping(CodeTransformation):
         self._buffer.insert("    .source = " + r'''"\n"''')
         # Insert the dynamic template of the code here (return the args that it will need)
         list_of_args = self._generate_dynamic_function(node, iteration_type)
+        self._loops.append({
+            "name": str(node.location),
+            "source": "\n" + "".join(self._template),
+            "signature_format": ",".join(format_list),
+            "compiler_command": self.compiler_command,
+            "restrict": values_list[-1] != "0"})
         self._buffer.insertpl(",")
         # Continue dopinginfo object
         self._buffer.insert("    .compiler_command = " + "\"" +
                             self.compiler_command + "\"" + ",")
-        self._buffer.insert("    .parameters = " + parameters_string + ",")
         self._buffer.insert("    .name = \"" + str(node.location) + "\",")
+        self._buffer.insert("    .signature = &" + signature_string + ",")
+        self._buffer.insert("    .signature_size = sizeof(" + signature_string + "),")
+        self._buffer.insert("    .signature_format = \"" + ",".join(format_list) + "\",")
+        self._buffer.insert("    .call_site = &" + call_site_string + ",")
         self._buffer.insert("};")
 
         # Convert the loop into a while construct
@@ -184,9 +232,14 @@ class InjectDoping(CodeTransformation):
         if node.location.line in self._for_loop_pragmas:
             self._buffer.insert(self._for_loop_pragmas[node.location.line])
 
-        self._buffer.insert("for(; (" + node.end_condition_string())
+        # The baseline loop returns to the runtime after info.chunk_size
+        # iterations, this allows the runtime to switch to a specialized
+        # version in the middle of the iteration space.
+        chunk_string = "dopingChunk_" + str(self._loop_id)
+        self._buffer.insert("for(long " + chunk_string + " = info" + str(self._loop_id) +
+                            ".chunk_size; (" + node.end_condition_string())
         # self._buffer.insertpl(" ) && time(NULL) < "+timevar+";")
-        self._buffer.insertpl(" );")
+        self._buffer.insertpl(" ) && " + chunk_string + "-- > 0;")
         self._buffer.insertpl(node.increment_string() + ")")
         self._buffer.increase_indexation()
         self._buffer.insertpl(node.body_string())  # This breaks indentation
@@ -213,7 +266,7 @@ class InjectDoping(CodeTransformation):
                         continue
                     # FIXME: What about multi-line (symbol \ continuation)
                     # FIXME: Are some #pragma necessary (e.g. #pragma once)?
-                    if not line.startswith('#pragma'):
+                    if not line.replace(" ", "").startswith('#pragma'):
                         if lnum < node.location.line - 1:
                             before.append(line)
                         else:
@@ -235,20 +288,20 @@ class InjectDoping(CodeTransformation):
         method = "method2"
 
         # Required libs
-        self._buffer.insertstr("#include <stdarg.h>")
+        self._insert_template("#include <stdarg.h>")
         remove_other_includes = False
 
         if method == "method2":
             cwd = os.getcwd()
             incpath = os.path.join(cwd, node.location.file.name)
-            self._buffer.insertstr(f"#include \"{incpath}\"")
+            self._insert_template(f"#include \"{incpath}\"")
             remove_other_includes = True
 
         # Replicate preprocessor macros until this point
         before, after = self._replicate_preprocessor(node, remove_other_includes)
 
         for line in before:
-            self._buffer.insertstr(line.replace('\n', ''))  # Remove \n
+            self._insert_template(line.replace('\n', ''))  # Remove \n
 
         if method == "method1":
 
@@ -266,7 +319,7 @@ class InjectDoping(CodeTransformation):
                           f"{func_def.location}")
 
                     # FIXME: In AO func_def.spelling != func_def.get_tokens() !??
-                    tokens = [x.spelling for x in func_def.get_tokens()]
+                    tokens = func_def.get_token_spellings()
                     attributes = []
                     # if tokens:
                     #    attributes.extend(tokens[:tokens.index(func.spelling)])
@@ -283,16 +336,16 @@ class InjectDoping(CodeTransformation):
                     if func_def not in inlined_functions:
                         inlined_functions.append(func_def)
                     for line in func_def.get_string().split('\n'):
-                        self._buffer.insertstr(line)
+                        self._insert_template(line)
                     continue
                     if 'static' in attributes or 'inline' in attributes:
                         # FIXME: Check for function calls also inside func
                         for line in func_def.get_string().split('\n'):
-                            self._buffer.insertstr(line)
+                            self._insert_template(line)
                     else:
                         # Insert just the function signature
-                        self._buffer.insertstr(func_def.result_type.spelling + " " +
-                                               func_def.displayname + ";")
+                        self._insert_template(func_def.result_type.spelling + " " +
+                                              func_def.displayname + ";")
                 else:
                     found = False
                     for file_func_decl in self._ast.find_functions():
@@ -305,7 +358,7 @@ class InjectDoping(CodeTransformation):
 
                             # Insert just the function signature
                             for line in file_func_decl.get_string().split('\n'):
-                                self._buffer.insertstr(line)
+                                self._insert_template(line)
 
                             print("    - Only the function signature of ", func.spelling,
                                   " was found!")
@@ -316,12 +369,12 @@ class InjectDoping(CodeTransformation):
 
         # Always use the C ABI
         if self._is_cpp:
-            self._buffer.insertstr(r'extern "C" void function(')
+            self._insert_template(r'extern "C" void function(')
         else:
-            self._buffer.insertstr(r"void function(")
+            self._insert_template(r"void function(")
 
-        self._buffer.insertstr(iteration_type + " dopingCurrentIteration,")
-        self._buffer.insertstr("va_list args){")
+        self._insert_template(iteration_type + " dopingCurrentIteration,")
+        self._insert_template("va_list args){")
 
         # TODO: Pass arguments by reference and use statement below ?
         # https://wiki.sei.cmu.edu/confluence/display/c/MSC39-C.+Do+not+call+
@@ -339,10 +392,10 @@ class InjectDoping(CodeTransformation):
                 qualifier = "constexpr "
             else:
                 qualifier = "const "
-            self._buffer.insertstr(qualifier + invar.type.spelling + " " +
-                                   invar.displayname +
-                                   " = /*<DOPING " +
-                                   invar.displayname + " >*/;")
+            self._insert_template(qualifier + invar.type.spelling + " " +
+                                  invar.displayname +
+                                  " = /*<DOPING " +
+                                  invar.displayname + " >*/;")
 
         # Get pointers or arrays used in the loop
         list_of_va_args = []
@@ -365,8 +418,8 @@ class InjectDoping(CodeTransformation):
             # Write a conditional Doping string to add __restrict when possible
             restrict_string = " /*<DOPING_IF doping_restrict_all __restrict__ >*/ "
 
-            self._buffer.insertstr(pointer_type + restrict_string + pointer.displayname +
-                                   " = va_arg(args, " + va_type + ");")
+            self._insert_template(pointer_type + restrict_string + pointer.displayname +
+                                  " = va_arg(args, " + va_type + ");")
             # self._buffer.insertstr(pointer.displayname + " = (" + pointer_type + ")" +
             #        "__builtin_assume_aligned(" + pointer.displayname + ",64);")
             list_of_va_args.append(pointer.displayname)
@@ -378,40 +431,50 @@ class InjectDoping(CodeTransformation):
         ref_vars = []
         for var in self._written_scalars:
             vtype = var.type.spelling + "*"  # Add pointer indetifier
-            self._buffer.insertstr(vtype + " " + var.displayname + "_dopingglobal" +
-                                   " = va_arg(args, " + vtype + ");")
+            self._insert_template(vtype + " " + var.displayname + "_dopingglobal" +
+                                  " = va_arg(args, " + vtype + ");")
             list_of_va_args.append("&" + var.displayname)
             # FIXME: This assumes no aliasing in this scalar, this need proper runtime
             # checks.
-            self._buffer.insertstr(var.type.spelling + " " + var.displayname + " = " +
-                                   "(*" + var.displayname + "_dopingglobal);")
+            self._insert_template(var.type.spelling + " " + var.displayname + " = " +
+                                  "(*" + var.displayname + "_dopingglobal);")
             ref_vars.append(var.displayname)
 
         # If the loop had a pragma, insert it back
         if node.location.line in self._for_loop_pragmas:
-            self._buffer.insertstr(self._for_loop_pragmas[node.location.line])
+            self._insert_template(self._for_loop_pragmas[node.location.line])
 
-        self._buffer.insertstr_nolb(
+        self._insert_template(
             "for(" + node.cond_variable_type() + " " + node.cond_variable() +
             " = dopingCurrentIteration;" + node.end_condition_string() + "; " +
-            node.increment_string() + ")")
+            node.increment_string() + ")", line_break=False)
 
         # for line in node.body_string(referencing_variables=ref_vars).split("\n"):
         for line in node.body_string().split("\n"):
-            self._buffer.insertstr(line)
+            self._insert_template(line)
 
         for var in self._written_scalars:
-            self._buffer.insertstr("(*" + var.displayname + "_dopingglobal) = " +
-                                   var.displayname + ";")
-        self._buffer.insertstr('}')
+            self._insert_template("(*" + var.displayname + "_dopingglobal) = " +
+                                  var.displayname + ";")
+        self._insert_template('}')
 
         # There can be open pre-processor conditionals that need closing after
         # the function
         for line in after:
-            self._buffer.insertstr(line.replace("\n", ''))
+            self._insert_template(line.replace("\n", ''))
 
         return list_of_va_args
 
+    def _insert_template(self, string, line_break=True):
+        """ Insert a line of the dynamic function template in the buffer as
+        a C literal and record it in the template of the loop analysis. """
+        if line_break:
+            self._buffer.insertstr(string)
+            self._template.append(string + "\n")
+        else:
+            self._buffer.insertstr_nolb(string)
+            self._template.append(string)
+
     @staticmethod
     def _print_analysis(local_vars, pointers, written_scalars,
                         runtime_constants, fcalls):
@@ -1,4 +1,5 @@
-from codegen.rewriter import Rewriter
+from codegen import profiling
+from codegen.rewriter import PieceTableRewriter
 from codegen.ast.translation_unit import DopingTranslationUnit
 
 
@@ -6,45 +7,104 @@ class CodeTransformation:
 
     _inputfile = None
     _outputfile = None
+    _tu = None
     _ast = None
     _buffer = None
     _flags = None
+    _preamble_cache = True
     _for_loop_pragmas = {}
+    _timings = {}
 
-    def __init__(self, inputfile, outputfile, flags):
+    def __init__(self, inputfile, outputfile, flags, preamble_cache=True):
         self._inputfile = inputfile
         self._outputfile = outputfile
         self._flags = flags
+        # See the DopingTranslationUnit preamble_cache parameter
+        self._preamble_cache = preamble_cache
+        # Each transformation needs its own pragma map, otherwise pragmas
+        # from one file would be re-inserted in the loops of another file.
+        self._for_loop_pragmas = {}
         self._store_for_pragmas(inputfile)
 
     def apply(self):
-        print("Compilation parsing flags:", self._flags)
-        tu = DopingTranslationUnit(self._inputfile, self._flags)
-        self._ast = tu.get_root()
-        result = []
-        for loop in self._candidates():
-            if self._static_analysis(loop):
-                if self._buffer is None:
-                    self._buffer = Rewriter(self._outputfile)
-                    self._buffer.load(self._inputfile)
-
-                ret = self._apply(loop)
-                self._buffer.save()
-                result.append((loop.location, ret))
-            else:
-                result.append((loop.location, False))
+        ''' Apply the transformation in three phases: analyse all the
+        candidates, apply the edits of the valid ones to the rewrite buffer
+        and save the buffer once. Return a list with the location of each
+        candidate and whether it was transformed. '''
+        # The phases are always recorded, so get_timings() can report them,
+        # in a Profiler of their own if profiling is disabled.
+        profiler = profiling.get_profiler() or profiling.Profiler()
+        first_event = len(profiler.events)
+        with profiling.span(self._inputfile, "file", file=self._inputfile):
+            with profiler.span("parse", "phase", file=self._inputfile):
+                print("Compilation parsing flags:", self._flags)
+                self._tu = DopingTranslationUnit(self._inputfile, self._flags,
+                                                 self._preamble_cache)
+                self._ast = self._tu.get_root()
+
+            analyses = []
+            with profiler.span("analysis", "phase", file=self._inputfile):
+                for loop in self._candidates():
+                    with profiling.span("analysis", "loop", file=self._inputfile,
+                                        line=loop.location.line) as args:
+                        analysis = self._static_analysis(loop)
+                        args["candidate"] = bool(analysis)
+                    analyses.append((loop, analysis))
+
+            result = []
+            with profiler.span("edit", "phase", file=self._inputfile):
+                for loop, analysis in analyses:
+                    if analysis:
+                        if self._buffer is None:
+                            self._buffer = PieceTableRewriter(self._outputfile,
+                                                              self._inputfile)
+                        with profiling.span("edit", "loop", file=self._inputfile,
+                                            line=loop.location.line) as args:
+                            ret = self._apply(loop, analysis)
+                            args["transformed"] = bool(ret)
+                        result.append((loop.location, ret))
+                    else:
+                        result.append((loop.location, False))
+
+            with profiler.span("save", "phase", file=self._inputfile):
+                if self._buffer is not None:
+                    self._buffer.save()
+
+        self._timings = {event["name"]: event["dur"] / 1e6
+                         for event in profiler.events[first_event:]
+                         if event["cat"] == "phase"}
+        return result
+
+    def get_timings(self):
+        ''' Return a dictionary with the seconds spent in each phase of the
+        last apply(). '''
+        return dict(self._timings)
+
+    def dependencies(self):
+        ''' Return the files included by the transformed source file. It
+        must be called after apply(). '''
+        if self._tu is None:
+            return []
+        return self._tu.get_includes()
 
     def _candidates(self):
         raise NotImplementedError(
             "This is an abstract class, instantiate a subclass!"
         )
 
-    def _apply(self, node):
+    def _apply(self, node, analysis):
+        ''' Add the edits that transform the candidate node to the rewrite
+        buffer and return whether it was transformed. The analysis is the
+        result of _static_analysis(node), it is only applied when it is
+        true. '''
         raise NotImplementedError(
             "This is an abstract class, instantiate a subclass!"
         )
 
     def _static_analysis(self, node):
+        ''' Return the analysis of the candidate node needed by _apply, or
+        a false value if it can not be transformed. It must not modify the
+        rewrite buffer. '''
         raise NotImplementedError(
             "This is an abstract class, instantiate a subclass!"
         )
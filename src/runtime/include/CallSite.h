@@ -0,0 +1,56 @@
+#ifndef CALLSITE_H
+#define CALLSITE_H
+
+#include <cstring>
+#include <memory>
+#include <string>
+
+#include "CompilationQueue.h"
+
+class VersionTable;
+
+// Signature and specialization used by the last entry to a loop. Entries are
+// immutable, so threads can use an entry while another one replaces it.
+struct CallSiteEntry {
+    std::string signature;
+    std::shared_ptr<Specialization> spec;
+
+    CallSiteEntry(const void * signature, int size, std::shared_ptr<Specialization> spec)
+        : signature((const char *) signature, size), spec(spec){}
+    bool matches(const void * signature, int size) const {
+        return this->signature.size() == (size_t) size &&
+               std::memcmp(this->signature.data(), signature, size) == 0;
+    }
+};
+
+// Object referenced by the call_site slot of a dopinginfo, so following
+// entries with the same signature don't need to build a key and search the
+// functions table. The current entry is replaced atomically (read-copy-update)
+// and it lives as long as its VersionTable.
+struct CallSite {
+    std::shared_ptr<const CallSiteEntry> entry;
+    // Versions of the loop, it clears the call site if its version is evicted.
+    VersionTable * table;
+
+    CallSite(VersionTable * table = NULL) : table(table){}
+    std::shared_ptr<const CallSiteEntry> load() const {
+        return std::atomic_load(&this->entry);
+    }
+    void update(const void * signature, int size, std::shared_ptr<Specialization> spec){
+        std::atomic_store(&this->entry, std::shared_ptr<const CallSiteEntry>(
+            std::make_shared<CallSiteEntry>(signature, size, spec)));
+    }
+    void clear(){
+        std::atomic_store(&this->entry, std::shared_ptr<const CallSiteEntry>());
+    }
+};
+
+// Format a binary signature (see dopinginfo) as the "name:value,..."
+// parameters string used to render the source.
+std::string format_signature(const char * format, const void * signature, int size);
+
+// Build the binary signature described by the format from the values in a
+// "name:value,..." parameters string (the inverse of format_signature).
+std::string build_signature(const char * format, const std::string& parameters);
+
+#endif
@@ -0,0 +1,74 @@
+#ifndef COMPILATIONQUEUE_H
+#define COMPILATIONQUEUE_H
+
+#include <atomic>
+#include <condition_variable>
+#include <deque>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <thread>
+
+#include "DynamicFunction.h"
+
+class LoopTrace;
+
+enum SpecializationState {
+    PENDING = 0,
+    READY = 1,
+    FAILED = 2
+};
+
+// A specialization of a loop for a given set of parameters. It keeps a copy
+// of everything needed to build it, so it can be compiled after the loop
+// information is out of scope (e.g. by the background worker). It is shared
+// (std::shared_ptr) by the version table, the call sites and the threads
+// running it, so it is only deleted when nobody is using its library.
+struct Specialization {
+    std::string source;
+    std::string parameters;
+    std::string compiler_command;
+    DynamicFunction * df;
+    std::atomic<int> state;
+    double compile_time;
+    // Time that the remaining baseline iterations were predicted to take
+    // when it was decided to specialize the loop (negative if unknown).
+    double predicted_baseline_time;
+    std::atomic<long> runs;
+    // Number of times it has been selected and logical time of the last one,
+    // used by the VersionTable.
+    std::atomic<long> hits;
+    std::atomic<unsigned long> last_use;
+    // Runtime trace of the loop (NULL if tracing is disabled)
+    LoopTrace * trace;
+
+    Specialization(const std::string& source,
+                   const std::string& parameters,
+                   const std::string& compiler_command);
+    // Deleting the DynamicFunction unloads its library.
+    ~Specialization(){delete this->df;}
+    // Render, compile and link the specialization and update its state.
+    void compile();
+    bool is_ready(){return this->state.load(std::memory_order_acquire) == READY;}
+    bool is_pending(){return this->state.load(std::memory_order_acquire) == PENDING;}
+};
+
+// Queue of specializations compiled by a background worker thread.
+class CompilationQueue {
+
+    std::deque<std::shared_ptr<Specialization> > jobs;
+    std::mutex mutex;
+    std::condition_variable condition;
+    std::thread worker;
+    bool stop;
+
+    void work();
+
+    public:
+        CompilationQueue();
+        ~CompilationQueue();
+        static CompilationQueue& instance();
+        void enqueue(std::shared_ptr<Specialization> specialization);
+};
+
+#endif
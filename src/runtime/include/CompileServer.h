@@ -0,0 +1,109 @@
+#ifndef COMPILESERVER_H
+#define COMPILESERVER_H
+
+#include <atomic>
+#include <condition_variable>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+
+#include "CompilerBackend.h"
+#include "SpecializationCache.h"
+
+
+// Compilation in progress in the server, the requests for the same
+// specialization wait for it instead of compiling it again.
+struct CompileJob {
+    bool done;
+    bool compiled;
+    std::string path;
+    std::string output;
+    std::mutex mutex;
+    std::condition_variable condition;
+
+    CompileJob() : done(false), compiled(false){}
+};
+
+// Local compilation server shared by all the processes of a user in a node
+// (e.g. MPI ranks). It listens in a Unix socket for rendered sources,
+// compiles each distinct specialization only once (even if it is requested
+// concurrently) and answers with the path of the library, which is kept in
+// a SpecializationCache directory. It exits after idle_timeout seconds
+// without requests. It refuses to use directories that other users can
+// write in, and only serves requests of the same user. Each compilation
+// runs a new compiler process, they are not kept warm between requests.
+class CompileServer {
+
+    std::string socket_path;
+    SpecializationCache cache;
+    double idle_timeout;
+    int listen_fd;
+    int lock_fd;
+    std::atomic<bool> stopping;
+    std::atomic<int> connections;
+    std::atomic<long> compilations;
+    // Time of the last request (milliseconds of a steady clock)
+    std::atomic<long> last_request;
+    std::mutex jobs_mutex;
+    std::map<std::string, std::shared_ptr<CompileJob> > jobs;
+
+    void handle(int fd);
+    void compile(const std::string& source, const std::string& compilercmd,
+                 const std::string& key, CompileJob& job);
+
+    public:
+        CompileServer(const std::string& socket_path,
+                      const std::string& cache_directory,
+                      double idle_timeout);
+        ~CompileServer();
+        // Listen in the socket, it returns false if another server is
+        // already using it.
+        bool start();
+        // Serve requests until it is stopped or idle for too long.
+        void serve();
+        void stop(){this->stopping = true;}
+        // Number of specializations compiled (not found in the cache)
+        long get_compilations(){return this->compilations;}
+};
+
+// Backend that sends the sources to the CompileServer listening in
+// socket_path. If there is no server and spawn is true, it starts one
+// (the doping_server executable) and waits for it.
+class ServerBackend : public CompilerBackend {
+
+    std::string socket_path;
+    bool spawn;
+
+    int connect_server();
+    bool spawn_server();
+
+    public:
+        ServerBackend(const std::string& socket_path, bool spawn=true)
+            : socket_path(socket_path), spawn(spawn){}
+        std::string name(){return "server";}
+        bool compile(const std::string& source, const std::string& compilercmd,
+                     const std::string& libname, CompiledLibrary& library);
+};
+
+// Socket of the server, DOPING_SERVER_SOCKET or server.sock in the
+// $XDG_RUNTIME_DIR/doping directory (~/.cache/doping if it is not defined).
+std::string server_socket_path();
+
+// Directory where the server keeps the libraries, the DOPING_CACHE_DIR
+// cache if it is enabled or ~/.cache/doping/specializations.
+std::string server_cache_directory();
+
+// Create the directory if it doesn't exist and check that it belongs to the
+// user and other users can't write in it.
+bool private_directory(const std::string& path);
+
+// Seconds that the server waits for requests before exiting,
+// DOPING_SERVER_IDLE_TIMEOUT (default 60).
+double server_idle_timeout();
+
+// Send and receive length-prefixed messages through a socket.
+bool send_message(int fd, const std::string& message);
+bool receive_message(int fd, std::string& message);
+
+#endif
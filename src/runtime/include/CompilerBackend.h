@@ -0,0 +1,76 @@
+#ifndef COMPILERBACKEND_H
+#define COMPILERBACKEND_H
+
+#include <string>
+#include <vector>
+
+
+// Shared library generated by a CompilerBackend.
+struct CompiledLibrary {
+    // Path used to link the library.
+    std::string path;
+    // Messages printed by the compiler.
+    std::string output;
+    // Descriptor of the in-memory library (or -1), it must stay open while
+    // the library is linked so its path is not reused by another library.
+    int fd;
+    // Whether path is a temporary file to remove once it is linked.
+    bool temporary;
+
+    CompiledLibrary() : fd(-1), temporary(false){}
+    // Remove the temporary file and close the descriptor (if any).
+    void release();
+};
+
+// Backends compile a rendered source into a shared library. If libname is
+// not empty the library is generated there, otherwise the backend chooses
+// where. They return false if the library could not be generated. All of
+// them run the compiler command as a separate process.
+class CompilerBackend {
+    public:
+        virtual ~CompilerBackend(){}
+        virtual std::string name() = 0;
+        virtual bool compile(const std::string& source,
+                             const std::string& compilercmd,
+                             const std::string& libname,
+                             CompiledLibrary& library) = 0;
+};
+
+// Write the source into a temporary file and run the compiler command
+// through a shell.
+class ShellBackend : public CompilerBackend {
+    public:
+        std::string name(){return "shell";}
+        bool compile(const std::string& source, const std::string& compilercmd,
+                     const std::string& libname, CompiledLibrary& library);
+};
+
+// Run the compiler directly (posix_spawn, without a shell) giving it the
+// source through a pipe, and generate the library in memory (memfd) when no
+// libname is given. Commands that need a shell to be interpreted (quotes,
+// variables, ...) are not supported.
+class SpawnBackend : public CompilerBackend {
+    public:
+        std::string name(){return "spawn";}
+        bool compile(const std::string& source, const std::string& compilercmd,
+                     const std::string& libname, CompiledLibrary& library);
+        static bool supports(const std::string& compilercmd);
+};
+
+// Return the backend with the given name (or NULL if it doesn't exist).
+CompilerBackend * create_backend(const std::string& name);
+
+// Backend selected with DOPING_COMPILER_BACKEND ("spawn" by default), it can
+// also be "shell" or "server" (see CompileServer.h).
+CompilerBackend * get_backend();
+
+// Backend used when the selected one fails.
+CompilerBackend * fallback_backend();
+
+// Split a command line in words (without interpreting any shell syntax).
+std::vector<std::string> split_command(const std::string& command);
+
+// Language of the source given to the compiler through stdin ("c" or "c++").
+std::string compiler_language(const std::string& compilercmd);
+
+#endif
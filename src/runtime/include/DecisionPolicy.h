@@ -0,0 +1,116 @@
+#ifndef DECISIONPOLICY_H
+#define DECISIONPOLICY_H
+
+#include <mutex>
+#include <string>
+
+#include "dopingRuntime.h"
+
+
+enum Decision {
+    // Compile (or load) the specialization and use it.
+    SPECIALIZE,
+    // Continue with the baseline loop.
+    BASELINE,
+    // Run some baseline iterations to measure their cost before deciding.
+    SAMPLE
+};
+
+// Policies decide if a loop should be specialized given the information
+// collected by the runtime.
+class DecisionPolicy {
+    public:
+        virtual ~DecisionPolicy(){}
+        virtual std::string name() = 0;
+        virtual Decision decide(const dopingdecisioninfo& info) = 0;
+};
+
+// Always specialize, this is the default policy.
+class AlwaysPolicy : public DecisionPolicy {
+    public:
+        std::string name(){return "always";}
+        Decision decide(const dopingdecisioninfo& info);
+};
+
+// Never specialize, useful to measure the runtime overhead.
+class NeverPolicy : public DecisionPolicy {
+    public:
+        std::string name(){return "never";}
+        Decision decide(const dopingdecisioninfo& info);
+};
+
+// Specialize if the loop progress is below a threshold (DOPING_THRESHOLD,
+// by default 0.5).
+class ThresholdPolicy : public DecisionPolicy {
+    float threshold;
+    public:
+        ThresholdPolicy(float threshold) : threshold(threshold){}
+        std::string name(){return "threshold";}
+        Decision decide(const dopingdecisioninfo& info);
+};
+
+// Specialize if the predicted time saved in the remaining iterations
+// (assuming the specialized loop is DOPING_EXPECTED_SPEEDUP times faster,
+// by default 2) is larger than the expected compilation time.
+class CostModelPolicy : public DecisionPolicy {
+    double speedup;
+    public:
+        CostModelPolicy(double speedup) : speedup(speedup){}
+        std::string name(){return "costmodel";}
+        Decision decide(const dopingdecisioninfo& info);
+        double predicted_gain(const dopingdecisioninfo& info);
+};
+
+// Sample the baseline of each loop once and then always specialize, so the
+// runtime trace (DOPING_TRACE) records the cost of the baseline and the
+// specialized loops for `dope --profile-use`.
+class RecordPolicy : public DecisionPolicy {
+    public:
+        std::string name(){return "record";}
+        Decision decide(const dopingdecisioninfo& info);
+};
+
+// Delegate the decision to a user-provided function, the baseline is
+// sampled first so the function can use the measured iteration time.
+class FunctionPolicy : public DecisionPolicy {
+    dopingpolicyfunction function;
+    public:
+        FunctionPolicy(dopingpolicyfunction function) : function(function){}
+        std::string name(){return "function";}
+        Decision decide(const dopingdecisioninfo& info);
+};
+
+// Return the policy with the given name (or NULL if it doesn't exist).
+DecisionPolicy * create_policy(const std::string& name);
+
+// Current policy, initialized from DOPING_POLICY the first time. The policy
+// should only be changed while no other thread is inside the runtime.
+DecisionPolicy * get_policy();
+void set_policy(DecisionPolicy * policy);
+
+// Iterations left to finish a loop from the current one (included), given
+// its first and last values of the iteration variable (dopinginfo
+// iteration_start and iteration_space). Loops can count up or down.
+long count_remaining_iterations(long iteration_start, long iteration_last, long current);
+
+// Number of baseline iterations timed to estimate the cost of the loop, it
+// can be set with DOPING_SAMPLE_ITERATIONS.
+long sample_iterations();
+
+// History of compilation times used to predict the cost of new ones. Cached
+// specializations only need to be linked, so they are accounted separately.
+class CompileTimeHistory {
+    double sum[2];
+    long count[2];
+    std::mutex mutex;
+    public:
+        CompileTimeHistory();
+        void record(double seconds, bool cached);
+        double expected(bool cached);
+};
+
+// Record and predict compilation times using the history of this execution.
+void record_compile_time(double seconds, bool cached);
+double expected_compile_time(bool cached);
+
+#endif
@@ -3,6 +3,8 @@
 
 #include <string>
 
+class SpecializationCache;
+
 
 // Function pointer prototpye:
 //   - Input argument is a struct with references to all access values.
@@ -14,6 +16,15 @@ class DynamicFunction {
     function_prototype functionPointer;
     std::string rendered_source;
     void * linked_library;
+    // Descriptor of the in-memory library file (or -1)
+    int library_fd;
+    bool cached;
+    // Seconds spent rendering the source and loading the library
+    double render_time;
+    double link_time;
+
+    // Link the library of the given key if it is in the cache
+    bool link_cached(SpecializationCache * cache, const std::string& key);
 
     public:
         DynamicFunction(
@@ -21,9 +32,25 @@ class DynamicFunction {
                 const std::string& parameters);
         ~DynamicFunction();
         void compile_and_link(const std::string& compilercmd);
+        void link(const std::string& libname);
+        // Compile the specialization into the given cache without loading
+        // it (unless it is already there) and return the library path.
+        std::string precompile(const std::string& compilercmd, SpecializationCache& cache);
+        // Whether the library is (or would be) loaded from the persistent cache
+        bool in_cache(const std::string& compilercmd);
+        bool is_cached(){return this->cached;}
+        double get_render_time(){return this->render_time;}
+        double get_link_time(){return this->link_time;}
         std::string get_rendered_source(){return this->rendered_source;}
         function_prototype get_fp(){return this->functionPointer;}
         int run(int current_iteration, va_list arguments);
 };
 
+// Run the given command in a shell and return its output, the exit status
+// is stored in status if it is not NULL.
+std::string run_shell(const std::string& cmd, int * status = NULL);
+
+// Unique ID (within all processes) for temporary files
+std::string getNextId();
+
 #endif
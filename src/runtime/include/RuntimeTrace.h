@@ -0,0 +1,107 @@
+#ifndef RUNTIMETRACE_H
+#define RUNTIMETRACE_H
+
+#include <atomic>
+#include <fstream>
+#include <map>
+#include <mutex>
+#include <string>
+
+
+class RuntimeTrace;
+
+// Counters and accumulated times of a loop. They are updated concurrently
+// by the threads running the loop (and the background compilation worker),
+// so they are atomics and the times are kept in nanoseconds.
+class LoopTrace {
+
+    RuntimeTrace * owner;
+    std::string name;
+
+    public:
+        // Entries to the runtime and how many were resolved by the call site
+        std::atomic<long> entries;
+        std::atomic<long> call_site_hits;
+        // Lookups in the version table that found (or not) the specialization
+        std::atomic<long> table_hits;
+        std::atomic<long> table_misses;
+        // Specializations compiled (or loaded from the persistent cache,
+        // which are also counted in cache_hits) and failed compilations
+        std::atomic<long> compilations;
+        std::atomic<long> cache_hits;
+        std::atomic<long> failures;
+        // Entries that ran a specialization or continued with the baseline
+        std::atomic<long> specialized_runs;
+        std::atomic<long> baseline_fallbacks;
+        std::atomic<long long> render_time;
+        std::atomic<long long> compile_time;
+        std::atomic<long long> dlopen_time;
+        std::atomic<long long> specialized_time;
+        // Executions of the loop (entries at its first iteration) and the
+        // sum of their trip counts
+        std::atomic<long> executions;
+        std::atomic<long long> iterations;
+        // Iterations run by the specializations
+        std::atomic<long long> specialized_iterations;
+        // Baseline iterations timed to estimate the loop cost, and their time
+        std::atomic<long long> sampled_iterations;
+        std::atomic<long long> sampled_time;
+
+        LoopTrace(RuntimeTrace * owner, const std::string& name);
+        std::string get_name(){return this->name;}
+        // Record an entry, trip_count is the number of iterations of the loop
+        // when it is entered at its first iteration, or -1 otherwise.
+        void entry(bool call_site_hit, long trip_count = -1);
+        void table_lookup(bool hit);
+        // Record a compilation, its times are in seconds.
+        void compilation(const std::string& parameters, double render, double compile,
+                         double dlopen, bool cached, bool succeeded);
+        void specialized_run(double seconds, long iterations);
+        void baseline_sample(long iterations, double seconds);
+        // Record an entry that continued with the baseline code, the reason
+        // is only used in the streamed events.
+        void baseline(const char * reason);
+};
+
+// Structured trace of what the runtime does with each loop, enabled with
+// DOPING_TRACE=<file>. The summary of each loop is written into the file
+// at exit, as CSV if the file name ends in .csv or as JSON otherwise.
+// If DOPING_TRACE_EVENTS=<file> is also set, each compilation, specialized
+// run and baseline fallback is streamed to that file as a JSON line.
+// In both names, %p is replaced with the process id (e.g. for MPI ranks).
+class RuntimeTrace {
+
+    std::string path;
+    std::mutex mutex;
+    std::map<std::string, LoopTrace *> loops;
+    std::mutex events_mutex;
+    std::ofstream events;
+    double start_time;
+
+    public:
+        RuntimeTrace(const std::string& path, const std::string& events_path = "");
+        ~RuntimeTrace();
+        // Return the trace configured by DOPING_TRACE and DOPING_TRACE_EVENTS
+        // or NULL if it is not enabled.
+        static RuntimeTrace * from_environment();
+        // Return the trace of the given loop, it is created the first time.
+        // The loop traces live as long as the RuntimeTrace.
+        LoopTrace * loop(const std::string& name);
+        // Stream an event of the given loop, fields is a list of JSON members
+        // (without braces) appended to the time, loop and event members.
+        void event(const std::string& loop, const std::string& event,
+                   const std::string& fields = "");
+        std::string to_json();
+        std::string to_csv();
+        // Write the summary into the trace file.
+        bool write();
+};
+
+// Trace of the runtime (created from the environment the first time), or
+// NULL if tracing is disabled. If it is enabled, it is written at exit.
+RuntimeTrace * get_runtime_trace();
+
+// Quote and escape a string as a JSON string.
+std::string json_string(const std::string& value);
+
+#endif
@@ -0,0 +1,52 @@
+#ifndef SPECIALIZATIONCACHE_H
+#define SPECIALIZATIONCACHE_H
+
+#include <string>
+
+
+// Persistent on-disk cache of compiled specializations (shared objects).
+//   - Entries are identified by a hash of the rendered source, the compiler
+//     command and the compiler version.
+//   - New entries are compiled into a temporary file inside the cache
+//     directory and published with an atomic rename, so readers never see
+//     partial files and do not need any lock.
+//   - The last use of an entry is recorded in its modification time, when
+//     the cache exceeds its maximum size the least recently used entries
+//     are removed. Temporary files older than a grace period, left by
+//     processes that died before publishing them, are removed as well.
+class SpecializationCache {
+
+    std::string directory;
+    unsigned long max_size;
+
+    public:
+        SpecializationCache(const std::string& directory, unsigned long max_size);
+        // Return the cache configured by DOPING_CACHE_DIR and
+        // DOPING_CACHE_MAX_SIZE (in MB) or NULL if it is not enabled.
+        static SpecializationCache * from_environment();
+        // Return the specializations precompiled for this executable, in
+        // DOPING_SPECIALIZATIONS_DIR or the `<executable>.doping` directory,
+        // or NULL if the directory does not exist.
+        static SpecializationCache * shipped();
+        std::string get_directory(){return this->directory;}
+        static std::string key(const std::string& source, const std::string& compilercmd);
+        // Return the path of the cached library or an empty string.
+        std::string lookup(const std::string& key);
+        // Path where a new entry can be generated before publishing it.
+        std::string temporary_path(const std::string& key);
+        // Move the given library into the cache and return its final path.
+        std::string publish(const std::string& key, const std::string& libname);
+        void evict();
+};
+
+// Create the directory and all its parents (only accessible by the user) if
+// they do not exist.
+void make_directories(const std::string& path);
+
+// Maximum size of the cache in bytes, DOPING_CACHE_MAX_SIZE (in MB) or 256MB.
+unsigned long cache_max_size();
+
+// Return the version string reported by the compiler used in compilercmd.
+std::string compiler_version(const std::string& compilercmd);
+
+#endif
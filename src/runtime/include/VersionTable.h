@@ -0,0 +1,61 @@
+#ifndef VERSIONTABLE_H
+#define VERSIONTABLE_H
+
+#include <atomic>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <unordered_map>
+#include <vector>
+
+#include "CallSite.h"
+#include "CompilationQueue.h"
+#include "RuntimeTrace.h"
+
+
+// Specializations of a single loop indexed by their signature. It keeps at
+// most `capacity` versions, when a new one is inserted in a full table the
+// least recently used is evicted (its library is unloaded once no thread is
+// running it). Versions still being compiled are never evicted.
+// All the methods can be called concurrently.
+class VersionTable {
+
+    std::unordered_map<std::string, std::shared_ptr<Specialization> > versions;
+    std::vector<CallSite *> call_sites;
+    size_t capacity;
+    std::atomic<unsigned long> clock;
+    std::mutex mutex;
+
+    void evict();
+
+    public:
+        // Runtime trace of the loop (NULL if tracing is disabled)
+        LoopTrace * trace;
+
+        VersionTable(size_t capacity);
+        ~VersionTable();
+        // Return the version with the given signature (or NULL) and record
+        // the hit.
+        std::shared_ptr<Specialization> find(const std::string& signature);
+        // Insert the version if there isn't one with the same signature and
+        // return the version in the table. Only the thread whose version is
+        // returned needs to compile it.
+        std::shared_ptr<Specialization> insert(const std::string& signature,
+                                               std::shared_ptr<Specialization> spec);
+        // Record a hit of a version found through a call site.
+        void touch(Specialization * spec){
+            spec->hits.fetch_add(1, std::memory_order_relaxed);
+            spec->last_use.store(this->clock.fetch_add(1, std::memory_order_relaxed) + 1,
+                                 std::memory_order_relaxed);
+        }
+        // Return the CallSite of the given call_site slot, it is created and
+        // published the first time. Call sites are cleared when the version
+        // they point to is evicted.
+        CallSite * call_site(void ** slot);
+        size_t size();
+};
+
+// Maximum number of versions per loop, it can be set with DOPING_MAX_VERSIONS.
+size_t max_versions();
+
+#endif
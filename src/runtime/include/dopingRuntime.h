@@ -1,3 +1,6 @@
+#ifndef DOPINGRUNTIME_H
+#define DOPINGRUNTIME_H
+
 #include <time.h>
 
 #ifdef __cplusplus
@@ -9,7 +12,7 @@
 typedef struct dopinginfo{
     // Starting iteration value (lower end of iteration space).
     int iteration_start;
-    // Length of the loop (upper bound - lower bound of iteration space).
+    // Last value of the iteration variable (end of the iteration space).
     int iteration_space;
     // Source code to be rendered and re-compiled.
     const char * source;
@@ -23,6 +26,22 @@ typedef struct dopinginfo{
     // variables and references used inside the given source.
     int num_arguments;
     void * arguments;
+    // Maximum number of iterations that the baseline loop executes before
+    // calling the runtime again (set by the runtime).
+    long chunk_size;
+    // Baseline sampling state: start time (in seconds) and iteration of the
+    // sample in progress, 0 when not sampling (set by the runtime).
+    double sample_start_time;
+    long sample_start_iteration;
+    // Binary signature of the runtime invariants, used instead of the
+    // parameters string when it is given. It has signature_size bytes in
+    // 8-byte slots described by signature_format ("name:kind,..." where kind
+    // is d for signed, u for unsigned or f for floating point values).
+    const void * signature;
+    int signature_size;
+    const char * signature_format;
+    // Per call site slot where the runtime keeps the last specialization.
+    void ** call_site;
     // Information about the dynamic state?
     // const char * stage;
 } dopinginfo;
@@ -30,7 +49,7 @@ typedef struct dopinginfo{
 typedef struct dopinginfoU{
     // Starting iteration value (lower end of iteration space).
     unsigned iteration_start;
-    // Length of the loop (upper bound - lower bound of iteration space).
+    // Last value of the iteration variable (end of the iteration space).
     unsigned iteration_space;
     // Source code to be rendered and re-compiled.
     const char * source;
@@ -44,12 +63,68 @@ typedef struct dopinginfoU{
     // variables and references used inside the given source.
     int num_arguments;
     void * arguments;
+    // Maximum number of iterations that the baseline loop executes before
+    // calling the runtime again (set by the runtime).
+    long chunk_size;
+    // Baseline sampling state: start time (in seconds) and iteration of the
+    // sample in progress, 0 when not sampling (set by the runtime).
+    double sample_start_time;
+    long sample_start_iteration;
+    // Binary signature of the runtime invariants, used instead of the
+    // parameters string when it is given. It has signature_size bytes in
+    // 8-byte slots described by signature_format ("name:kind,..." where kind
+    // is d for signed, u for unsigned or f for floating point values).
+    const void * signature;
+    int signature_size;
+    const char * signature_format;
+    // Per call site slot where the runtime keeps the last specialization.
+    void ** call_site;
     // Information about the dynamic state?
     // const char * stage;
 } dopinginfoU;
 
+// Information given to the decision policies to choose if a loop should be
+// specialized.
+typedef struct dopingdecisioninfo{
+    // Loop Name
+    const char * name;
+    // Iterations left to finish the loop, including the current one.
+    long remaining_iterations;
+    // Fraction of the iteration space already executed.
+    float progress;
+    // Measured time per iteration of the baseline loop in seconds, or a
+    // negative value if it has not been measured yet.
+    double baseline_iteration_time;
+    // Expected time to have the specialization ready in seconds.
+    double expected_compile_time;
+    // Whether the specialization is already in the persistent cache.
+    int cached;
+} dopingdecisioninfo;
+
+// User-defined policy, it returns non-zero if the loop should be specialized.
+typedef int (*dopingpolicyfunction)(const dopingdecisioninfo * info);
+
 //time_t doping_set_timer();
 
+// Select the policy that decides which loops are specialized: "always"
+// (default), "never", "threshold" or "costmodel". It can also be set with the
+// DOPING_POLICY environment variable. Returns 0 if the name is not valid.
+EXTERNC int dopingSetPolicy(const char * name);
+
+// Use a user-defined function as policy.
+EXTERNC void dopingSetPolicyFunction(dopingpolicyfunction function);
+
+// Render the loop source with the given runtime invariants ("name:value,..."
+// for each name in signature_format) as the runtime would, and compile it into
+// the directory, where the runtime of the executable finds it (see `dope
+// --specialize`). Returns 0 if it could not be compiled.
+EXTERNC int dopingPrecompile(
+    const char * source,
+    const char * signature_format,
+    const char * parameters,
+    const char * compiler_command,
+    const char * directory);
+
 // Doping infrastructure entry point.
 EXTERNC int dopingRuntime(
     int current_iteration,
@@ -62,3 +137,5 @@ EXTERNC int dopingRuntimeU(
     unsigned continue_condition,
     dopinginfoU * loop,
     ...);
+
+#endif
@@ -18,12 +18,7 @@ public:
     LOG(typelog type) {
         opened = false;
         msglevel = type;
-        const char * var = std::getenv("DOPING_VERBOSE");
-        try{
-            level = std::stoi(var);
-        } catch (std::exception const &e){
-            level = 0; // By default just print ERRORS
-        }
+        level = verbosity();
         if(msglevel <= level) {
             opened = true;
             fflush(NULL);
@@ -46,6 +41,19 @@ private:
     bool opened;
     typelog msglevel;
     int level;
+    // The verbosity level is only read once, as messages are created in the
+    // hot path of the runtime.
+    static int verbosity() {
+        static const int value = [](){
+            const char * var = std::getenv("DOPING_VERBOSE");
+            try{
+                return var ? std::stoi(var) : 0;
+            } catch (std::exception const &e){
+                return 0; // By default just print ERRORS
+            }
+        }();
+        return value;
+    }
     inline string getLabel(typelog type) {
         string label;
         switch(type) {
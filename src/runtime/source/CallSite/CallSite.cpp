@@ -0,0 +1,172 @@
+#include "CallSite.h"
+#include "log.h"
+
+#include <cstdio>
+#include <map>
+#include <sstream>
+#include <stdexcept>
+
+
+using namespace std;
+
+static const int SLOT_SIZE = 8;
+
+string format_signature(const char * format, const void * signature, int size){
+    const char * data = (const char *) signature;
+    string parameters;
+    stringstream ss(format);
+    int offset = 0;
+    while (ss.good()){
+        string item;
+        getline(ss, item, ',');
+        size_t pos = item.find(':');
+        if (pos == string::npos || pos + 1 >= item.length()) continue;
+        if (offset + SLOT_SIZE > size){
+            throw std::runtime_error("Signature format '" + string(format) +
+                                     "' does not match the signature size");
+        }
+
+        char value[32];
+        char kind = item[pos + 1];
+        if (kind == 'f'){
+            double slot;
+            memcpy(&slot, data + offset, SLOT_SIZE);
+            snprintf(value, sizeof(value), "%.17g", slot);
+        }else if (kind == 'u'){
+            unsigned long long slot;
+            memcpy(&slot, data + offset, SLOT_SIZE);
+            snprintf(value, sizeof(value), "%llu", slot);
+        }else{
+            long long slot;
+            memcpy(&slot, data + offset, SLOT_SIZE);
+            snprintf(value, sizeof(value), "%lld", slot);
+        }
+        offset += SLOT_SIZE;
+
+        if (!parameters.empty()) parameters += ",";
+        parameters += item.substr(0, pos) + ":" + value;
+    }
+    return parameters;
+}
+
+string build_signature(const char * format, const string& parameters){
+    map<string, string> values;
+    stringstream ps(parameters);
+    while (ps.good()){
+        string item;
+        getline(ps, item, ',');
+        size_t pos = item.find(':');
+        if (pos != string::npos) values[item.substr(0, pos)] = item.substr(pos + 1);
+    }
+
+    string signature;
+    stringstream ss(format);
+    while (ss.good()){
+        string item;
+        getline(ss, item, ',');
+        size_t pos = item.find(':');
+        if (pos == string::npos || pos + 1 >= item.length()) continue;
+        auto search = values.find(item.substr(0, pos));
+        if (search == values.end()){
+            throw std::runtime_error("Missing value of " + item.substr(0, pos));
+        }
+
+        char slot[SLOT_SIZE];
+        char kind = item[pos + 1];
+        try{
+            if (kind == 'f'){
+                double value = stod(search->second);
+                memcpy(slot, &value, SLOT_SIZE);
+            }else if (kind == 'u'){
+                unsigned long long value = stoull(search->second);
+                memcpy(slot, &value, SLOT_SIZE);
+            }else{
+                long long value = stoll(search->second);
+                memcpy(slot, &value, SLOT_SIZE);
+            }
+        } catch(std::logic_error& e){
+            throw std::runtime_error("Invalid value of " + item.substr(0, pos) + ": " +
+                                     search->second);
+        }
+        signature.append(slot, SLOT_SIZE);
+    }
+    return signature;
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+
+SCENARIO("Format binary signatures") {
+
+    struct { long long A; double B; long long C; } signature = {-3, 0.5, 1};
+
+    GIVEN("A signature with signed, floating point and unsigned values"){
+        THEN("it is formatted as a parameters string"){
+            REQUIRE(format_signature("A:d,B:f,C:u", &signature, sizeof(signature)) ==
+                    "A:-3,B:0.5,C:1");
+        }
+    }
+    GIVEN("A format with more values than the signature"){
+        THEN("it throws an error"){
+            REQUIRE_THROWS(format_signature("A:d,B:f,C:u,D:d", &signature,
+                                            sizeof(signature)));
+        }
+    }
+}
+
+SCENARIO("Build binary signatures") {
+
+    GIVEN("The values of a signature with signed, floating point and unsigned values"){
+        string signature = build_signature("A:d,B:f,C:u", "C:1,A:-3,B:0.5,D:7");
+        THEN("it has a slot for each value in the format order"){
+            REQUIRE(signature.size() == 24);
+            REQUIRE(format_signature("A:d,B:f,C:u", signature.data(), signature.size()) ==
+                    "A:-3,B:0.5,C:1");
+        }
+    }
+    GIVEN("Floating point values written in any notation"){
+        string signature = build_signature("B:f", "B:1e-1");
+        THEN("they are formatted as the runtime formats them"){
+            REQUIRE(format_signature("B:f", signature.data(), signature.size()) ==
+                    "B:0.10000000000000001");
+        }
+    }
+    GIVEN("Missing or invalid values"){
+        THEN("it throws an error"){
+            REQUIRE_THROWS(build_signature("A:d,B:f", "A:1"));
+            REQUIRE_THROWS(build_signature("A:d", "A:x"));
+        }
+    }
+}
+
+SCENARIO("Call site slots") {
+
+    struct { long long A; } signature = {1};
+    shared_ptr<Specialization> spec = make_shared<Specialization>("", "", "gcc");
+    CallSite site;
+
+    GIVEN("An empty call site"){
+        THEN("it has no entry"){
+            REQUIRE(!site.load());
+        }
+    }
+    GIVEN("A call site updated with a signature"){
+        site.update(&signature, sizeof(signature), spec);
+        shared_ptr<const CallSiteEntry> entry = site.load();
+        THEN("its entry only matches the same signature"){
+            REQUIRE(entry->matches(&signature, sizeof(signature)));
+            REQUIRE(entry->spec == spec);
+            signature.A = 2;
+            REQUIRE(!entry->matches(&signature, sizeof(signature)));
+        }
+        WHEN("it is cleared"){
+            site.clear();
+            THEN("the entry loaded before is still valid"){
+                REQUIRE(!site.load());
+                REQUIRE(entry->spec == spec);
+            }
+        }
+    }
+}
+#endif
@@ -0,0 +1,149 @@
+#include "CompilationQueue.h"
+#include "DecisionPolicy.h"
+#include "RuntimeTrace.h"
+#include "log.h"
+
+#include <algorithm>
+#include <chrono>
+#include <stdexcept>
+
+
+using namespace std;
+
+Specialization::Specialization(const string& source,
+                               const string& parameters,
+                               const string& compiler_command)
+    : source(source), parameters(parameters), compiler_command(compiler_command),
+      df(NULL), state(PENDING), compile_time(0), predicted_baseline_time(-1), runs(0),
+      hits(0), last_use(0), trace(NULL){
+}
+
+void Specialization::compile(){
+    chrono::time_point<chrono::system_clock> tstart, tend;
+
+    tstart = chrono::system_clock::now();
+    DynamicFunction * newdf = NULL;
+    double render_time = 0, link_time = 0;
+    try {
+        newdf = new DynamicFunction(this->source, this->parameters);
+        render_time = newdf->get_render_time();
+        newdf->compile_and_link(this->compiler_command);
+        link_time = newdf->get_link_time();
+    } catch(exception& e){
+        LOG(ERROR) << "Doping failed to dynamically optimize function with error:";
+        LOG(ERROR) << e.what();
+        LOG(ERROR) << "Continuing with baseline code.";
+        if (newdf) link_time = newdf->get_link_time();
+        delete newdf;
+        newdf = NULL;
+    }
+    tend = chrono::system_clock::now();
+    chrono::duration<double> tduration = tend - tstart;
+    this->compile_time = tduration.count();
+    LOG(INFO) << "Rendering template, compilation and linking took: " << tduration.count() \
+        << " seconds.";
+    if (std::getenv("DOPING_BENCHMARK") != NULL){
+        cout << "DopingRuntime: " <<  tduration.count() << " ";
+    }
+    if (newdf) record_compile_time(this->compile_time, newdf->is_cached());
+    if (this->trace){
+        this->trace->compilation(this->parameters, render_time,
+                                 max(0.0, this->compile_time - render_time - link_time),
+                                 link_time, newdf && newdf->is_cached(), newdf != NULL);
+    }
+
+    // Publish the result, the release order guarantees that threads that
+    // see the READY state also see the function.
+    this->df = newdf;
+    this->state.store(newdf ? READY : FAILED, memory_order_release);
+}
+
+CompilationQueue::CompilationQueue() : stop(false){
+    this->worker = thread(&CompilationQueue::work, this);
+}
+
+CompilationQueue::~CompilationQueue(){
+    // Pending jobs are discarded, but we need to wait for the one that may
+    // be in progress.
+    {
+        lock_guard<std::mutex> lock(this->mutex);
+        this->stop = true;
+        this->jobs.clear();
+    }
+    this->condition.notify_all();
+    if (this->worker.joinable()) this->worker.join();
+}
+
+CompilationQueue& CompilationQueue::instance(){
+    // The worker thread is only started the first time it is needed
+    static CompilationQueue queue;
+    return queue;
+}
+
+void CompilationQueue::enqueue(shared_ptr<Specialization> specialization){
+    {
+        lock_guard<std::mutex> lock(this->mutex);
+        this->jobs.push_back(specialization);
+    }
+    this->condition.notify_one();
+}
+
+void CompilationQueue::work(){
+    while (true){
+        shared_ptr<Specialization> specialization;
+        {
+            unique_lock<std::mutex> lock(this->mutex);
+            this->condition.wait(lock, [this]{return this->stop || !this->jobs.empty();});
+            if (this->stop) return;
+            specialization = this->jobs.front();
+            this->jobs.pop_front();
+        }
+        LOG(DEBUG) << "Background compilation started";
+        specialization->compile();
+    }
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+
+static string queue_test_source = "\n"
+    "int function(){\n"
+    "    return /*<DOPING A >*/;\n"
+    "}\n";
+
+SCENARIO("Compile specializations") {
+
+    GIVEN("A valid specialization"){
+        shared_ptr<Specialization> spec = make_shared<Specialization>(queue_test_source, "A:7", "gcc");
+        REQUIRE(spec->is_pending());
+
+        WHEN("compiled synchronously"){
+            spec->compile();
+            THEN("it is ready and returns the expected value"){
+                REQUIRE(spec->is_ready());
+                REQUIRE(spec->df->run(0, NULL) == 7);
+            }
+        }
+        WHEN("compiled by the background worker"){
+            CompilationQueue queue;
+            queue.enqueue(spec);
+            while (spec->is_pending()) this_thread::sleep_for(chrono::milliseconds(10));
+            THEN("it becomes ready"){
+                REQUIRE(spec->is_ready());
+                REQUIRE(spec->df->run(0, NULL) == 7);
+            }
+        }
+    }
+    GIVEN("A specialization that does not compile"){
+        Specialization spec("int function({", "", "gcc");
+        WHEN("compiled"){
+            spec.compile();
+            THEN("it is marked as failed"){
+                REQUIRE(spec.state == FAILED);
+                REQUIRE(spec.df == NULL);
+            }
+        }
+    }
+}
+#endif
@@ -0,0 +1,502 @@
+#include "CompileServer.h"
+#include "DynamicFunction.h"
+#include "log.h"
+
+#include <cerrno>
+#include <chrono>
+#include <cstdint>
+#include <cstring>
+#include <fstream>
+#include <thread>
+
+#include <dlfcn.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <pwd.h>
+#include <spawn.h>
+#include <sys/file.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+
+using namespace std;
+
+extern char **environ;
+
+static long now_milliseconds(){
+    return chrono::duration_cast<chrono::milliseconds>(
+        chrono::steady_clock::now().time_since_epoch()).count();
+}
+
+bool send_message(int fd, const string& message){
+    uint64_t size = message.size();
+    string data(reinterpret_cast<const char *>(&size), sizeof(size));
+    data += message;
+    size_t sent = 0;
+    while (sent < data.size()){
+        ssize_t n = send(fd, data.data() + sent, data.size() - sent, MSG_NOSIGNAL);
+        if (n < 0 && errno == EINTR) continue;
+        if (n <= 0) return false;
+        sent += n;
+    }
+    return true;
+}
+
+static bool receive_bytes(int fd, char * buffer, size_t size){
+    size_t received = 0;
+    while (received < size){
+        ssize_t n = recv(fd, buffer + received, size - received, 0);
+        if (n < 0 && errno == EINTR) continue;
+        if (n <= 0) return false;
+        received += n;
+    }
+    return true;
+}
+
+bool receive_message(int fd, string& message){
+    uint64_t size;
+    if (!receive_bytes(fd, reinterpret_cast<char *>(&size), sizeof(size))) return false;
+    message.resize(size);
+    return size == 0 || receive_bytes(fd, &message[0], size);
+}
+
+static bool socket_address(const string& path, struct sockaddr_un& address){
+    memset(&address, 0, sizeof(address));
+    address.sun_family = AF_UNIX;
+    if (path.size() >= sizeof(address.sun_path)){
+        LOG(ERROR) << "The server socket path is too long: " << path;
+        return false;
+    }
+    strncpy(address.sun_path, path.c_str(), sizeof(address.sun_path) - 1);
+    return true;
+}
+
+// Whether the process at the other end of the socket belongs to this user
+static bool same_user(int fd){
+    struct ucred credentials;
+    socklen_t size = sizeof(credentials);
+    return getsockopt(fd, SOL_SOCKET, SO_PEERCRED, &credentials, &size) == 0 &&
+           credentials.uid == getuid();
+}
+
+// The user cache directory of Doping, ~/.cache/doping
+static string user_cache_directory(){
+    const char * home = std::getenv("HOME");
+    if (home == NULL || string(home).empty()){
+        struct passwd * user = getpwuid(getuid());
+        home = user != NULL ? user->pw_dir : "";
+    }
+    return string(home) + "/.cache/doping";
+}
+
+string server_socket_path(){
+    const char * var = std::getenv("DOPING_SERVER_SOCKET");
+    if (var != NULL && !string(var).empty()) return var;
+    const char * runtime_dir = std::getenv("XDG_RUNTIME_DIR");
+    if (runtime_dir != NULL && !string(runtime_dir).empty()){
+        return string(runtime_dir) + "/doping/server.sock";
+    }
+    return user_cache_directory() + "/server.sock";
+}
+
+string server_cache_directory(){
+    const char * root = std::getenv("DOPING_CACHE_DIR");
+    if (root != NULL && !string(root).empty()) return string(root) + "/specializations";
+    return user_cache_directory() + "/specializations";
+}
+
+bool private_directory(const string& path){
+    try{
+        make_directories(path);
+    } catch (std::exception const &e){
+        LOG(ERROR) << e.what();
+        return false;
+    }
+    struct stat info;
+    if (lstat(path.c_str(), &info) != 0 || !S_ISDIR(info.st_mode)){
+        LOG(ERROR) << path << " is not a directory";
+        return false;
+    }
+    if (info.st_uid != getuid() || (info.st_mode & (S_IWGRP | S_IWOTH)) != 0){
+        LOG(ERROR) << path << " is not owned by the user or other users can write in it";
+        return false;
+    }
+    return true;
+}
+
+double server_idle_timeout(){
+    const char * var = std::getenv("DOPING_SERVER_IDLE_TIMEOUT");
+    if (var == NULL) return 60;
+    try{
+        return std::stod(var);
+    } catch (std::exception const &e){
+        LOG(ERROR) << "Invalid DOPING_SERVER_IDLE_TIMEOUT value: " << var;
+        return 60;
+    }
+}
+
+CompileServer::CompileServer(const string& socket_path,
+                             const string& cache_directory,
+                             double idle_timeout)
+    : socket_path(socket_path), cache(cache_directory, cache_max_size()),
+      idle_timeout(idle_timeout), listen_fd(-1), lock_fd(-1), stopping(false),
+      connections(0), compilations(0), last_request(now_milliseconds()){
+}
+
+CompileServer::~CompileServer(){
+    // The connection threads are detached, wait for them to finish
+    while (this->connections > 0) this_thread::sleep_for(chrono::milliseconds(10));
+    if (this->listen_fd >= 0){
+        close(this->listen_fd);
+        unlink(this->socket_path.c_str());
+    }
+    // Releasing the lock last, so a new server can't remove our socket
+    if (this->lock_fd >= 0) close(this->lock_fd);
+}
+
+bool CompileServer::start(){
+    // Only the server holding the lock can (re)create the socket, if the
+    // socket exists without a lock it belongs to a server that crashed.
+    // Other users must not be able to replace the socket, the lock or the
+    // libraries, the runtime would load them.
+    size_t pos = this->socket_path.find_last_of('/');
+    string socket_directory = pos == string::npos ? "." : this->socket_path.substr(0, pos);
+    if (!private_directory(socket_directory) ||
+        !private_directory(this->cache.get_directory())){
+        return false;
+    }
+    string lockname = this->socket_path + ".lock";
+    this->lock_fd = open(lockname.c_str(), O_RDWR | O_CREAT | O_CLOEXEC | O_NOFOLLOW, 0600);
+    if (this->lock_fd < 0){
+        LOG(ERROR) << "Could not open " << lockname << ": " << strerror(errno);
+        return false;
+    }
+    if (flock(this->lock_fd, LOCK_EX | LOCK_NB) != 0){
+        LOG(DEBUG) << "Another compile server is using " << this->socket_path;
+        close(this->lock_fd);
+        this->lock_fd = -1;
+        return false;
+    }
+
+    struct sockaddr_un address;
+    if (!socket_address(this->socket_path, address)) return false;
+    unlink(this->socket_path.c_str());
+    this->listen_fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (this->listen_fd < 0 ||
+        bind(this->listen_fd, (struct sockaddr *) &address, sizeof(address)) != 0 ||
+        listen(this->listen_fd, 64) != 0){
+        LOG(ERROR) << "Could not listen in " << this->socket_path << ": " << strerror(errno);
+        if (this->listen_fd >= 0) close(this->listen_fd);
+        this->listen_fd = -1;
+        return false;
+    }
+    LOG(INFO) << "Compile server listening in " << this->socket_path;
+    return true;
+}
+
+void CompileServer::serve(){
+    while (!this->stopping){
+        struct pollfd fds;
+        fds.fd = this->listen_fd;
+        fds.events = POLLIN;
+        int ready = poll(&fds, 1, 100);
+        if (ready < 0 && errno != EINTR) break;
+        if (ready <= 0){
+            long idle = now_milliseconds() - this->last_request;
+            if (this->connections == 0 && idle > this->idle_timeout * 1000) break;
+            continue;
+        }
+        int fd = accept4(this->listen_fd, NULL, NULL, SOCK_CLOEXEC);
+        if (fd < 0) continue;
+        this->connections++;
+        this->last_request = now_milliseconds();
+        thread(&CompileServer::handle, this, fd).detach();
+    }
+    LOG(INFO) << "Compile server stopped after " << this->compilations << " compilations";
+}
+
+void CompileServer::handle(int fd){
+    string compilercmd, source;
+    // The requests run a compiler command, only the user can send them
+    if (!same_user(fd)){
+        LOG(ERROR) << "Compile server request from another user rejected";
+    }else if (receive_message(fd, compilercmd) && receive_message(fd, source)){
+        string key = this->cache.key(source, compilercmd);
+        string path = this->cache.lookup(key);
+        bool compiled = !path.empty();
+        string output;
+
+        if (!compiled){
+            // Only the first request of a specialization compiles it, the
+            // others wait for its result.
+            shared_ptr<CompileJob> job;
+            bool owner = false;
+            {
+                lock_guard<std::mutex> lock(this->jobs_mutex);
+                auto search = this->jobs.find(key);
+                if (search == this->jobs.end()){
+                    job = make_shared<CompileJob>();
+                    this->jobs[key] = job;
+                    owner = true;
+                }else{
+                    job = search->second;
+                }
+            }
+            if (owner){
+                // It may have been published after the previous lookup
+                job->path = this->cache.lookup(key);
+                job->compiled = !job->path.empty();
+                if (!job->compiled) this->compile(source, compilercmd, key, *job);
+                {
+                    lock_guard<std::mutex> lock(this->jobs_mutex);
+                    this->jobs.erase(key);
+                }
+                lock_guard<std::mutex> lock(job->mutex);
+                job->done = true;
+                job->condition.notify_all();
+            }
+            unique_lock<std::mutex> lock(job->mutex);
+            job->condition.wait(lock, [&job]{return job->done;});
+            compiled = job->compiled;
+            path = job->path;
+            output = job->output;
+        }
+        send_message(fd, compiled ? "0" : "1") && send_message(fd, path) &&
+            send_message(fd, output);
+    }
+    close(fd);
+    this->last_request = now_milliseconds();
+    this->connections--;
+}
+
+void CompileServer::compile(const string& source, const string& compilercmd,
+                            const string& key, CompileJob& job){
+    string libname = this->cache.temporary_path(key);
+    CompiledLibrary library;
+    SpawnBackend spawn;
+    ShellBackend shell;
+    bool compiled = spawn.compile(source, compilercmd, libname, library);
+    if (!compiled){
+        library.release();
+        library = CompiledLibrary();
+        compiled = shell.compile(source, compilercmd, libname, library);
+    }
+    job.output = library.output;
+    job.compiled = compiled;
+    if (compiled){
+        job.path = this->cache.publish(key, library.path);
+        this->compilations++;
+        LOG(DEBUG) << "Compile server generated " << job.path;
+    }else{
+        library.release();
+    }
+}
+
+int ServerBackend::connect_server(){
+    struct sockaddr_un address;
+    if (!socket_address(this->socket_path, address)) return -1;
+    int fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (fd < 0) return -1;
+    if (connect(fd, (struct sockaddr *) &address, sizeof(address)) != 0){
+        close(fd);
+        return -1;
+    }
+    // The libraries of a server of another user must not be loaded
+    if (!same_user(fd)){
+        LOG(ERROR) << "The compile server " << this->socket_path << " belongs to another user";
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+// The doping_server executable is DOPING_SERVER or the one next to this
+// library.
+static string server_executable(){
+    const char * var = std::getenv("DOPING_SERVER");
+    if (var != NULL && !string(var).empty()) return var;
+    Dl_info info;
+    if (dladdr((void *) &server_executable, &info) != 0 && info.dli_fname != NULL){
+        string library(info.dli_fname);
+        size_t pos = library.find_last_of('/');
+        if (pos != string::npos) return library.substr(0, pos + 1) + "doping_server";
+    }
+    return "doping_server";
+}
+
+bool ServerBackend::spawn_server(){
+    // The server daemonizes itself once it is listening, so waiting for
+    // this process also waits for the socket to be ready.
+    string executable = server_executable();
+    vector<char *> argv = {&executable[0], NULL};
+    pid_t pid;
+    int error = posix_spawnp(&pid, argv[0], NULL, NULL, argv.data(), environ);
+    if (error != 0){
+        LOG(ERROR) << "Could not start the compile server " << executable << ": " \
+            << strerror(error);
+        return false;
+    }
+    LOG(INFO) << "Started compile server " << executable;
+    int status;
+    while (waitpid(pid, &status, 0) < 0 && errno == EINTR);
+    return WIFEXITED(status) && WEXITSTATUS(status) == 0;
+}
+
+bool ServerBackend::compile(const string& source, const string& compilercmd,
+                            const string& libname, CompiledLibrary& library){
+    int fd = this->connect_server();
+    if (fd < 0 && this->spawn && this->spawn_server()) fd = this->connect_server();
+    if (fd < 0){
+        library.output = "Could not connect to the compile server " + this->socket_path;
+        return false;
+    }
+
+    string status, path;
+    bool received = send_message(fd, compilercmd) && send_message(fd, source) &&
+                    receive_message(fd, status) && receive_message(fd, path) &&
+                    receive_message(fd, library.output);
+    close(fd);
+    if (!received){
+        library.output = "The compile server closed the connection";
+        return false;
+    }
+    if (status != "0") return false;
+
+    library.path = path;
+    if (!libname.empty() && libname != path){
+        // Link (or copy) the library where it was requested
+        library.path = libname;
+        if (link(path.c_str(), libname.c_str()) != 0){
+            ifstream src(path, ios::binary);
+            ofstream dst(libname, ios::binary | ios::trunc);
+            dst << src.rdbuf();
+            if (!src || !dst) return false;
+        }
+    }
+    return true;
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+
+// Set (or unset if value is NULL) an environment variable, returning the
+// previous value so it can be restored.
+static pair<bool, string> replace_env(const char * name, const char * value){
+    const char * previous = std::getenv(name);
+    pair<bool, string> saved(previous != NULL, previous ? previous : "");
+    if (value == NULL) unsetenv(name);
+    else setenv(name, value, 1);
+    return saved;
+}
+
+static void restore_env(const char * name, const pair<bool, string>& saved){
+    replace_env(name, saved.first ? saved.second.c_str() : NULL);
+}
+
+SCENARIO("Compile server default paths") {
+    GIVEN("No DOPING_SERVER_SOCKET nor DOPING_CACHE_DIR"){
+        auto socket = replace_env("DOPING_SERVER_SOCKET", NULL);
+        auto cache = replace_env("DOPING_CACHE_DIR", NULL);
+        auto home = replace_env("HOME", "/home/doping");
+        auto runtime_dir = replace_env("XDG_RUNTIME_DIR", "/run/user/1000");
+
+        THEN("the server files are in the user directories, not in /tmp"){
+            REQUIRE(server_socket_path() == "/run/user/1000/doping/server.sock");
+            replace_env("XDG_RUNTIME_DIR", NULL);
+            REQUIRE(server_socket_path() == "/home/doping/.cache/doping/server.sock");
+            REQUIRE(server_cache_directory() == "/home/doping/.cache/doping/specializations");
+        }
+        restore_env("DOPING_SERVER_SOCKET", socket);
+        restore_env("DOPING_CACHE_DIR", cache);
+        restore_env("HOME", home);
+        restore_env("XDG_RUNTIME_DIR", runtime_dir);
+    }
+}
+
+static string server_test_source = "\n"
+    "int function(){\n"
+    "    return 5;\n"
+    "}\n";
+
+SCENARIO("Compile specializations in a compile server") {
+
+    GIVEN("A running compile server"){
+        char tmpl[] = "/tmp/doping_server_test_XXXXXX";
+        string directory(mkdtemp(tmpl));
+        string socket_path = directory + "/server.sock";
+        CompileServer server(socket_path, directory + "/specializations", 60);
+        REQUIRE(server.start());
+        thread serving(&CompileServer::serve, &server);
+
+        THEN("a second server can not use the same socket"){
+            CompileServer other(socket_path, directory + "/specializations", 60);
+            REQUIRE(!other.start());
+        }
+        WHEN("the same specialization is requested concurrently"){
+            vector<CompiledLibrary> libraries(4);
+            vector<int> compiled(4, 0);
+            vector<thread> clients;
+            for (int i = 0; i < 4; i++){
+                clients.push_back(thread([&, i](){
+                    ServerBackend backend(socket_path, false);
+                    compiled[i] = backend.compile(server_test_source, "gcc", "", libraries[i]);
+                }));
+            }
+            for (auto& client : clients) client.join();
+            THEN("it is compiled once and all requests get the library"){
+                REQUIRE(server.get_compilations() == 1);
+                for (int i = 0; i < 4; i++){
+                    REQUIRE(compiled[i]);
+                    REQUIRE(libraries[i].path == libraries[0].path);
+                }
+                DynamicFunction df(server_test_source, "");
+                df.link(libraries[0].path);
+                REQUIRE(df.run(0, NULL) == 5);
+            }
+        }
+        WHEN("an invalid source is requested"){
+            ServerBackend backend(socket_path, false);
+            CompiledLibrary library;
+            THEN("it fails with the compiler errors"){
+                REQUIRE(!backend.compile("int function({", "gcc", "", library));
+                REQUIRE(library.output.find("error") != string::npos);
+            }
+        }
+        server.stop();
+        serving.join();
+    }
+    GIVEN("A directory that other users can write in"){
+        char tmpl[] = "/tmp/doping_server_test_XXXXXX";
+        string directory(mkdtemp(tmpl));
+        chmod(directory.c_str(), 0777);
+        THEN("the server refuses to use it"){
+            CompileServer server(directory + "/server.sock", directory + "/private", 60);
+            REQUIRE(!server.start());
+            CompileServer other(directory + "/private/server.sock", directory, 60);
+            REQUIRE(!other.start());
+        }
+    }
+    GIVEN("A lock file that is a symbolic link"){
+        char tmpl[] = "/tmp/doping_server_test_XXXXXX";
+        string directory(mkdtemp(tmpl));
+        REQUIRE(symlink((directory + "/target").c_str(),
+                        (directory + "/server.sock.lock").c_str()) == 0);
+        THEN("the server does not follow it"){
+            CompileServer server(directory + "/server.sock", directory + "/cache", 60);
+            REQUIRE(!server.start());
+            REQUIRE(access((directory + "/target").c_str(), F_OK) != 0);
+        }
+    }
+    GIVEN("No compile server"){
+        ServerBackend backend("/tmp/doping_server_test_missing.sock", false);
+        CompiledLibrary library;
+        THEN("the backend fails"){
+            REQUIRE(!backend.compile(server_test_source, "gcc", "", library));
+        }
+    }
+}
+#endif
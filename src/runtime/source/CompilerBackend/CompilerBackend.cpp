@@ -0,0 +1,316 @@
+#include "CompilerBackend.h"
+#include "CompileServer.h"
+#include "DynamicFunction.h"
+#include "log.h"
+
+#include <cerrno>
+#include <cstdio>
+#include <cstring>
+#include <fstream>
+#include <sstream>
+
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <spawn.h>
+#include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/syscall.h>
+#include <sys/wait.h>
+#include <unistd.h>
+
+
+using namespace std;
+
+extern char **environ;
+
+// Use /tmp but it may be system-specific and could be a security issue
+static string TMPDIR = "/tmp/";
+
+void CompiledLibrary::release(){
+    // The file doesn't exist if the compilation failed
+    if (this->temporary && access(this->path.c_str(), F_OK) == 0 &&
+        remove(this->path.c_str()) != 0){
+        LOG(ERROR) << "Could not delete the file:" << this->path;
+    }
+    this->temporary = false;
+    if (this->fd >= 0) close(this->fd);
+    this->fd = -1;
+}
+
+bool ShellBackend::compile(const string& source, const string& compilercmd,
+                           const string& libname, CompiledLibrary& library){
+    string uid = getNextId();
+
+    // FIXME: It should maintain the same file extension as the original
+    string filename = TMPDIR + "doping_tmp_file_" + uid + ".c";
+
+    // Open a temporal file (is it possible to compile from a stream instead?)
+    ofstream tmpfile(filename, ofstream::out | ofstream::trunc);
+    if(tmpfile.fail() || !tmpfile.is_open()){
+        LOG(ERROR) << " Error opening" << filename << "file: (errno" \
+            << errno <<") " << strerror(errno);
+        return false;
+    }
+    tmpfile << source;
+    tmpfile.close();
+    LOG(DEBUG) << "Saving rendered source to " << filename;
+
+    // Compile with -fPIC and -shared flags in addition to the original ones.
+    library.path = libname;
+    if (libname.empty()){
+        library.path = TMPDIR + "doping_tmp_object" + uid + ".so";
+        library.temporary = true;
+    }
+    string command = compilercmd + " -fPIC -shared " + filename + " -o " + library.path;
+    LOG(DEBUG) << "Compiling: " << command;
+    int status;
+    library.output = run_shell(command, &status);
+
+    if (remove(filename.c_str()) != 0){
+        LOG(ERROR) << "Could not delete the file:" << filename;
+    }
+    return status == 0 && access(library.path.c_str(), F_OK) == 0;
+}
+
+vector<string> split_command(const string& command){
+    vector<string> words;
+    stringstream ss(command);
+    string word;
+    while (ss >> word) words.push_back(word);
+    return words;
+}
+
+string compiler_language(const string& compilercmd){
+    vector<string> words = split_command(compilercmd);
+    if (words.empty()) return "c";
+    string compiler = words[0].substr(words[0].find_last_of('/') + 1);
+    // The shell backend gives a .c file to the compiler, which C++ compilers
+    // also compile as C++.
+    if (compiler.find("++") != string::npos || compiler.find("cxx") != string::npos ||
+        compiler.find("icpc") != string::npos){
+        return "c++";
+    }
+    return "c";
+}
+
+bool SpawnBackend::supports(const string& compilercmd){
+    return compilercmd.find_first_of("\"'\\$`*?;|&<>(){}~") == string::npos &&
+           !split_command(compilercmd).empty();
+}
+
+// Write the input to the process and read its output until it closes it,
+// polling both so neither side blocks if a pipe is full.
+static string communicate(int input, int output, const string& data){
+    string result;
+    size_t written = 0;
+    char buffer[4096];
+    if (data.empty()){
+        close(input);
+        input = -1;
+    }
+    while (output >= 0){
+        struct pollfd fds[2];
+        int nfds = 0;
+        fds[nfds].fd = output;
+        fds[nfds++].events = POLLIN;
+        if (input >= 0){
+            fds[nfds].fd = input;
+            fds[nfds++].events = POLLOUT;
+        }
+        if (poll(fds, nfds, -1) < 0){
+            if (errno == EINTR) continue;
+            break;
+        }
+        if (input >= 0 && fds[1].revents){
+            ssize_t n = send(input, data.data() + written, data.size() - written,
+                             MSG_NOSIGNAL);
+            if (n > 0) written += n;
+            // The compiler may stop reading (e.g. after an error)
+            if (n < 0 || written == data.size()){
+                close(input);
+                input = -1;
+            }
+        }
+        if (fds[0].revents){
+            ssize_t n = read(output, buffer, sizeof(buffer));
+            if (n > 0){
+                result.append(buffer, n);
+            }else if (n == 0 || errno != EINTR){
+                close(output);
+                output = -1;
+            }
+        }
+    }
+    if (input >= 0) close(input);
+    return result;
+}
+
+bool SpawnBackend::compile(const string& source, const string& compilercmd,
+                           const string& libname, CompiledLibrary& library){
+    if (!this->supports(compilercmd)){
+        library.output = "The compiler command needs a shell: " + compilercmd;
+        return false;
+    }
+
+    library.path = libname;
+    if (libname.empty()){
+#ifdef SYS_memfd_create
+        library.fd = syscall(SYS_memfd_create, "doping_specialization", 0);
+#endif
+        if (library.fd >= 0){
+            library.path = "/proc/self/fd/" + to_string(library.fd);
+        }else{
+            library.path = TMPDIR + "doping_tmp_object" + getNextId() + ".so";
+            library.temporary = true;
+        }
+    }
+
+    vector<string> words = split_command(compilercmd);
+    words.push_back("-fPIC");
+    words.push_back("-shared");
+    words.push_back("-x");
+    words.push_back(compiler_language(compilercmd));
+    words.push_back("-");
+    words.push_back("-o");
+    words.push_back(library.path);
+    vector<char *> argv;
+    for (auto& word : words) argv.push_back(&word[0]);
+    argv.push_back(NULL);
+    LOG(DEBUG) << "Compiling (spawn): " << compilercmd << " -fPIC -shared -x " \
+        << compiler_language(compilercmd) << " - -o " << library.path;
+
+    // The source is sent through a socket (instead of a pipe) so writing to
+    // it doesn't raise SIGPIPE if the compiler exits early.
+    int input[2], output[2];
+    if (socketpair(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0, input) != 0){
+        library.output = string("socketpair() failed: ") + strerror(errno);
+        return false;
+    }
+    if (pipe2(output, O_CLOEXEC) != 0){
+        library.output = string("pipe() failed: ") + strerror(errno);
+        close(input[0]);
+        close(input[1]);
+        return false;
+    }
+
+    posix_spawn_file_actions_t actions;
+    posix_spawn_file_actions_init(&actions);
+    posix_spawn_file_actions_adddup2(&actions, input[1], STDIN_FILENO);
+    posix_spawn_file_actions_adddup2(&actions, output[1], STDOUT_FILENO);
+    posix_spawn_file_actions_adddup2(&actions, output[1], STDERR_FILENO);
+    pid_t pid;
+    int error = posix_spawnp(&pid, argv[0], &actions, NULL, argv.data(), environ);
+    posix_spawn_file_actions_destroy(&actions);
+    close(input[1]);
+    close(output[1]);
+    if (error != 0){
+        library.output = string("posix_spawn() failed: ") + strerror(error);
+        close(input[0]);
+        close(output[0]);
+        return false;
+    }
+
+    library.output = communicate(input[0], output[0], source);
+    int status;
+    while (waitpid(pid, &status, 0) < 0 && errno == EINTR);
+
+    struct stat info;
+    return WIFEXITED(status) && WEXITSTATUS(status) == 0 &&
+           stat(library.path.c_str(), &info) == 0 && info.st_size > 0;
+}
+
+CompilerBackend * create_backend(const string& name){
+    if (name == "shell") return new ShellBackend();
+    if (name == "spawn") return new SpawnBackend();
+    if (name == "server") return new ServerBackend(server_socket_path());
+    return NULL;
+}
+
+CompilerBackend * get_backend(){
+    static CompilerBackend * backend = [](){
+        const char * var = std::getenv("DOPING_COMPILER_BACKEND");
+        CompilerBackend * selected = create_backend(var ? var : "spawn");
+        if (selected == NULL){
+            LOG(ERROR) << "Unknown DOPING_COMPILER_BACKEND " << var << ", using 'spawn'.";
+            selected = new SpawnBackend();
+        }
+        return selected;
+    }();
+    return backend;
+}
+
+CompilerBackend * fallback_backend(){
+    static CompilerBackend * backend = new ShellBackend();
+    return backend;
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+
+static string backend_test_source = "\n"
+    "int function(){\n"
+    "    return 7;\n"
+    "}\n";
+
+SCENARIO("Compiler command helpers") {
+    GIVEN("Some compiler commands"){
+        THEN("they are split in words"){
+            REQUIRE(split_command("  gcc -O2   -g ") == vector<string>({"gcc", "-O2", "-g"}));
+        }
+        THEN("the language depends on the compiler"){
+            REQUIRE(compiler_language("gcc -O2") == "c");
+            REQUIRE(compiler_language("/usr/bin/g++ -O2") == "c++");
+            REQUIRE(compiler_language("mpicxx") == "c++");
+        }
+        THEN("commands with shell syntax are not supported by the spawn backend"){
+            REQUIRE(SpawnBackend::supports("gcc -O2 -DN=3"));
+            REQUIRE(!SpawnBackend::supports("gcc -DNAME=\"a b\""));
+            REQUIRE(!SpawnBackend::supports("gcc $CFLAGS"));
+            REQUIRE(!SpawnBackend::supports(""));
+        }
+    }
+}
+
+SCENARIO("Compile with the different backends") {
+
+    GIVEN("The backends"){
+        vector<string> names = {"shell", "spawn"};
+        for (auto& name : names){
+            CompilerBackend * backend = create_backend(name);
+            WHEN("a valid source is compiled with the " + name + " backend"){
+                CompiledLibrary library;
+                bool compiled = backend->compile(backend_test_source, "gcc", "", library);
+                THEN("a library is generated"){
+                    REQUIRE(compiled);
+                    REQUIRE(access(library.path.c_str(), R_OK) == 0);
+                }
+                library.release();
+            }
+            WHEN("an invalid source is compiled with the " + name + " backend"){
+                CompiledLibrary library;
+                bool compiled = backend->compile("int function({", "gcc", "", library);
+                THEN("it fails and returns the compiler errors"){
+                    REQUIRE(!compiled);
+                    REQUIRE(library.output.find("error") != string::npos);
+                }
+                library.release();
+            }
+            delete backend;
+        }
+    }
+    GIVEN("The spawn backend and a library name"){
+        SpawnBackend backend;
+        string libname = TMPDIR + "doping_backend_test_" + getNextId() + ".so";
+        CompiledLibrary library;
+        REQUIRE(backend.compile(backend_test_source, "gcc -O2", libname, library));
+        THEN("the library is generated there"){
+            REQUIRE(library.path == libname);
+            REQUIRE(library.fd < 0);
+            REQUIRE(access(libname.c_str(), R_OK) == 0);
+        }
+        remove(libname.c_str());
+    }
+}
+#endif
@@ -0,0 +1,268 @@
+#include "DecisionPolicy.h"
+#include "log.h"
+
+#include <algorithm>
+#include <cstdlib>
+
+
+using namespace std;
+
+// Compilation time assumed before any specialization has been compiled, and
+// linking time assumed for cached specializations.
+static const double DEFAULT_COMPILE_TIME = 0.5;
+static const double DEFAULT_LINK_TIME = 0.001;
+
+static double env_double(const char * name, double default_value){
+    const char * var = std::getenv(name);
+    if (var == NULL) return default_value;
+    try{
+        return std::stod(var);
+    } catch (std::exception const &e){
+        LOG(ERROR) << "Invalid " << name << " value: " << var;
+        return default_value;
+    }
+}
+
+Decision AlwaysPolicy::decide(const dopingdecisioninfo&){
+    return SPECIALIZE;
+}
+
+Decision NeverPolicy::decide(const dopingdecisioninfo&){
+    return BASELINE;
+}
+
+Decision ThresholdPolicy::decide(const dopingdecisioninfo& info){
+    if (info.progress < this->threshold){
+        LOG(INFO) << info.progress << " < " << this->threshold << " -> Decided to recompile";
+        return SPECIALIZE;
+    }
+    return BASELINE;
+}
+
+double CostModelPolicy::predicted_gain(const dopingdecisioninfo& info){
+    double baseline_time = info.remaining_iterations * info.baseline_iteration_time;
+    return baseline_time * (1.0 - 1.0 / this->speedup) - info.expected_compile_time;
+}
+
+Decision CostModelPolicy::decide(const dopingdecisioninfo& info){
+    if (info.baseline_iteration_time < 0) return SAMPLE;
+    double gain = this->predicted_gain(info);
+    LOG(INFO) << "Cost model: " << info.remaining_iterations << " remaining iterations of " \
+        << info.baseline_iteration_time << " s, compilation " \
+        << info.expected_compile_time << " s -> predicted gain " << gain << " s";
+    return gain > 0 ? SPECIALIZE : BASELINE;
+}
+
+Decision RecordPolicy::decide(const dopingdecisioninfo& info){
+    if (info.baseline_iteration_time < 0) return SAMPLE;
+    return SPECIALIZE;
+}
+
+Decision FunctionPolicy::decide(const dopingdecisioninfo& info){
+    if (info.baseline_iteration_time < 0) return SAMPLE;
+    return this->function(&info) ? SPECIALIZE : BASELINE;
+}
+
+DecisionPolicy * create_policy(const string& name){
+    if (name == "always") return new AlwaysPolicy();
+    if (name == "never") return new NeverPolicy();
+    if (name == "record") return new RecordPolicy();
+    if (name == "threshold") return new ThresholdPolicy(env_double("DOPING_THRESHOLD", 0.5));
+    if (name == "costmodel") return new CostModelPolicy(
+        std::max(1.0, env_double("DOPING_EXPECTED_SPEEDUP", 2.0)));
+    return NULL;
+}
+
+static DecisionPolicy * current_policy = NULL;
+static std::mutex policy_mutex;
+
+DecisionPolicy * get_policy(){
+    lock_guard<std::mutex> lock(policy_mutex);
+    if (current_policy == NULL){
+        const char * var = std::getenv("DOPING_POLICY");
+        if (var != NULL) current_policy = create_policy(var);
+        if (var != NULL && current_policy == NULL){
+            LOG(ERROR) << "Unknown DOPING_POLICY " << var << ", using 'always'.";
+        }
+        if (current_policy == NULL) current_policy = new AlwaysPolicy();
+    }
+    return current_policy;
+}
+
+void set_policy(DecisionPolicy * policy){
+    lock_guard<std::mutex> lock(policy_mutex);
+    delete current_policy;
+    current_policy = policy;
+}
+
+long sample_iterations(){
+    static long iterations = std::max(1L, (long) env_double("DOPING_SAMPLE_ITERATIONS", 64));
+    return iterations;
+}
+
+long count_remaining_iterations(long iteration_start, long iteration_last, long current){
+    long remaining = iteration_start <= iteration_last ? iteration_last - current
+                                                       : current - iteration_last;
+    return std::max(remaining + 1, 0L);
+}
+
+CompileTimeHistory::CompileTimeHistory(){
+    this->sum[0] = this->sum[1] = 0;
+    this->count[0] = this->count[1] = 0;
+}
+
+void CompileTimeHistory::record(double seconds, bool cached){
+    lock_guard<std::mutex> lock(this->mutex);
+    this->sum[cached] += seconds;
+    this->count[cached]++;
+}
+
+double CompileTimeHistory::expected(bool cached){
+    lock_guard<std::mutex> lock(this->mutex);
+    if (this->count[cached] == 0){
+        return cached ? DEFAULT_LINK_TIME : DEFAULT_COMPILE_TIME;
+    }
+    return this->sum[cached] / this->count[cached];
+}
+
+static CompileTimeHistory compile_time_history;
+
+void record_compile_time(double seconds, bool cached){
+    compile_time_history.record(seconds, cached);
+}
+
+double expected_compile_time(bool cached){
+    return compile_time_history.expected(cached);
+}
+
+int dopingSetPolicy(const char * name){
+    DecisionPolicy * policy = create_policy(name);
+    if (policy == NULL){
+        LOG(ERROR) << "Unknown Doping policy " << name;
+        return 0;
+    }
+    set_policy(policy);
+    return 1;
+}
+
+void dopingSetPolicyFunction(dopingpolicyfunction function){
+    set_policy(new FunctionPolicy(function));
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+
+static int policy_test_function(const dopingdecisioninfo * info){
+    return info->remaining_iterations > 10;
+}
+
+SCENARIO("Decision policies") {
+
+    dopingdecisioninfo info = {"loop", 1000, 0.2f, -1.0, 0.5, 0};
+
+    GIVEN("The policies created by name"){
+        THEN("they are the expected policies"){
+            REQUIRE(create_policy("always")->name() == "always");
+            REQUIRE(create_policy("never")->name() == "never");
+            REQUIRE(create_policy("threshold")->name() == "threshold");
+            REQUIRE(create_policy("costmodel")->name() == "costmodel");
+            REQUIRE(create_policy("record")->name() == "record");
+            REQUIRE(create_policy("invalid") == NULL);
+        }
+    }
+    GIVEN("A threshold policy of 0.5"){
+        ThresholdPolicy policy(0.5);
+        THEN("loops before the threshold are specialized"){
+            REQUIRE(policy.decide(info) == SPECIALIZE);
+            info.progress = 0.7f;
+            REQUIRE(policy.decide(info) == BASELINE);
+        }
+    }
+    GIVEN("A cost model policy expecting a 2x speedup"){
+        CostModelPolicy policy(2.0);
+        WHEN("the baseline has not been measured"){
+            THEN("it needs a sample"){
+                REQUIRE(policy.decide(info) == SAMPLE);
+            }
+        }
+        WHEN("the remaining iterations take more than twice the compilation"){
+            info.baseline_iteration_time = 0.002;
+            THEN("it is specialized"){
+                REQUIRE(policy.predicted_gain(info) == Approx(0.5));
+                REQUIRE(policy.decide(info) == SPECIALIZE);
+            }
+        }
+        WHEN("the remaining iterations are too cheap"){
+            info.baseline_iteration_time = 0.0001;
+            THEN("it is not specialized"){
+                REQUIRE(policy.decide(info) == BASELINE);
+            }
+            info.cached = 1;
+            info.expected_compile_time = 0.001;
+            THEN("unless the specialization is cached"){
+                REQUIRE(policy.decide(info) == SPECIALIZE);
+            }
+        }
+    }
+    GIVEN("A record policy"){
+        RecordPolicy policy;
+        THEN("it samples first and then always specializes"){
+            REQUIRE(policy.decide(info) == SAMPLE);
+            info.baseline_iteration_time = 1e-9;
+            REQUIRE(policy.decide(info) == SPECIALIZE);
+        }
+    }
+    GIVEN("A user-defined function policy"){
+        FunctionPolicy policy(policy_test_function);
+        THEN("it samples first and then uses the function decision"){
+            REQUIRE(policy.decide(info) == SAMPLE);
+            info.baseline_iteration_time = 0.1;
+            REQUIRE(policy.decide(info) == SPECIALIZE);
+            info.remaining_iterations = 5;
+            REQUIRE(policy.decide(info) == BASELINE);
+        }
+    }
+}
+
+SCENARIO("Remaining iterations") {
+    GIVEN("A loop from 0 to 49 (i < 50)"){
+        THEN("the iterations left include the current one"){
+            REQUIRE(count_remaining_iterations(0, 49, 0) == 50);
+            REQUIRE(count_remaining_iterations(0, 49, 10) == 40);
+            REQUIRE(count_remaining_iterations(0, 49, 49) == 1);
+            REQUIRE(count_remaining_iterations(0, 49, 50) == 0);
+        }
+    }
+    GIVEN("A loop from 10 down to 1 (i > 0)"){
+        THEN("the iterations are counted down"){
+            REQUIRE(count_remaining_iterations(10, 1, 10) == 10);
+            REQUIRE(count_remaining_iterations(10, 1, 1) == 1);
+        }
+    }
+    GIVEN("A loop with a single iteration"){
+        THEN("it has one iteration left"){
+            REQUIRE(count_remaining_iterations(5, 5, 5) == 1);
+        }
+    }
+}
+
+SCENARIO("Compile time history") {
+    CompileTimeHistory history;
+
+    GIVEN("No previous compilations"){
+        THEN("the default estimates are used"){
+            REQUIRE(history.expected(false) == Approx(0.5));
+            REQUIRE(history.expected(true) == Approx(0.001));
+        }
+    }
+    GIVEN("Two previous compilations"){
+        history.record(1.0, false);
+        history.record(2.0, false);
+        THEN("the estimate is their average"){
+            REQUIRE(history.expected(false) == Approx(1.5));
+            REQUIRE(history.expected(true) == Approx(0.001));
+        }
+    }
+}
+#endif
@@ -1,7 +1,11 @@
 #include "DynamicFunction.h"
+#include "CompilerBackend.h"
 #include "SourceRenderingEngine.h"
+#include "SpecializationCache.h"
 #include "log.h"
 
+#include <atomic>
+#include <chrono>
 #include <fstream>
 #include <cerrno>
 #include <cstring>
@@ -9,17 +13,37 @@
 #include <sstream>
 #include <dlfcn.h>
 #include <stdio.h>
+#include <sys/wait.h>
+#include <unistd.h>
 
 
 using namespace std;
 
-static int sNextId = 0;
-// Use /tmp but it may be system-specific and could be a security issue
-static string TMPDIR = "/tmp/";
-string getNextId() { return to_string(++sNextId); }
+static std::atomic<int> sNextId(0);
+// The process id is part of the unique ID as multiple processes (e.g. MPI
+// ranks) may be compiling specializations at the same time.
+string getNextId() { return to_string(getpid()) + "_" + to_string(++sNextId); }
 
-string run_shell(const string& cmd) {
-    char buffer[128];
+// Persistent cache of compiled specializations, only used if DOPING_CACHE_DIR
+// is defined.
+static SpecializationCache * getCache(){
+    static SpecializationCache * cache = SpecializationCache::from_environment();
+    return cache;
+}
+
+// Read-only specializations precompiled when the executable was built.
+static SpecializationCache * getShippedCache(){
+    static SpecializationCache * shipped = SpecializationCache::shipped();
+    return shipped;
+}
+
+static double now_seconds(){
+    chrono::duration<double> now = chrono::steady_clock::now().time_since_epoch();
+    return now.count();
+}
+
+string run_shell(const string& cmd, int * status) {
+    char buffer[4096];
     std::string result = "";
     FILE* pipe = popen( (cmd + " 2>&1").c_str(), "r");
     if (!pipe){
@@ -27,10 +51,12 @@ string run_shell(const string& cmd) {
 		exit(-1);
 	}
 
-    while (!feof(pipe)) {
-    	if (fgets(buffer, 128, pipe) != NULL) result += buffer;
+    size_t size;
+    while ((size = fread(buffer, 1, sizeof(buffer), pipe)) > 0) {
+        result.append(buffer, size);
     }
-    pclose(pipe);
+    int exit_status = pclose(pipe);
+    if (status) *status = WIFEXITED(exit_status) ? WEXITSTATUS(exit_status) : -1;
     return result;
 }
 
@@ -38,6 +64,13 @@ DynamicFunction::DynamicFunction(const string& source,
                                  const string& parameters){
 
     LOG(DEBUG) << "Creating DynamicFunction" << source << parameters;
+    double start = now_seconds();
+    this->functionPointer = NULL;
+    this->linked_library = NULL;
+    this->library_fd = -1;
+    this->cached = false;
+    this->render_time = 0;
+    this->link_time = 0;
 
     // Transform comma-separated list into parameters map
     map<string, string> parmap;
@@ -59,66 +92,134 @@ DynamicFunction::DynamicFunction(const string& source,
     string newsource = render(source, parmap);
     LOG(DEBUG_LONG) << " Rendered source = " << newsource;
     this->rendered_source.append(newsource);
+    this->render_time = now_seconds() - start;
 }
 
-void DynamicFunction::compile_and_link(const string& compilercmd) {
-    // Get a unique ID
-    string uid = getNextId();
-
-    // FIXME: It should maintain the same file extension as the original
-    string filename = TMPDIR + "doping_tmp_file_" + uid + ".c";
-
-    // Open a temporal file (is it possible to compile from a stream instead?)
-    ofstream tmpfile(filename, ofstream::out | ofstream::trunc);
-    if(tmpfile.fail() || !tmpfile.is_open()){
-        LOG(ERROR) << " Error opening" << filename << "file: (errno" \
-            << errno <<") " << strerror(errno);
-        throw std::runtime_error("Error opening " + filename);
+// Compile the source with the selected backend (or the fallback backend if it
+// fails) into libname, or where the backend chooses if it is empty. Returns
+// whether it compiled, the compiler output is kept in the library.
+static bool compile_library(const string& source, const string& compilercmd,
+                            const string& libname, CompiledLibrary& library){
+    CompilerBackend * backend = get_backend();
+    bool compiled = backend->compile(source, compilercmd, libname, library);
+    if (!compiled && backend != fallback_backend()){
+        LOG(DEBUG) << "The " << backend->name() << " backend failed, using the " \
+            << fallback_backend()->name() << " backend:";
+        LOG(DEBUG) << library.output;
+        library.release();
+        library = CompiledLibrary();
+        backend = fallback_backend();
+        compiled = backend->compile(source, compilercmd, libname, library);
     }
-
-    // NOTE: An option here would be to encapsulate rendered source
-    // in a function that passes parameters and functions used?
-    // Delegate the responsability to the passed source for now.
-
-    // Write the output into the temporal file 
-    tmpfile << this->rendered_source;
-    tmpfile.close();
-    LOG(DEBUG) << "Saving rendered source to " << filename;
+    LOG(DEBUG) << "Compilation output (" << backend->name() << " backend):";
+    LOG(DEBUG) << library.output;
 
     if (std::getenv("DOPING_SAVE_FILES") != NULL){
+        string uid = getNextId();
         string savefilename = "doping_loop_" + uid + ".c";
         ofstream savefile(savefilename, ofstream::out | ofstream::trunc);
         if(savefile.fail() || !savefile.is_open()){
+            library.release();
             throw std::runtime_error("Error opening " + savefilename);
         }
-        savefile << this->rendered_source;
+        savefile << source;
         savefile.close();
-    }
-
-    // Compile with -fPIC and -shared flags in addition to the original ones
-    string libname = TMPDIR + "doping_tmp_object" + uid + ".so";
-    string command = compilercmd + " -fPIC -shared " + filename + " -o " + libname;
-    LOG(DEBUG) << "Compiling: " << command;
-	string result = run_shell(command);
-    LOG(DEBUG) << "Compilation output:";
-    LOG(DEBUG) << result;
-    if (std::getenv("DOPING_SAVE_FILES") != NULL){
-        string savefilename = "doping_loop_" + uid + ".compiler.out";
-        ofstream savefile(savefilename, ofstream::out | ofstream::trunc);
+        savefilename = "doping_loop_" + uid + ".compiler.out";
+        savefile.open(savefilename, ofstream::out | ofstream::trunc);
         if(savefile.fail() || !savefile.is_open()){
+            library.release();
             throw std::runtime_error("Error opening " + savefilename);
         }
-        savefile << result;
+        savefile << library.output;
         savefile.close();
     }
+    return compiled;
+}
+
+bool DynamicFunction::link_cached(SpecializationCache * cache, const string& key){
+    string cachedname = cache->lookup(key);
+    if (cachedname.empty()) return false;
+    LOG(INFO) << "Specialization found in the cache: " << cachedname;
+    try {
+        this->link(cachedname);
+        this->cached = true;
+        return true;
+    } catch(exception& e){
+        // It may have been evicted meanwhile, compile it again
+        LOG(INFO) << "Failed to link cached specialization, compiling it again.";
+        return false;
+    }
+}
+
+void DynamicFunction::compile_and_link(const string& compilercmd) {
+    // Check if this specialization was precompiled when the executable was
+    // built, or compiled by a previous execution.
+    SpecializationCache * shipped = getShippedCache();
+    SpecializationCache * cache = getCache();
+    string key;
+    if (shipped || cache) key = SpecializationCache::key(this->rendered_source, compilercmd);
+    if (shipped && this->link_cached(shipped, key)) return;
+    if (cache && this->link_cached(cache, key)) return;
+
+    // When the cache is enabled, the library is generated inside the cache
+    // directory so it can be published with an atomic rename. Otherwise the
+    // backend chooses where to put it.
+    string libname;
+    if (cache) libname = cache->temporary_path(key);
+
+    CompiledLibrary library;
+    if (!compile_library(this->rendered_source, compilercmd, libname, library)){
+        LOG(ERROR) << library.output;
+        library.release();
+        throw std::runtime_error("Failed to compile the specialization");
+    }
 
-    if ( remove(filename.c_str())!= 0 ){
-        throw std::runtime_error("Error deleting " + filename);
-        LOG(ERROR) << "Could not delete the file:" << filename;
+    if (cache){
+        this->link(cache->publish(key, library.path));
+        return;
     }
 
+    try {
+        this->link(library.path);
+    } catch(exception& e){
+        library.release();
+        throw;
+    }
+    // The in-memory file is kept open while the library is linked
+    this->library_fd = library.fd;
+    library.fd = -1;
+    library.release();
+}
+
+string DynamicFunction::precompile(const string& compilercmd, SpecializationCache& cache){
+    string key = SpecializationCache::key(this->rendered_source, compilercmd);
+    string cachedname = cache.lookup(key);
+    if (!cachedname.empty()) return cachedname;
+
+    CompiledLibrary library;
+    if (!compile_library(this->rendered_source, compilercmd, cache.temporary_path(key),
+                         library)){
+        LOG(ERROR) << library.output;
+        library.release();
+        throw std::runtime_error("Failed to compile the specialization");
+    }
+    return cache.publish(key, library.path);
+}
+
+bool DynamicFunction::in_cache(const string& compilercmd) {
+    SpecializationCache * shipped = getShippedCache();
+    SpecializationCache * cache = getCache();
+    if (!shipped && !cache) return false;
+    string key = SpecializationCache::key(this->rendered_source, compilercmd);
+    return (shipped && !shipped->lookup(key).empty()) ||
+           (cache && !cache->lookup(key).empty());
+}
+
+void DynamicFunction::link(const string& libname) {
     // Link new object file to current executable
+    double start = now_seconds();
     this->linked_library = dlopen(libname.c_str(), RTLD_NOW);
+    this->link_time += now_seconds() - start;
     if (!this->linked_library) {
         LOG(ERROR) << "Failed to open library .so: \n" << dlerror();
         throw std::runtime_error("Failed to open library .so");
@@ -130,17 +231,12 @@ void DynamicFunction::compile_and_link(const string& compilercmd) {
         throw std::runtime_error("Failed to locate function:");
     }
 	LOG(DEBUG) << "Loop symbol resolved";
-
-    if ( remove(libname.c_str())!= 0 ){
-        LOG(ERROR) << "Could not delete the file:" << libname;
-    }
-    // Note that I am not calling dlclose() anywhere. Fix?
-    // I can delete test.c and test.so here?
 }
 
 DynamicFunction::~DynamicFunction(){
     LOG(DEBUG) << "Dynamic Function destructed";
     if (this->linked_library) dlclose(this->linked_library);
+    if (this->library_fd >= 0) close(this->library_fd);
 
 }
 
@@ -194,6 +290,30 @@ SCENARIO("Simple source with no parameters") {
     }
 }
 
+SCENARIO("Precompile a specialization") {
+
+    string source = "\n"
+        "int function(){\n"
+        "    return /*<DOPING A >*/;\n"
+        "}\n";
+    string directory = "/tmp/doping_precompile_test_" + getNextId();
+    SpecializationCache cache(directory, 1024 * 1024);
+
+    GIVEN("A specialization precompiled into a cache"){
+        DynamicFunction df(source, "A:7");
+        string libname = df.precompile("gcc", cache);
+        THEN("it is in the cache but not loaded"){
+            REQUIRE(libname == cache.lookup(cache.key(df.get_rendered_source(), "gcc")));
+            REQUIRE(df.get_fp() == NULL);
+        }
+        THEN("precompiling it again reuses the library"){
+            DynamicFunction again(source, "A:7");
+            REQUIRE(again.precompile("gcc", cache) == libname);
+        }
+    }
+    run_shell("rm -rf " + directory);
+}
+
 SCENARIO("Simple source with 2 parameters") {
 
     string source = "\n"
@@ -0,0 +1,339 @@
+#include "RuntimeTrace.h"
+#include "log.h"
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <sstream>
+#include <utility>
+#include <vector>
+
+#include <unistd.h>
+
+
+using namespace std;
+
+static double now_seconds(){
+    chrono::duration<double> now = chrono::steady_clock::now().time_since_epoch();
+    return now.count();
+}
+
+static long long to_nanoseconds(double seconds){
+    return (long long) (seconds * 1e9);
+}
+
+static string seconds_string(long long nanoseconds){
+    return to_string(nanoseconds / 1e9);
+}
+
+// Replace %p with the process id.
+static string expand_pid(const string& path){
+    string result = path;
+    size_t pos = result.find("%p");
+    while (pos != string::npos){
+        result.replace(pos, 2, to_string(getpid()));
+        pos = result.find("%p", pos);
+    }
+    return result;
+}
+
+string json_string(const string& value){
+    string result = "\"";
+    for (char c : value){
+        switch (c){
+            case '"': result += "\\\""; break;
+            case '\\': result += "\\\\"; break;
+            case '\n': result += "\\n"; break;
+            case '\t': result += "\\t"; break;
+            default:
+                if ((unsigned char) c < 0x20){
+                    char escaped[8];
+                    snprintf(escaped, sizeof(escaped), "\\u%04x", c);
+                    result += escaped;
+                }else{
+                    result += c;
+                }
+        }
+    }
+    return result + "\"";
+}
+
+static string csv_string(const string& value){
+    string result = "\"";
+    for (char c : value){
+        if (c == '"') result += '"';
+        result += c;
+    }
+    return result + "\"";
+}
+
+// Name and value (already formatted) of each field of the loop summary.
+static vector<pair<string, string> > loop_fields(LoopTrace * loop){
+    vector<pair<string, string> > fields;
+    fields.push_back(make_pair("entries", to_string(loop->entries.load())));
+    fields.push_back(make_pair("call_site_hits", to_string(loop->call_site_hits.load())));
+    fields.push_back(make_pair("table_hits", to_string(loop->table_hits.load())));
+    fields.push_back(make_pair("table_misses", to_string(loop->table_misses.load())));
+    fields.push_back(make_pair("compilations", to_string(loop->compilations.load())));
+    fields.push_back(make_pair("cache_hits", to_string(loop->cache_hits.load())));
+    fields.push_back(make_pair("failures", to_string(loop->failures.load())));
+    fields.push_back(make_pair("specialized_runs", to_string(loop->specialized_runs.load())));
+    fields.push_back(make_pair("baseline_fallbacks",
+                               to_string(loop->baseline_fallbacks.load())));
+    fields.push_back(make_pair("render_time", seconds_string(loop->render_time.load())));
+    fields.push_back(make_pair("compile_time", seconds_string(loop->compile_time.load())));
+    fields.push_back(make_pair("dlopen_time", seconds_string(loop->dlopen_time.load())));
+    fields.push_back(make_pair("specialized_time",
+                               seconds_string(loop->specialized_time.load())));
+    fields.push_back(make_pair("executions", to_string(loop->executions.load())));
+    fields.push_back(make_pair("iterations", to_string(loop->iterations.load())));
+    fields.push_back(make_pair("specialized_iterations",
+                               to_string(loop->specialized_iterations.load())));
+    fields.push_back(make_pair("sampled_iterations",
+                               to_string(loop->sampled_iterations.load())));
+    fields.push_back(make_pair("sampled_time", seconds_string(loop->sampled_time.load())));
+    return fields;
+}
+
+LoopTrace::LoopTrace(RuntimeTrace * owner, const string& name)
+    : owner(owner), name(name), entries(0), call_site_hits(0), table_hits(0),
+      table_misses(0), compilations(0), cache_hits(0), failures(0), specialized_runs(0),
+      baseline_fallbacks(0), render_time(0), compile_time(0), dlopen_time(0),
+      specialized_time(0), executions(0), iterations(0), specialized_iterations(0),
+      sampled_iterations(0), sampled_time(0){
+}
+
+void LoopTrace::entry(bool call_site_hit, long trip_count){
+    this->entries.fetch_add(1, memory_order_relaxed);
+    if (call_site_hit) this->call_site_hits.fetch_add(1, memory_order_relaxed);
+    if (trip_count >= 0){
+        this->executions.fetch_add(1, memory_order_relaxed);
+        this->iterations.fetch_add(trip_count, memory_order_relaxed);
+    }
+}
+
+void LoopTrace::table_lookup(bool hit){
+    if (hit) this->table_hits.fetch_add(1, memory_order_relaxed);
+    else this->table_misses.fetch_add(1, memory_order_relaxed);
+}
+
+void LoopTrace::compilation(const string& parameters, double render, double compile,
+                            double dlopen, bool cached, bool succeeded){
+    if (succeeded) this->compilations.fetch_add(1, memory_order_relaxed);
+    else this->failures.fetch_add(1, memory_order_relaxed);
+    if (cached) this->cache_hits.fetch_add(1, memory_order_relaxed);
+    this->render_time.fetch_add(to_nanoseconds(render), memory_order_relaxed);
+    this->compile_time.fetch_add(to_nanoseconds(compile), memory_order_relaxed);
+    this->dlopen_time.fetch_add(to_nanoseconds(dlopen), memory_order_relaxed);
+    this->owner->event(this->name, succeeded ? "compile" : "failure",
+        "\"parameters\": " + json_string(parameters) +
+        ", \"render_time\": " + to_string(render) +
+        ", \"compile_time\": " + to_string(compile) +
+        ", \"dlopen_time\": " + to_string(dlopen) +
+        ", \"cached\": " + (cached ? "true" : "false"));
+}
+
+void LoopTrace::specialized_run(double seconds, long iterations){
+    this->specialized_runs.fetch_add(1, memory_order_relaxed);
+    this->specialized_time.fetch_add(to_nanoseconds(seconds), memory_order_relaxed);
+    this->specialized_iterations.fetch_add(iterations, memory_order_relaxed);
+    this->owner->event(this->name, "run", "\"seconds\": " + to_string(seconds) +
+                       ", \"iterations\": " + to_string(iterations));
+}
+
+void LoopTrace::baseline_sample(long iterations, double seconds){
+    this->sampled_iterations.fetch_add(iterations, memory_order_relaxed);
+    this->sampled_time.fetch_add(to_nanoseconds(seconds), memory_order_relaxed);
+}
+
+void LoopTrace::baseline(const char * reason){
+    this->baseline_fallbacks.fetch_add(1, memory_order_relaxed);
+    this->owner->event(this->name, "baseline", "\"reason\": " + json_string(reason));
+}
+
+RuntimeTrace::RuntimeTrace(const string& path, const string& events_path)
+    : path(path), start_time(now_seconds()){
+    if (!events_path.empty()){
+        this->events.open(events_path, ofstream::out | ofstream::trunc);
+        if (!this->events.is_open()){
+            LOG(ERROR) << "Could not open the trace events file " << events_path;
+        }
+    }
+}
+
+RuntimeTrace::~RuntimeTrace(){
+    for (auto& loop : this->loops) delete loop.second;
+}
+
+RuntimeTrace * RuntimeTrace::from_environment(){
+    const char * path = std::getenv("DOPING_TRACE");
+    if (path == NULL || string(path).empty()) return NULL;
+    const char * events_path = std::getenv("DOPING_TRACE_EVENTS");
+    return new RuntimeTrace(expand_pid(path),
+                            events_path ? expand_pid(events_path) : string());
+}
+
+LoopTrace * RuntimeTrace::loop(const string& name){
+    lock_guard<std::mutex> lock(this->mutex);
+    auto search = this->loops.find(name);
+    if (search != this->loops.end()) return search->second;
+    LoopTrace * loop = new LoopTrace(this, name);
+    this->loops.insert(make_pair(name, loop));
+    return loop;
+}
+
+void RuntimeTrace::event(const string& loop, const string& event, const string& fields){
+    if (!this->events.is_open()) return;
+    string line = "{\"time\": " + to_string(now_seconds() - this->start_time) +
+                  ", \"loop\": " + json_string(loop) +
+                  ", \"event\": " + json_string(event);
+    if (!fields.empty()) line += ", " + fields;
+    line += "}\n";
+    lock_guard<std::mutex> lock(this->events_mutex);
+    this->events << line;
+    this->events.flush();
+}
+
+string RuntimeTrace::to_json(){
+    lock_guard<std::mutex> lock(this->mutex);
+    ostringstream json;
+    json << "{\"pid\": " << getpid() << ", \"elapsed\": "
+         << to_string(now_seconds() - this->start_time) << ", \"loops\": [";
+    bool first = true;
+    for (auto& loop : this->loops){
+        json << (first ? "\n" : ",\n") << "  {\"name\": " << json_string(loop.first);
+        for (auto& field : loop_fields(loop.second)){
+            json << ", \"" << field.first << "\": " << field.second;
+        }
+        json << "}";
+        first = false;
+    }
+    json << "\n]}\n";
+    return json.str();
+}
+
+string RuntimeTrace::to_csv(){
+    lock_guard<std::mutex> lock(this->mutex);
+    ostringstream csv;
+    LoopTrace header(this, "");
+    csv << "name";
+    for (auto& field : loop_fields(&header)) csv << "," << field.first;
+    csv << "\n";
+    for (auto& loop : this->loops){
+        csv << csv_string(loop.first);
+        for (auto& field : loop_fields(loop.second)) csv << "," << field.second;
+        csv << "\n";
+    }
+    return csv.str();
+}
+
+bool RuntimeTrace::write(){
+    bool csv = this->path.size() >= 4 &&
+               this->path.compare(this->path.size() - 4, 4, ".csv") == 0;
+    ofstream file(this->path, ofstream::out | ofstream::trunc);
+    if (!file.is_open()){
+        LOG(ERROR) << "Could not write the runtime trace in " << this->path;
+        return false;
+    }
+    file << (csv ? this->to_csv() : this->to_json());
+    file.close();
+    LOG(INFO) << "Runtime trace written in " << this->path;
+    return !file.fail();
+}
+
+static void write_runtime_trace(){
+    get_runtime_trace()->write();
+}
+
+RuntimeTrace * get_runtime_trace(){
+    static RuntimeTrace * trace = [](){
+        RuntimeTrace * trace = RuntimeTrace::from_environment();
+        if (trace) atexit(write_runtime_trace);
+        return trace;
+    }();
+    return trace;
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+#include <sstream>
+
+static string read_file(const string& filename){
+    ifstream file(filename);
+    stringstream content;
+    content << file.rdbuf();
+    return content.str();
+}
+
+SCENARIO("Runtime trace of the loops") {
+    char tmpl[] = "/tmp/doping_trace_test_XXXXXX";
+    string directory(mkdtemp(tmpl));
+
+    GIVEN("A trace with the events of a loop"){
+        RuntimeTrace trace(directory + "/trace.json", directory + "/events.jsonl");
+        LoopTrace * loop = trace.loop("file.c:10");
+        loop->entry(false, 100);
+        loop->table_lookup(false);
+        loop->compilation("n:\"100\"", 0.5, 1.0, 0.25, false, true);
+        loop->specialized_run(2.0, 100);
+        loop->entry(true, 50);
+        loop->baseline_sample(10, 0.5);
+        loop->entry(true);
+        loop->specialized_run(1.0, 40);
+        loop->entry(false);
+        loop->table_lookup(true);
+        loop->baseline("pending");
+
+        THEN("the loop traces are shared by name"){
+            REQUIRE(trace.loop("file.c:10") == loop);
+            REQUIRE(trace.loop("other.c:1") != loop);
+        }
+        THEN("the counters and times are accumulated"){
+            REQUIRE(loop->entries == 4);
+            REQUIRE(loop->call_site_hits == 2);
+            REQUIRE(loop->table_hits == 1);
+            REQUIRE(loop->table_misses == 1);
+            REQUIRE(loop->compilations == 1);
+            REQUIRE(loop->cache_hits == 0);
+            REQUIRE(loop->specialized_runs == 2);
+            REQUIRE(loop->baseline_fallbacks == 1);
+            REQUIRE(loop->compile_time == 1000000000);
+            REQUIRE(loop->specialized_time == 3000000000);
+            REQUIRE(loop->executions == 2);
+            REQUIRE(loop->iterations == 150);
+            REQUIRE(loop->specialized_iterations == 140);
+            REQUIRE(loop->sampled_iterations == 10);
+            REQUIRE(loop->sampled_time == 500000000);
+        }
+        THEN("the summary is written as JSON"){
+            REQUIRE(trace.write());
+            string json = read_file(directory + "/trace.json");
+            REQUIRE(json.find("{\"name\": \"file.c:10\", \"entries\": 4,") != string::npos);
+            REQUIRE(json.find("\"compile_time\": 1.000000") != string::npos);
+            REQUIRE(json.find("\"iterations\": 150, \"specialized_iterations\": 140")
+                    != string::npos);
+            REQUIRE(json.find("\"pid\": " + to_string(getpid())) == 1);
+        }
+        THEN("each event is streamed as a JSON line"){
+            string events = read_file(directory + "/events.jsonl");
+            REQUIRE(count(events.begin(), events.end(), '\n') == 4);
+            REQUIRE(events.find("\"event\": \"compile\", \"parameters\": \"n:\\\"100\\\"\"")
+                    != string::npos);
+            REQUIRE(events.find("\"event\": \"baseline\", \"reason\": \"pending\"")
+                    != string::npos);
+        }
+    }
+    GIVEN("A trace written as CSV"){
+        RuntimeTrace trace(directory + "/trace.csv");
+        trace.loop("a.c:1")->entry(true);
+        THEN("there is a header and a row per loop"){
+            REQUIRE(trace.write());
+            string csv = read_file(directory + "/trace.csv");
+            REQUIRE(csv.find("name,entries,call_site_hits,") == 0);
+            REQUIRE(csv.find("\n\"a.c:1\",1,1,0,") != string::npos);
+        }
+    }
+}
+#endif
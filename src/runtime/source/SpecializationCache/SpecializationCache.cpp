@@ -0,0 +1,291 @@
+#include "SpecializationCache.h"
+#include "DynamicFunction.h"
+#include "log.h"
+
+#include <algorithm>
+#include <atomic>
+#include <cerrno>
+#include <cstdio>
+#include <climits>
+#include <cstring>
+#include <ctime>
+#include <map>
+#include <mutex>
+#include <sstream>
+#include <stdexcept>
+#include <utility>
+#include <vector>
+
+#include <dirent.h>
+#include <stdint.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <unistd.h>
+#include <utime.h>
+
+
+using namespace std;
+
+static const string LIBEXT = ".so";
+static const unsigned long DEFAULT_MAX_SIZE = 256; // MB
+// Age after which a temporary file is considered left behind by a process
+// that died before publishing it
+static const time_t TEMPORARY_GRACE_PERIOD = 3600; // seconds
+
+// 64-bit FNV-1a hash
+static uint64_t fnv1a(const string& data, uint64_t hash){
+    for (size_t i = 0; i < data.length(); i++){
+        hash ^= (unsigned char) data[i];
+        hash *= 1099511628211ULL;
+    }
+    return hash;
+}
+
+static string to_hex(uint64_t value){
+    char buffer[17];
+    snprintf(buffer, sizeof(buffer), "%016llx", (unsigned long long) value);
+    return string(buffer);
+}
+
+void make_directories(const string& path){
+    size_t pos = 0;
+    while (pos != string::npos){
+        pos = path.find('/', pos + 1);
+        string partial = path.substr(0, pos);
+        if (mkdir(partial.c_str(), 0700) != 0 && errno != EEXIST){
+            throw std::runtime_error("Error creating directory " + partial +
+                                     ": " + strerror(errno));
+        }
+    }
+}
+
+string compiler_version(const string& compilercmd){
+    // The compiler is the first word of the command, its version is only
+    // queried once per execution.
+    static map<string, string> versions;
+    static std::mutex versions_mutex;
+    stringstream ss(compilercmd);
+    string compiler;
+    ss >> compiler;
+    lock_guard<std::mutex> lock(versions_mutex);
+    auto search = versions.find(compiler);
+    if (search != versions.end()) return search->second;
+
+    string version = run_shell(compiler + " --version");
+    versions[compiler] = version;
+    return version;
+}
+
+SpecializationCache::SpecializationCache(const string& directory,
+                                         unsigned long max_size){
+    this->directory = directory;
+    this->max_size = max_size;
+    make_directories(directory);
+}
+
+unsigned long cache_max_size(){
+    unsigned long max_size = DEFAULT_MAX_SIZE;
+    const char * size = std::getenv("DOPING_CACHE_MAX_SIZE");
+    if (size != NULL){
+        try{
+            max_size = std::stoul(size);
+        } catch (std::exception const &e){
+            LOG(ERROR) << "Invalid DOPING_CACHE_MAX_SIZE value: " << size;
+        }
+    }
+    return max_size * 1024 * 1024;
+}
+
+SpecializationCache * SpecializationCache::from_environment(){
+    const char * root = std::getenv("DOPING_CACHE_DIR");
+    if (root == NULL || string(root).empty()) return NULL;
+    return new SpecializationCache(string(root) + "/specializations", cache_max_size());
+}
+
+SpecializationCache * SpecializationCache::shipped(){
+    string directory;
+    const char * path = std::getenv("DOPING_SPECIALIZATIONS_DIR");
+    if (path != NULL){
+        directory = path;
+    }else{
+        char executable[PATH_MAX];
+        ssize_t length = readlink("/proc/self/exe", executable, sizeof(executable) - 1);
+        if (length <= 0) return NULL;
+        directory = string(executable, length) + ".doping";
+    }
+    struct stat info;
+    if (directory.empty() || stat(directory.c_str(), &info) != 0 || !S_ISDIR(info.st_mode)){
+        return NULL;
+    }
+    LOG(INFO) << "Using the precompiled specializations in " << directory;
+    // They are never evicted
+    return new SpecializationCache(directory, ULONG_MAX);
+}
+
+string SpecializationCache::key(const string& source, const string& compilercmd){
+    string data = source + '\0' + compilercmd + '\0' + compiler_version(compilercmd);
+    // Two hashes with different offset basis to make collisions negligible
+    return to_hex(fnv1a(data, 14695981039346656037ULL)) +
+           to_hex(fnv1a(data, 0x6c62272e07bb0142ULL));
+}
+
+string SpecializationCache::lookup(const string& key){
+    string libname = this->directory + "/" + key + LIBEXT;
+    if (access(libname.c_str(), R_OK) != 0) return string();
+    // Record the use for the LRU eviction (it doesn't matter if it fails)
+    utime(libname.c_str(), NULL);
+    return libname;
+}
+
+string SpecializationCache::temporary_path(const string& key){
+    static std::atomic<int> sNextTmp(0);
+    return this->directory + "/." + key + "." + to_string(getpid()) + "." +
+           to_string(++sNextTmp) + LIBEXT;
+}
+
+string SpecializationCache::publish(const string& key, const string& libname){
+    string cachedname = this->directory + "/" + key + LIBEXT;
+    // rename is atomic, concurrent readers will find the old file, the new
+    // file or nothing, but never a partially written one.
+    if (rename(libname.c_str(), cachedname.c_str()) != 0){
+        LOG(ERROR) << "Could not add " << libname << " to the cache: " << strerror(errno);
+        return libname;
+    }
+    LOG(DEBUG) << "Added " << cachedname << " into the specialization cache";
+    this->evict();
+    return cachedname;
+}
+
+void SpecializationCache::evict(){
+    DIR * dir = opendir(this->directory.c_str());
+    if (dir == NULL) return;
+
+    // List of (last use, size, path) of all published entries
+    vector<pair<time_t, pair<unsigned long, string> > > entries;
+    unsigned long total = 0;
+    time_t now = time(NULL);
+    struct dirent * entry;
+    while ((entry = readdir(dir)) != NULL){
+        string name(entry->d_name);
+        if (name.length() <= LIBEXT.length() + 1 ||
+            name.compare(name.length() - LIBEXT.length(), LIBEXT.length(), LIBEXT) != 0){
+            continue;
+        }
+        string path = this->directory + "/" + name;
+        struct stat info;
+        if (stat(path.c_str(), &info) != 0) continue;
+        if (name[0] == '.'){
+            // Temporary files being generated are not entries, but the
+            // old ones will never be published
+            if (now - info.st_mtime > TEMPORARY_GRACE_PERIOD &&
+                remove(path.c_str()) == 0){
+                LOG(DEBUG) << "Removed stale temporary file " << path << " from the cache";
+            }
+            continue;
+        }
+        entries.push_back(make_pair(info.st_mtime,
+                                    make_pair((unsigned long) info.st_size, path)));
+        total += info.st_size;
+    }
+    closedir(dir);
+
+    // Remove the least recently used entries first. Processes that already
+    // opened them are not affected.
+    sort(entries.begin(), entries.end());
+    for (size_t i = 0; i < entries.size() && total > this->max_size; i++){
+        if (remove(entries[i].second.second.c_str()) == 0){
+            LOG(DEBUG) << "Evicted " << entries[i].second.second << " from the cache";
+            total -= entries[i].second.first;
+        }
+    }
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+#include <fstream>
+
+static string make_tmp_directory(){
+    char tmpl[] = "/tmp/doping_cache_test_XXXXXX";
+    return string(mkdtemp(tmpl));
+}
+
+static string write_file(const string& filename, const string& content){
+    ofstream file(filename, ofstream::out | ofstream::trunc);
+    file << content;
+    file.close();
+    return filename;
+}
+
+SCENARIO("Specialization cache keys") {
+    SpecializationCache cache(make_tmp_directory(), 1024);
+
+    GIVEN("The same source and compiler command"){
+        THEN("the key is the same"){
+            REQUIRE(cache.key("source", "gcc -O2") == cache.key("source", "gcc -O2"));
+            REQUIRE(cache.key("source", "gcc -O2").length() == 32);
+        }
+    }
+    GIVEN("A different source or compiler command"){
+        THEN("the key is different"){
+            REQUIRE(cache.key("source", "gcc -O2") != cache.key("source2", "gcc -O2"));
+            REQUIRE(cache.key("source", "gcc -O2") != cache.key("source", "gcc -O3"));
+        }
+    }
+}
+
+SCENARIO("Publish and lookup specializations") {
+    string directory = make_tmp_directory();
+
+    GIVEN("An empty cache"){
+        SpecializationCache cache(directory + "/nested/dir", 1024);
+        string key = cache.key("source", "gcc");
+
+        WHEN("an entry is not published"){
+            THEN("it is not found"){
+                REQUIRE(cache.lookup(key).empty());
+            }
+        }
+        WHEN("an entry is published"){
+            string tmp = write_file(cache.temporary_path(key), "library");
+            string path = cache.publish(key, tmp);
+            THEN("it is found in its final location"){
+                REQUIRE(path == cache.lookup(key));
+                REQUIRE(access(tmp.c_str(), F_OK) != 0);
+            }
+        }
+    }
+    GIVEN("A cache with a maximum size of 10 bytes"){
+        SpecializationCache cache(directory, 10);
+        string key1 = cache.key("source1", "gcc");
+        string key2 = cache.key("source2", "gcc");
+
+        WHEN("two entries of 6 bytes are published"){
+            string path1 = cache.publish(key1, write_file(cache.temporary_path(key1), "first "));
+            struct utimbuf old_time = {0, 0};
+            utime(path1.c_str(), &old_time);
+            cache.publish(key2, write_file(cache.temporary_path(key2), "second"));
+            THEN("the least recently used is evicted"){
+                REQUIRE(cache.lookup(key1).empty());
+                REQUIRE(!cache.lookup(key2).empty());
+            }
+        }
+    }
+    GIVEN("Temporary files left in the cache"){
+        SpecializationCache cache(directory + "/temporary", 1024);
+        string key = cache.key("source", "gcc");
+        string stale = write_file(cache.temporary_path(key), "stale");
+        struct utimbuf old_time = {0, 0};
+        utime(stale.c_str(), &old_time);
+        string recent = write_file(cache.temporary_path(key), "recent");
+
+        WHEN("the cache is evicted"){
+            cache.evict();
+            THEN("only the temporary files older than the grace period are removed"){
+                REQUIRE(access(stale.c_str(), F_OK) != 0);
+                REQUIRE(access(recent.c_str(), F_OK) == 0);
+            }
+        }
+    }
+}
+#endif
@@ -0,0 +1,203 @@
+#include "VersionTable.h"
+#include "log.h"
+
+#include <algorithm>
+#include <cstdlib>
+
+
+using namespace std;
+
+static const size_t DEFAULT_MAX_VERSIONS = 8;
+
+size_t max_versions(){
+    static const size_t versions = [](){
+        const char * var = std::getenv("DOPING_MAX_VERSIONS");
+        try{
+            if (var) return (size_t) std::max(1L, std::stol(var));
+        } catch (std::exception const &e){
+            LOG(ERROR) << "Invalid DOPING_MAX_VERSIONS value: " << var;
+        }
+        return DEFAULT_MAX_VERSIONS;
+    }();
+    return versions;
+}
+
+VersionTable::VersionTable(size_t capacity) : capacity(capacity), clock(0), trace(NULL){
+}
+
+VersionTable::~VersionTable(){
+    for (auto& site : this->call_sites) delete site;
+}
+
+shared_ptr<Specialization> VersionTable::find(const string& signature){
+    lock_guard<std::mutex> lock(this->mutex);
+    auto search = this->versions.find(signature);
+    if (search == this->versions.end()) return NULL;
+    this->touch(search->second.get());
+    return search->second;
+}
+
+shared_ptr<Specialization> VersionTable::insert(const string& signature,
+                                                shared_ptr<Specialization> spec){
+    lock_guard<std::mutex> lock(this->mutex);
+    auto search = this->versions.find(signature);
+    if (search != this->versions.end()){
+        // Another thread inserted it first
+        this->touch(search->second.get());
+        return search->second;
+    }
+    if (this->versions.size() >= this->capacity) this->evict();
+    this->versions[signature] = spec;
+    this->touch(spec.get());
+    return spec;
+}
+
+CallSite * VersionTable::call_site(void ** slot){
+    lock_guard<std::mutex> lock(this->mutex);
+    // Another thread may have created it meanwhile
+    CallSite * site = (CallSite *) __atomic_load_n(slot, __ATOMIC_ACQUIRE);
+    if (site) return site;
+    site = new CallSite(this);
+    this->call_sites.push_back(site);
+    __atomic_store_n(slot, (void *) site, __ATOMIC_RELEASE);
+    return site;
+}
+
+size_t VersionTable::size(){
+    lock_guard<std::mutex> lock(this->mutex);
+    return this->versions.size();
+}
+
+void VersionTable::evict(){
+    // The tables are small, so a linear search of the least recently used
+    // version is cheaper than keeping an ordered list updated on each hit.
+    auto victim = this->versions.end();
+    for (auto it = this->versions.begin(); it != this->versions.end(); ++it){
+        if (it->second->is_pending()) continue;
+        if (victim == this->versions.end() || it->second->last_use < victim->second->last_use){
+            victim = it;
+        }
+    }
+    if (victim == this->versions.end()) return;
+
+    shared_ptr<Specialization> spec = victim->second;
+    LOG(DEBUG) << "Evicting version " << spec->parameters << " used " << spec->hits \
+        << " times";
+    for (auto& site : this->call_sites){
+        shared_ptr<const CallSiteEntry> entry = site->load();
+        if (entry && entry->spec == spec) site->clear();
+    }
+    this->versions.erase(victim);
+}
+
+
+#ifdef UNIT_TEST
+#include "catch.hpp"
+#include <thread>
+
+SCENARIO("Bounded version tables") {
+
+    GIVEN("A table with capacity for two versions"){
+        VersionTable table(2);
+        shared_ptr<Specialization> first = make_shared<Specialization>("", "A:1", "gcc");
+        shared_ptr<Specialization> second = make_shared<Specialization>("", "A:2", "gcc");
+        first->state = FAILED;
+        second->state = FAILED;
+        table.insert("1", first);
+        table.insert("2", second);
+        void * slot = NULL;
+        CallSite * site = table.call_site(&slot);
+        site->update("1", 1, first);
+
+        WHEN("versions are found"){
+            THEN("their hits are counted"){
+                REQUIRE(table.find("1") == first);
+                REQUIRE(table.find("1") == first);
+                REQUIRE(!table.find("3"));
+                REQUIRE(first->hits == 3);
+            }
+        }
+        WHEN("a version with the same signature is inserted"){
+            shared_ptr<Specialization> other = make_shared<Specialization>("", "A:1", "gcc");
+            THEN("the existing version is returned"){
+                REQUIRE(table.insert("1", other) == first);
+                REQUIRE(table.size() == 2);
+            }
+        }
+        WHEN("a third version is inserted"){
+            table.find("1");
+            table.insert("3", make_shared<Specialization>("", "A:3", "gcc"));
+            THEN("the least recently used is evicted"){
+                REQUIRE(table.size() == 2);
+                REQUIRE(!table.find("2"));
+                REQUIRE(table.find("1") == first);
+                REQUIRE(site->load()->spec == first);
+                REQUIRE(second.use_count() == 1);
+            }
+        }
+        WHEN("the version of a call site is evicted"){
+            table.insert("3", make_shared<Specialization>("", "A:3", "gcc"));
+            THEN("the call site is cleared"){
+                REQUIRE(!table.find("1"));
+                REQUIRE(!site->load());
+                REQUIRE(first.use_count() == 1);
+            }
+        }
+        WHEN("the call site of the same slot is requested again"){
+            THEN("the existing one is returned"){
+                REQUIRE(table.call_site(&slot) == site);
+                REQUIRE(slot == site);
+            }
+        }
+    }
+    GIVEN("A full table with a version being compiled"){
+        VersionTable table(1);
+        shared_ptr<Specialization> pending = make_shared<Specialization>("", "A:1", "gcc");
+        table.insert("1", pending);
+        WHEN("a new version is inserted"){
+            shared_ptr<Specialization> other = make_shared<Specialization>("", "A:2", "gcc");
+            other->state = FAILED;
+            table.insert("2", other);
+            THEN("the pending version is not evicted"){
+                REQUIRE(table.size() == 2);
+                REQUIRE(table.find("1") == pending);
+            }
+        }
+    }
+}
+SCENARIO("Concurrent version tables") {
+
+    GIVEN("Several threads inserting versions of the same loop"){
+        VersionTable table(4);
+        void * slot = NULL;
+        vector<shared_ptr<Specialization> > inserted(8);
+        vector<CallSite *> sites(8);
+        vector<thread> threads;
+        for (size_t t = 0; t < inserted.size(); t++){
+            threads.push_back(thread([&table, &slot, &inserted, &sites, t](){
+                for (int repetition = 0; repetition < 100; repetition++){
+                    string signature = to_string(repetition % 2);
+                    shared_ptr<Specialization> spec = table.find(signature);
+                    if (!spec){
+                        spec = make_shared<Specialization>("", signature, "gcc");
+                        spec->state = FAILED;
+                        spec = table.insert(signature, spec);
+                    }
+                    if (signature == "0") inserted[t] = spec;
+                }
+                sites[t] = table.call_site(&slot);
+            }));
+        }
+        for (auto& thread : threads) thread.join();
+
+        THEN("all of them use the same version and call site"){
+            REQUIRE(table.size() == 2);
+            for (size_t t = 0; t < inserted.size(); t++){
+                REQUIRE(inserted[t] == inserted[0]);
+                REQUIRE(sites[t] == sites[0]);
+            }
+            REQUIRE(inserted[0]->hits == 400);
+        }
+    }
+}
+#endif
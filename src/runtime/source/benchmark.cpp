@@ -0,0 +1,309 @@
+// Micro-benchmarks of the overhead that the Doping runtime adds to each
+// entry of a transformed loop. Each case runs the same loop body as the
+// plain `for` loop and wrapped as the codegen generates it (building the
+// dopinginfo and the binary signature, calling dopingRuntime with the
+// arguments and running the specialization found through the call site or
+// the version table). The results are printed as a table and written as
+// JSON with --output, so they can be compared between versions.
+//
+// Usage: run_benchmark [--quick] [--output FILE]
+
+#include "dopingRuntime.h"
+#include "DynamicFunction.h"
+#include "RuntimeTrace.h"
+
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+
+using namespace std;
+
+static const int MAX_POINTERS = 8;
+static const int MAX_INVARIANTS = 8;
+
+// Minimum time of each timed batch (reduced by --quick)
+static double min_batch_time = 0.05;
+
+static double now_seconds(){
+    chrono::duration<double> now = chrono::steady_clock::now().time_since_epoch();
+    return now.count();
+}
+
+struct Case {
+    string name;
+    int trips;
+    int invariants;
+    int pointers;
+    // Number of distinct invariant values the entries cycle through, with
+    // more than one the call site misses and the version table is searched.
+    int distinct;
+};
+
+struct Result {
+    Case config;
+    double plain_ns;
+    double doping_ns;
+};
+
+// Source of the specialization, as rendered by the codegen for the loop
+// `for (i = 0; i < n; i++) s += a0[i] + ... ;`
+static string loop_source(const Case& config){
+    ostringstream source;
+    source << "#include <stdarg.h>\n"
+           << "void function(int dopingCurrentIteration, va_list args){\n"
+           << "const int n = /*<DOPING n >*/;\n";
+    for (int k = 1; k < config.invariants; k++){
+        source << "const long long k" << k << " = /*<DOPING k" << k << " >*/;\n";
+    }
+    source << "double* s_dopingglobal = va_arg(args, double*);\n";
+    for (int p = 0; p < config.pointers; p++){
+        source << "double * a" << p << " = va_arg(args, double *);\n";
+    }
+    source << "double s = (*s_dopingglobal);\n"
+           << "for(int i = dopingCurrentIteration; i < n; i++){\n"
+           << "    s += a0[i]";
+    for (int p = 1; p < config.pointers; p++) source << " + a" << p << "[i]";
+    source << ";\n}\n(*s_dopingglobal) = s;\n}\n";
+    return source.str();
+}
+
+static string signature_format(const Case& config){
+    string format = "n:d";
+    for (int k = 1; k < config.invariants; k++) format += ",k" + to_string(k) + ":d";
+    return format;
+}
+
+template <int P>
+__attribute__((noinline)) static double plain_loop(double ** a, int n){
+    double s = 0;
+    for (int i = 0; i < n; i++){
+        for (int p = 0; p < P; p++) s += a[p][i];
+    }
+    return s;
+}
+
+// The loop as transformed by the codegen.
+template <int P>
+__attribute__((noinline)) static double doping_loop(double ** a, int n, long long value,
+                                                    const Case& config, const char * source,
+                                                    const char * format, void ** call_site){
+    double s = 0;
+    long long signature[MAX_INVARIANTS] = {n, value, value, value, value, value, value, value};
+    dopinginfo info = dopinginfo();
+    info.iteration_start = 0;
+    info.iteration_space = n - 1;
+    info.source = source;
+    info.compiler_command = "gcc -O2";
+    info.name = config.name.c_str();
+    info.signature = signature;
+    info.signature_size = config.invariants * sizeof(long long);
+    info.signature_format = format;
+    info.call_site = call_site;
+    int i = 0;
+    while (dopingRuntime(i, i < n, &info, &s, a[0], a[1], a[2], a[3], a[4], a[5], a[6], a[7])){
+        for (long chunk = info.chunk_size; i < n && chunk-- > 0; i++){
+            for (int p = 0; p < P; p++) s += a[p][i];
+        }
+    }
+    return s;
+}
+
+// Return the nanoseconds per call of the function, the minimum of three
+// batches, each of them repeated until it takes at least min_batch_time.
+template <typename F>
+static double time_per_call(F function){
+    static volatile double sink = 0;
+    long calls = 1;
+    double best = -1;
+    for (int batch = 0; batch < 3; batch++){
+        while (true){
+            double start = now_seconds();
+            for (long call = 0; call < calls; call++) sink = sink + function(call);
+            double elapsed = now_seconds() - start;
+            if (elapsed >= min_batch_time){
+                if (best < 0 || elapsed / calls < best) best = elapsed / calls;
+                break;
+            }
+            calls *= 2;
+        }
+    }
+    return best * 1e9;
+}
+
+template <int P>
+static Result run_case_with(const Case& config, double ** a){
+    string source = loop_source(config);
+    string format = signature_format(config);
+    void * call_site = NULL;
+    // Warm up, so each specialization is compiled before being timed
+    for (int value = 0; value < config.distinct; value++){
+        doping_loop<P>(a, config.trips, value, config, source.c_str(), format.c_str(),
+                       &call_site);
+    }
+    Result result;
+    result.config = config;
+    result.plain_ns = time_per_call([&](long){return plain_loop<P>(a, config.trips);});
+    result.doping_ns = time_per_call([&](long call){
+        return doping_loop<P>(a, config.trips, call % config.distinct, config,
+                              source.c_str(), format.c_str(), &call_site);
+    });
+    return result;
+}
+
+static Result run_case(const Case& config, double ** a){
+    switch (config.pointers){
+        case 1: return run_case_with<1>(config, a);
+        case 2: return run_case_with<2>(config, a);
+        case 4: return run_case_with<4>(config, a);
+        default: return run_case_with<8>(config, a);
+    }
+}
+
+static string result_json(const Result& result){
+    ostringstream json;
+    json << "{\"name\": " << json_string(result.config.name)
+         << ", \"trips\": " << result.config.trips
+         << ", \"invariants\": " << result.config.invariants
+         << ", \"pointers\": " << result.config.pointers
+         << ", \"distinct\": " << result.config.distinct
+         << ", \"plain_ns_per_entry\": " << result.plain_ns
+         << ", \"doping_ns_per_entry\": " << result.doping_ns
+         << ", \"overhead_ns_per_entry\": " << result.doping_ns - result.plain_ns << "}";
+    return json.str();
+}
+
+static string optional_json(double value){
+    if (value < 0) return "null";
+    ostringstream json;
+    json << value;
+    return json.str();
+}
+
+// Time to compile a specialization and to load it from the persistent cache,
+// its parameters are not used by any other case so the first one is a miss.
+static void compilation_times(double * compile, double * cached){
+    Case config = {"benchmark_compilation", 1000, 1, 1, 1};
+    string source = loop_source(config);
+    double start = now_seconds();
+    DynamicFunction first(source, "n:1000");
+    first.compile_and_link("gcc -O2");
+    *compile = now_seconds() - start;
+    start = now_seconds();
+    DynamicFunction second(source, "n:1000");
+    second.compile_and_link("gcc -O2");
+    *cached = second.is_cached() ? now_seconds() - start : -1;
+}
+
+int main(int argc, char ** argv){
+    string output;
+    for (int arg = 1; arg < argc; arg++){
+        if (strcmp(argv[arg], "--quick") == 0){
+            min_batch_time = 0.005;
+        }else if (strcmp(argv[arg], "--output") == 0 && arg + 1 < argc){
+            output = argv[++arg];
+        }else{
+            cerr << "Usage: " << argv[0] << " [--quick] [--output FILE]" << endl;
+            return 1;
+        }
+    }
+
+    // Use a fresh persistent cache, so the first compilation of each
+    // specialization is a miss.
+    char tmpl[] = "/tmp/doping_benchmark_XXXXXX";
+    string cache_directory(mkdtemp(tmpl));
+    setenv("DOPING_CACHE_DIR", cache_directory.c_str(), 1);
+
+    const int max_trips = 65536;
+    vector<vector<double> > arrays(MAX_POINTERS, vector<double>(max_trips, 1.0));
+    double * a[MAX_POINTERS];
+    for (int p = 0; p < MAX_POINTERS; p++) a[p] = arrays[p].data();
+
+    vector<Case> cases;
+    for (int trips = 1; trips <= max_trips; trips *= 4){
+        cases.push_back({"trips_" + to_string(trips), trips, 1, 1, 1});
+    }
+    for (int invariants = 2; invariants <= MAX_INVARIANTS; invariants *= 2){
+        cases.push_back({"invariants_" + to_string(invariants), 16, invariants, 1, 1});
+    }
+    for (int pointers = 2; pointers <= MAX_POINTERS; pointers *= 2){
+        cases.push_back({"pointers_" + to_string(pointers), 16, 1, pointers, 1});
+    }
+    for (int distinct = 1; distinct <= 4; distinct *= 2){
+        cases.push_back({"distinct_" + to_string(distinct), 16, 2, 1, distinct});
+    }
+
+    printf("%-16s %8s %8s %12s %12s %12s\n", "case", "trips", "ptrs", "plain ns",
+           "doping ns", "overhead ns");
+    vector<Result> results;
+    for (auto& config : cases){
+        results.push_back(run_case(config, a));
+        const Result& result = results.back();
+        printf("%-16s %8d %8d %12.1f %12.1f %12.1f\n", config.name.c_str(), config.trips,
+               config.pointers, result.plain_ns, result.doping_ns,
+               result.doping_ns - result.plain_ns);
+    }
+
+    // Break-even trip counts of the trips sweep: the first trip count where
+    // the wrapped loop is as fast as the plain loop, and the first one where
+    // its overhead is below 5%.
+    double break_even = -1, overhead_5 = -1, saving = 0;
+    double call_site_hit = -1, table_hit = -1;
+    for (auto& result : results){
+        if (result.config.name.compare(0, 6, "trips_") == 0){
+            if (break_even < 0 && result.doping_ns <= result.plain_ns){
+                break_even = result.config.trips;
+            }
+            if (overhead_5 < 0 && result.doping_ns <= 1.05 * result.plain_ns){
+                overhead_5 = result.config.trips;
+            }
+            saving = result.plain_ns - result.doping_ns;
+        }
+        if (result.config.name == "distinct_1"){
+            call_site_hit = result.doping_ns - result.plain_ns;
+        }
+        if (result.config.name == "distinct_2"){
+            table_hit = result.doping_ns - result.plain_ns;
+        }
+    }
+    double compile, cached;
+    compilation_times(&compile, &cached);
+    // Entries of the largest loop needed to pay for the compilation
+    double compile_break_even = saving > 0 ? compile * 1e9 / saving : -1;
+
+    printf("\ncall site hit: %.1f ns/entry, version table hit: %.1f ns/entry\n",
+           call_site_hit, table_hit);
+    printf("compilation: %.4f s, persistent cache load: %.4f s\n", compile, cached);
+    printf("break-even trip count: %s, overhead below 5%% at: %s trips\n",
+           optional_json(break_even).c_str(), optional_json(overhead_5).c_str());
+
+    if (!output.empty()){
+        ofstream file(output, ofstream::out | ofstream::trunc);
+        file << "{\"cases\": [";
+        for (size_t i = 0; i < results.size(); i++){
+            file << (i ? ",\n  " : "\n  ") << result_json(results[i]);
+        }
+        file << "\n],\n"
+             << "\"call_site_hit_ns\": " << call_site_hit << ",\n"
+             << "\"version_table_hit_ns\": " << table_hit << ",\n"
+             << "\"compile_seconds\": " << compile << ",\n"
+             << "\"persistent_cache_seconds\": " << optional_json(cached) << ",\n"
+             << "\"break_even_trip_count\": " << optional_json(break_even) << ",\n"
+             << "\"overhead_5_percent_trip_count\": " << optional_json(overhead_5) << ",\n"
+             << "\"compile_break_even_entries\": " << optional_json(compile_break_even)
+             << "\n}\n";
+        if (file.fail()){
+            cerr << "Could not write " << output << endl;
+            return 1;
+        }
+        printf("Results written in %s\n", output.c_str());
+    }
+    run_shell("rm -rf " + cache_directory);
+    return 0;
+}
@@ -2,23 +2,218 @@
 
 #include <string>
 #include <map>
+#include <unordered_map>
 #include <chrono>
+#include <algorithm>
+#include <functional>
+#include <memory>
+#include <mutex>
 
 #include <cstdarg>
 
 #include <unistd.h>
 #include <stdlib.h>
+#include <limits.h>
 #include <time.h>
 
 #include "log.h"
 #include "DynamicFunction.h"
+#include "CompilationQueue.h"
+#include "DecisionPolicy.h"
+#include "CallSite.h"
+#include "VersionTable.h"
+#include "RuntimeTrace.h"
+#include "SpecializationCache.h"
 
 
 using namespace std;
 
-bool global_counter = 0;
+// Nested Doping runtimes are forbidden, but each thread (e.g. in an OpenMP
+// parallel region) can be inside its own runtime.
+static thread_local bool global_counter = 0;
 
-std::map<std::string, DynamicFunction*> function_table;
+// Bounded table of specializations of each loop, indexed by the loop name.
+// It is split in shards with their own lock, so threads entering different
+// loops for the first time don't wait for each other. The tables are never
+// deleted, so they can be used without holding the lock.
+static const int FUNCTION_TABLE_SHARDS = 16;
+struct FunctionTableShard {
+    std::mutex mutex;
+    std::unordered_map<std::string, VersionTable*> tables;
+};
+static FunctionTableShard function_table[FUNCTION_TABLE_SHARDS];
+
+// Baseline times used by the decision policies, protected by decision_mutex.
+static std::mutex decision_mutex;
+// Measured time per iteration of the baseline version of each loop
+static std::map<std::string, double> baseline_iteration_times;
+// Whether each specialization is in the persistent cache, it is only checked
+// once per execution because it needs to render the source. It has its own
+// mutex, which is not held while checking the cache.
+static std::mutex cache_status_mutex;
+static std::map<std::string, bool> cache_status;
+
+// If DOPING_ASYNC is set, specializations are compiled by a background
+// thread while the loop continues executing the baseline code.
+static bool async_compilation(){
+    static bool async = std::getenv("DOPING_ASYNC") != NULL &&
+                        std::string(std::getenv("DOPING_ASYNC")) != "0";
+    return async;
+}
+
+// Number of baseline iterations executed between checks of a pending
+// background compilation, it can be set with DOPING_ASYNC_POLL.
+static long async_poll_iterations(){
+    static const long iterations = [](){
+        const char * var = std::getenv("DOPING_ASYNC_POLL");
+        try{
+            if (var) return std::max(1L, std::stol(var));
+        } catch (std::exception const &e){
+            LOG(ERROR) << "Invalid DOPING_ASYNC_POLL value: " << var;
+        }
+        return 1024L;
+    }();
+    return iterations;
+}
+
+// Return to the baseline loop, which will call the runtime again after
+// chunk_size iterations if it has not finished by then.
+template <typename T, typename U>
+static int continue_baseline(T continue_condition, U * loop, long chunk_size){
+    loop->chunk_size = chunk_size;
+    return continue_condition;
+}
+
+template <typename U>
+static const char * loop_name(U * loop){
+    return loop->name ? loop->name : "";
+}
+
+// Key of the specialization in the version table of the loop, the binary
+// signature (or the parameters string if the loop doesn't provide one).
+template <typename U>
+static std::string signature_key(U * loop){
+    if (loop->signature){
+        return std::string((const char *) loop->signature, loop->signature_size);
+    }
+    return loop->parameters ? loop->parameters : "";
+}
+
+template <typename U>
+static VersionTable * version_table(U * loop){
+    std::string name(loop_name(loop));
+    FunctionTableShard& shard = function_table[std::hash<std::string>()(name) %
+                                               FUNCTION_TABLE_SHARDS];
+    lock_guard<std::mutex> lock(shard.mutex);
+    auto search = shard.tables.find(name);
+    if (search != shard.tables.end()) return search->second;
+    VersionTable * table = new VersionTable(max_versions());
+    if (get_runtime_trace()) table->trace = get_runtime_trace()->loop(name);
+    shard.tables.insert(std::make_pair(name, table));
+    return table;
+}
+
+// Iterations left to finish the loop, including the current one. The
+// iteration_space is the last value of the iteration variable.
+template <typename T, typename U>
+static long remaining_iterations(T current_iteration, U * loop){
+    return count_remaining_iterations((long) loop->iteration_start,
+                                      (long) loop->iteration_space,
+                                      (long) current_iteration);
+}
+
+// Trip count of the loop if it is entered at its first iteration, -1 if it is
+// a later call to the runtime during the same execution of the loop.
+template <typename T, typename U>
+static long trip_count(T current_iteration, U * loop){
+    if ((long) current_iteration != (long) loop->iteration_start) return -1;
+    return remaining_iterations(current_iteration, loop);
+}
+
+// Parameters string used to render the source of the loop.
+template <typename U>
+static std::string specialization_parameters(U * loop){
+    if (loop->signature && loop->signature_format){
+        return format_signature(loop->signature_format, loop->signature,
+                                loop->signature_size);
+    }
+    return loop->parameters ? loop->parameters : "";
+}
+
+static double now_seconds(){
+    chrono::duration<double> now = chrono::steady_clock::now().time_since_epoch();
+    return now.count();
+}
+
+// Run a timed chunk of baseline iterations to estimate the loop cost.
+template <typename T, typename U>
+static int start_sample(T current_iteration, T continue_condition, U * loop){
+    LOG(INFO) << "Sampling " << sample_iterations() << " baseline iterations.";
+    loop->sample_start_time = now_seconds();
+    loop->sample_start_iteration = (long) current_iteration;
+    return continue_baseline(continue_condition, loop, sample_iterations());
+}
+
+// Record the time per iteration of the sample started by start_sample.
+template <typename T, typename U>
+static void finish_sample(T current_iteration, U * loop){
+    double elapsed = now_seconds() - loop->sample_start_time;
+    long iterations = labs((long) current_iteration - loop->sample_start_iteration);
+    loop->sample_start_time = 0;
+    if (iterations > 0){
+        LoopTrace * trace = version_table(loop)->trace;
+        if (trace) trace->baseline_sample(iterations, elapsed);
+        lock_guard<std::mutex> lock(decision_mutex);
+        baseline_iteration_times[loop_name(loop)] = elapsed / iterations;
+        LOG(DEBUG) << "Baseline sample: " << iterations << " iterations in " \
+            << elapsed << " seconds.";
+    }
+}
+
+template <typename U>
+static bool is_cached(U * loop, const std::string& key, const std::string& parameters){
+    {
+        lock_guard<std::mutex> lock(cache_status_mutex);
+        auto search = cache_status.find(key);
+        if (search != cache_status.end()) return search->second;
+    }
+    // Rendering the source and querying the compiler version is slow, so
+    // other threads are not blocked meanwhile. Threads that check the same
+    // specialization concurrently get the same result.
+    bool cached = false;
+    try{
+        DynamicFunction df(loop->source, parameters);
+        cached = df.in_cache(loop->compiler_command);
+    } catch(exception& e){
+        LOG(ERROR) << e.what();
+    }
+    lock_guard<std::mutex> lock(cache_status_mutex);
+    cache_status[key] = cached;
+    return cached;
+}
+
+template <typename T, typename U>
+static dopingdecisioninfo decision_info(T current_iteration, U * loop, float progress,
+                                        const std::string& key,
+                                        const std::string& parameters){
+    dopingdecisioninfo info;
+    info.name = loop_name(loop);
+    info.remaining_iterations = remaining_iterations(current_iteration, loop);
+    info.progress = progress;
+    info.baseline_iteration_time = -1;
+    {
+        lock_guard<std::mutex> lock(decision_mutex);
+        auto search = baseline_iteration_times.find(loop_name(loop));
+        if (search != baseline_iteration_times.end()){
+            info.baseline_iteration_time = search->second;
+        }
+    }
+    // Checking the cache is only worth it if the policy has the information
+    // to compare the compilation time with something.
+    info.cached = info.baseline_iteration_time >= 0 && is_cached(loop, key, parameters);
+    info.expected_compile_time = expected_compile_time(info.cached);
+    return info;
+}
 
 template <typename T, typename U>
 int dopingRuntimeG(
@@ -27,107 +222,164 @@ int dopingRuntimeG(
         U * loop,
         va_list arguments){
 
-    chrono::time_point<chrono::system_clock> tstart, tend;
-
     // If iteration space has finished, do nothing and return
-    if (!continue_condition) return continue_condition;
+    if (!continue_condition){
+        if (loop->sample_start_time > 0) finish_sample(current_iteration, loop);
+        return continue_condition;
+    }
 
     // If the loop is too small, continue with the original code
     // if (loop->iteration_space < 100) return continue_condition;
 
     // Forbid nested Doping run-times for now
-    if (global_counter > 0) return continue_condition;
+    if (global_counter > 0) return continue_baseline(continue_condition, loop, LONG_MAX);
 
     global_counter = 1;
 
-    
-    if(loop->name == NULL){
-        LOG(INFO) << "Entering unnamed Doping Runtime.";
-    }else{
-        LOG(INFO) << "Entering Doping Runtime for loop " << loop->name << ".";
-    }
-    LOG(DEBUG) << " - current_iteration = " << current_iteration;
-    LOG(DEBUG) << " - compiler_command = " << loop->compiler_command;
-    //LOG(DEBUG) << " - timer=" << loop->timer;
-    LOG(DEBUG) << " - iteration_start = " << loop->iteration_start;
-    LOG(DEBUG) << " - iteration_space = " << loop->iteration_space;
-    LOG(DEBUG_LONG) << " - source: " << loop->source;
-    //LOG(DEBUG) << " - stage = " << loop->stage;
-    LOG(DEBUG) << " - parameters = " << loop->parameters;
-        
-    float progress = float(current_iteration) / \
-                     (loop->iteration_space - loop->iteration_start);
-    auto key = std::string(loop->name) + std::string(loop->parameters);
-    //float threshold = 0.5;
-
-
-    DynamicFunction * df = NULL;
-
-    // First try to find the DynamicFunction in the FunctionsTable
-    auto search = function_table.find(key);
-    if (search != function_table.end() ){
-        LOG(INFO) << key << " found in the FunctionsTable";
-        df = search->second;
+    if (loop->sample_start_time > 0) finish_sample(current_iteration, loop);
+
+    // The specialization is kept alive while this thread uses it, even if it
+    // is evicted meanwhile.
+    std::shared_ptr<Specialization> spec;
+    CallSite * site = NULL;
+    LoopTrace * trace = NULL;
+    if (loop->call_site) site = (CallSite *) __atomic_load_n(loop->call_site, __ATOMIC_ACQUIRE);
+
+    // Fast path: the runtime values are the same as in the last entry to this
+    // loop, so we can use the same specialization without searching it.
+    if (site && loop->signature){
+        std::shared_ptr<const CallSiteEntry> entry = site->load();
+        if (entry && entry->matches(loop->signature, loop->signature_size)){
+            spec = entry->spec;
+            site->table->touch(spec.get());
+            trace = site->table->trace;
+            if (trace) trace->entry(true, trip_count(current_iteration, loop));
+        }
     }
-    // Then check if the conditions to re-compile are met.
-    else if (true){
-    //else if ( (progress < threshold) ){
-
-        LOG(INFO) << "Runtime Analysis: Loop at " << current_iteration << " (" \
-            << 100*progress << " %)"; // (ETC: " << 2/progress << " s)";
-        // LOG(INFO) << progress << " < " << threshold << " -> Decided to recompile";
-        
-        tstart = chrono::system_clock::now();
-        try {
-            df = new DynamicFunction(loop->source, loop->parameters);
-            df->compile_and_link(loop->compiler_command);
+    if (!spec){
+        if(loop->name == NULL){
+            LOG(INFO) << "Entering unnamed Doping Runtime.";
+        }else{
+            LOG(INFO) << "Entering Doping Runtime for loop " << loop->name << ".";
+        }
+        LOG(DEBUG) << " - current_iteration = " << current_iteration;
+        LOG(DEBUG) << " - compiler_command = " << loop->compiler_command;
+        LOG(DEBUG) << " - iteration_start = " << loop->iteration_start;
+        LOG(DEBUG) << " - iteration_space = " << loop->iteration_space;
+        LOG(DEBUG_LONG) << " - source: " << loop->source;
+
+        float progress = float(current_iteration) / \
+                         (loop->iteration_space - loop->iteration_start);
+        VersionTable * table = version_table(loop);
+        trace = table->trace;
+        if (trace) trace->entry(false, trip_count(current_iteration, loop));
+        std::string signature = signature_key(loop);
+        std::string key = std::string(loop_name(loop)) + '\0' + signature;
+        std::string parameters;
+        try{
+            parameters = specialization_parameters(loop);
         } catch(exception& e){
-            LOG(ERROR) << "Doping failed to dynamically optimize function with error:";
             LOG(ERROR) << e.what();
             LOG(ERROR) << "Continuing with baseline code.";
-            df = NULL;
+            if (trace) trace->baseline("error");
+            global_counter = 0;
+            return continue_baseline(continue_condition, loop, LONG_MAX);
         }
-        // If built successfully, add it into the Functions Table
-        if (df) {
-            LOG(DEBUG) << "Added " << key << " into the functions table";
-            function_table.insert(std::make_pair(key, df));
+        LOG(DEBUG) << " - parameters = " << parameters;
+
+        // First try to find the Specialization in the FunctionsTable
+        spec = table->find(signature);
+        if (trace) trace->table_lookup(spec != NULL);
+        if (spec){
+            LOG(INFO) << parameters << " found in the FunctionsTable";
         }
-        tend = chrono::system_clock::now();
-        chrono::duration<double> tduration = tend - tstart;
-        LOG(INFO) << "Rendering template, compilation and linking took: " << tduration.count() \
-            << " seconds.";
-        if (std::getenv("DOPING_BENCHMARK") != NULL){
-            cout << "DopingRuntime: " <<  tduration.count() << " ";
+        // Then ask the policy if the conditions to re-compile are met.
+        else {
+            LOG(INFO) << "Runtime Analysis: Loop at " << current_iteration << " (" \
+                << 100*progress << " %)";
+            dopingdecisioninfo info = decision_info(current_iteration, loop, progress,
+                                                    key, parameters);
+            Decision decision = get_policy()->decide(info);
+
+            if (decision == SAMPLE){
+                if (trace) trace->baseline("sample");
+                global_counter = 0;
+                return start_sample(current_iteration, continue_condition, loop);
+            }
+            if (decision == BASELINE){
+                LOG(INFO) << "Policy " << get_policy()->name() << " decided to continue with baseline code.";
+                if (trace) trace->baseline("policy");
+                global_counter = 0;
+                return continue_baseline(continue_condition, loop, LONG_MAX);
+            }
+
+            // Failed specializations are also kept in the Functions Table, so
+            // we don't try to compile them again.
+            std::shared_ptr<Specialization> newspec = std::make_shared<Specialization>(
+                loop->source, parameters, loop->compiler_command);
+            newspec->trace = trace;
+            if (info.baseline_iteration_time >= 0){
+                newspec->predicted_baseline_time = info.remaining_iterations * info.baseline_iteration_time;
+            }
+            // If another thread inserted it first, it is the one compiling it
+            // and this thread continues with the baseline until it is ready.
+            spec = table->insert(signature, newspec);
+            if (spec == newspec){
+                LOG(DEBUG) << "Added " << parameters << " into the functions table";
+                if (async_compilation()){
+                    LOG(INFO) << "Compilation enqueued, continuing with baseline code.";
+                    CompilationQueue::instance().enqueue(spec);
+                }else{
+                    spec->compile();
+                }
+            }
+        }
+
+        // Remember the specialization for the next entry to this loop
+        if (loop->call_site && loop->signature){
+            if (site == NULL) site = table->call_site(loop->call_site);
+            site->update(loop->signature, loop->signature_size, spec);
         }
     }
 
     // If we have a dynamic function, execute it, otherwise continue with
     // the baseline implementation.
-    if (df){
+    if (spec && spec->is_ready()){
+        chrono::time_point<chrono::system_clock> tstart, tend;
         tstart = chrono::system_clock::now();
-        df->run(current_iteration, arguments);
+        spec->df->run(current_iteration, arguments);
         tend = chrono::system_clock::now();
         chrono::duration<double> tduration = tend - tstart;
 
         LOG(INFO) << "Time to complete DynFunction: " <<  tduration.count() << " seconds.";
+        if (trace){
+            trace->specialized_run(tduration.count(),
+                                   remaining_iterations(current_iteration, loop));
+        }
+        if (spec->runs++ == 0 && spec->predicted_baseline_time >= 0){
+            // Compare the decision with what actually happened, the first
+            // run pays for the compilation.
+            double actual = tduration.count() + spec->compile_time;
+            LOG(INFO) << "Predicted baseline time " << spec->predicted_baseline_time \
+                << " seconds, specialization took " << actual << " seconds (gain " \
+                << spec->predicted_baseline_time - actual << " seconds).";
+        }
 
         global_counter = 0;
         return 0; // Assume loop is finished (this may need a more careful solution)
+    }else if (spec && spec->is_pending()){
+        // Run some baseline iterations and check again if the compilation
+        // (in the background or by another thread) has finished.
+        if (trace) trace->baseline("pending");
+        global_counter = 0;
+        return continue_baseline(continue_condition, loop, async_poll_iterations());
     }else{
         //loop->timer = doping_set_timer();
+        if (trace) trace->baseline("failed");
         global_counter = 0;
-        return continue_condition;
+        return continue_baseline(continue_condition, loop, LONG_MAX);
     }
 }
-// Check if optimized library is already compiled from a previous executions
-// else if( access( libname, F_OK ) != -1) { 
-//    LOG(INFO, "Specialized loop %s already compiled. Linking and executing  ...", libname);
-//     link_specialized_fn(libname);
-//     function(args);
-//     return false;
-//
-//
-//
 
 
 // Specialization of dopingRuntime for the extern "C" (no templates)
@@ -149,3 +401,21 @@ int dopingRuntime(int current_iteration, int continue_condition,
     va_end(arguments);
 }
 
+int dopingPrecompile(const char * source, const char * signature_format,
+                     const char * parameters, const char * compiler_command,
+                     const char * directory){
+    try{
+        // Go through the binary signature so the values are formatted exactly
+        // as they are at runtime.
+        std::string signature = build_signature(signature_format, parameters);
+        DynamicFunction df(source, format_signature(signature_format, signature.data(),
+                                                    signature.size()));
+        SpecializationCache cache(directory, ULONG_MAX);
+        std::string libname = df.precompile(compiler_command, cache);
+        LOG(INFO) << "Precompiled " << parameters << " into " << libname;
+    } catch(exception& e){
+        LOG(ERROR) << "Failed to precompile " << parameters << ": " << e.what();
+        return 0;
+    }
+    return 1;
+}
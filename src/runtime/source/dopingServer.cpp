@@ -0,0 +1,33 @@
+#include "CompileServer.h"
+#include "log.h"
+
+#include <string>
+#include <unistd.h>
+
+
+using namespace std;
+
+// Compile server started by the runtime when DOPING_COMPILER_BACKEND=server.
+// It runs in the background (unless --foreground is given) until it has been
+// idle for DOPING_SERVER_IDLE_TIMEOUT seconds.
+int main(int argc, char ** argv){
+    bool foreground = argc > 1 && string(argv[1]) == "--foreground";
+
+    CompileServer server(server_socket_path(), server_cache_directory(),
+                         server_idle_timeout());
+    // If another server is already listening there is nothing to do
+    if (!server.start()) return 0;
+
+    if (!foreground){
+        pid_t pid = fork();
+        if (pid < 0){
+            LOG(ERROR) << "Could not start the compile server in the background";
+            return 1;
+        }
+        // The parent returns once the socket is ready
+        if (pid > 0) _exit(0);
+        setsid();
+    }
+    server.serve();
+    return 0;
+}